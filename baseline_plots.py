@@ -1,8 +1,18 @@
-import sys
+import sys, imp
+imp.load_source('common_functions','common_functions.py')
+import common_functions as cf
 
 vis = sys.argv[3]
 fields = sys.argv[4]
 chanavg = sys.argv[5]
 
-command = "plotms(vis='{0}', gridrows=2, gridcols=2, xaxis='time', yaxis='amp', field='{1}', avgchannel='{2}', iteraxis='baseline', exprange='all', xselfscale=True, yselfscale=True, plotfile='plots/baseline_plots/baseline_plot.png', coloraxis='scan', showgui=False)".format(vis,fields,chanavg)
-exec(command)
+logger = cf.get_logger(LOG_FILE_INFO='baseline_plots.log', LOG_FILE_ERROR='baseline_plots_errors.log')
+cf.makedir('plots/baseline_plots/',logger)
+
+#One plot per antenna (with the baselines to all the later antennas) so that they can be rendered in parallel
+antennas = cf.ms_metadata(vis,logger)['antennas']
+for i in range(len(antennas)-1):
+    cf.queue_plot(logger,vis=vis, gridrows=2, gridcols=2, xaxis='time', yaxis='amp', field=fields, avgchannel=chanavg,
+                  antenna='{0}&{1}'.format(antennas[i],','.join(antennas[i+1:])), iteraxis='baseline', exprange='all',
+                  xselfscale=True, yselfscale=True, plotfile='plots/baseline_plots/baseline_plot_{}.png'.format(antennas[i]), coloraxis='scan')
+cf.render_plots(None,None,logger)
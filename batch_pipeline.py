@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import csv
+import time
+import glob
+import json
+import shutil
+import logging
+import argparse
+import subprocess
+import collections
+import configparser
+from ast import literal_eval
+
+
+# Sizes of the cost model of the plans (as in plan_pipeline.py), to put their cost in bytes
+vis_bytes = 12. # Bytes per visibility
+pixel_bytes = 4. # Bytes per image pixel
+
+
+def read_batch_config(configfile):
+    """
+    Parses the batch parameters file.
+
+    Input:
+    configfile = Path to the batch parameters file. (String)
+
+    Output:
+    config = The parameters read from the file, with paths relative to the file made absolute. (Ordered dictionary)
+    """
+    if not os.path.isfile(configfile):
+        raise FileNotFoundError(' Batch parameters file {} not found. '.format(configfile))
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(configfile)
+    config = collections.OrderedDict()
+    for section in config_raw.sections():
+        config[section] = collections.OrderedDict()
+        for option in config_raw.options(section):
+            try:
+                config[section][option] = literal_eval(config_raw.get(section, option))
+            except (ValueError, SyntaxError):
+                config[section][option] = config_raw.get(section, option)
+    base_dir = os.path.dirname(os.path.abspath(configfile))
+    batch = config['batch']
+    batch.setdefault('target', 'moment_zero')
+    batch.setdefault('max_cores', os.cpu_count())
+    batch.setdefault('max_memory', mem_total()/2.**30)
+    batch.setdefault('min_free_disk', 50.)
+    batch.setdefault('job_cores', 1)
+    batch.setdefault('job_memory', 8.)
+    batch.setdefault('disk_factor', 4.)
+    batch.setdefault('poll', 30)
+    batch['flag_db'] = os.path.join(base_dir, os.path.expanduser(batch.get('flag_db', 'flagstats.sqlite')))
+    batch['scripts'] = os.path.join(os.path.abspath(os.path.expanduser(batch['scripts'])), '')
+    config['projects'] = [os.path.normpath(os.path.join(base_dir, path)) for path in config['jobs'].get('projects', [])]
+    config['combine'] = [os.path.normpath(os.path.join(base_dir, path)) for path in config['jobs'].get('combine', [])]
+    return config
+
+
+def read_params(configfile):
+    """
+    Reads a pipeline (or combined imaging) parameters file without evaluating anything CASA specific.
+    """
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(configfile)
+    params = collections.OrderedDict()
+    for section in config_raw.sections():
+        params[section] = collections.OrderedDict()
+        for option in config_raw.options(section):
+            try:
+                params[section][option] = literal_eval(config_raw.get(section, option))
+            except (ValueError, SyntaxError):
+                params[section][option] = config_raw.get(section, option)
+    return params
+
+
+def read_yml(ymlfile):
+    """
+    Reads the simple 'key: value' pairs of a pipeline yml file.
+    """
+    values = collections.OrderedDict()
+    with open(ymlfile, 'r') as f:
+        for line in f:
+            if ':' not in line or line.strip().startswith('#'):
+                continue
+            key, value = line.split(':', 1)
+            values[key.strip()] = value.split('#')[0].strip()
+    return values
+
+
+def mem_total():
+    """
+    Returns the total physical memory in bytes.
+    """
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+
+def mem_available():
+    """
+    Returns the memory available for new processes in bytes (from /proc/meminfo).
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return mem_total()
+
+
+def path_size(path):
+    """
+    Returns the total size in bytes of a file or directory tree.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def read_csv(path):
+    """
+    Returns the rows of a CSV file (an empty list if it does not exist).
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        return list(csv.DictReader(f))
+
+
+def project_job(project_dir, batch):
+    """
+    Describes the pipeline run of one project: its parameters and the cores, memory (GB) and disk (GB) it is expected to need.
+    The cost (used to start the longest jobs first) and disk use come from the plan (summary/<project>.plan.csv) if one was made,
+    otherwise they are scaled from the size of the raw data (see scale_costs). The cost of a plan is the bytes its calls read: the
+    visibilities x passes (x major cycles) converted with vis_bytes plus the image pixels x major cycles converted with pixel_bytes.
+    The memory is the peak from a previous run's task profile if there is one.
+    """
+    ymlfile = os.path.join(project_dir, 'hi_segmented_pipeline.yml')
+    if not os.path.isfile(ymlfile):
+        raise FileNotFoundError(' {} not found. '.format(ymlfile))
+    yml = read_yml(ymlfile)
+    configfile = os.path.join(project_dir, yml['configfile'])
+    if not os.path.isfile(configfile):
+        raise FileNotFoundError(' {} not found. '.format(configfile))
+    params = read_params(configfile)
+    name = params['global']['project_name']
+    job = {'name': name, 'kind': 'project', 'dir': project_dir, 'cores': int(batch['job_cores']),
+           'memory': float(batch['job_memory']), 'deps': [], 'status': 'queued'}
+    if params['global'].get('interactive', True):
+        job['status'] = 'failed'
+        job['error'] = 'interactive mode is set in {}'.format(configfile)
+    data_path = os.path.join(project_dir, str(params['importdata']['data_path']))
+    if params['importdata'].get('jvla', False):
+        data_size = path_size(os.path.join(data_path, name+'.ms'))
+    elif os.path.isdir(os.path.join(project_dir, name+'.ms')):
+        data_size = path_size(os.path.join(project_dir, name+'.ms'))
+    else:
+        data_size = sum([path_size(path) for path in glob.glob(os.path.join(data_path, '*'))])
+    job['data_size'] = float(data_size)
+    job['cost'] = float(data_size)
+    job['planned'] = False
+    job['disk'] = batch['disk_factor']*data_size/2.**30
+    plan = read_csv(os.path.join(project_dir, 'summary', name+'.plan.csv'))
+    if len(plan) > 0:
+        cycles = [max(int(call['major_cycles']), 1) for call in plan]
+        job['cost'] = sum([vis_bytes*float(call['visibilities'])*float(call['passes'])*n+pixel_bytes*float(call['pixels'])*n
+                           for call, n in zip(plan, cycles)])
+        job['planned'] = True
+        job['disk'] = sum([float(call['disk_bytes']) for call in plan])/2.**30
+    profile = read_csv(os.path.join(project_dir, 'summary', name+'.profile.csv'))
+    if len(profile) > 0:
+        job['memory'] = max([float(row['peak_rss']) for row in profile])/2.**30
+    targets = params['calibration'].get('target_names', [])
+    if int(batch['job_cores']) > 1 and len(targets) > 0:
+        job['cores'] = min(int(batch['job_cores']), len(set(targets)))
+    return job
+
+
+def scale_costs(projects, logger):
+    """
+    Puts the cost of the projects without a plan in the same unit as those with one, by scaling the size of their raw data with the
+    median ratio of cost to raw data size of the planned projects. If no project has a plan the raw data size is used for all of them.
+    """
+    ratios = sorted([job['cost']/job['data_size'] for job in projects if job['planned'] and job['data_size'] > 0])
+    if len(ratios) == 0:
+        return
+    ratio = ratios[len(ratios)//2]
+    unplanned = [job for job in projects if not job['planned']]
+    if len(unplanned) > 0:
+        logger.info('Estimating the cost of {0} project(s) without a plan as {1:.3g} times their raw data size.'.format(len(unplanned),ratio))
+    for job in unplanned:
+        job['cost'] = ratio*job['data_size']
+
+
+def combine_job(configfile, projects, batch):
+    """
+    Describes the combined imaging of one HCG, which depends on the pipeline runs of every project in its 'proj_ids'.
+    """
+    params = read_params(configfile)
+    combine_dir = os.path.dirname(configfile)
+    name = 'HCG{}'.format(params['combine']['hcg'])
+    job = {'name': name, 'kind': 'combine', 'dir': combine_dir, 'configfile': os.path.basename(configfile), 'cores': 1,
+           'memory': float(batch['job_memory']), 'disk': 0., 'cost': 0., 'deps': [], 'status': 'waiting'}
+    for proj in params['combine']['proj_ids']:
+        proj_dir = os.path.normpath(os.path.join(combine_dir, '..', proj))
+        if proj_dir in projects:
+            job['deps'].append(projects[proj_dir]['name'])
+        elif len(glob.glob(os.path.join(proj_dir, 'sources', '{}*.*split.contsub'.format(name)))) == 0:
+            job['status'] = 'failed'
+            job['error'] = 'project {0} is not in the batch and has no continuum subtracted data for {1}'.format(proj, name)
+    return job
+
+
+def link_scripts(work_dir, scripts, batch):
+    """
+    Creates symbolic links in the working directory to the pipeline scripts it runs.
+    """
+    for script in scripts:
+        path = os.path.join(work_dir, os.path.basename(script))
+        if not os.access(path, os.R_OK):
+            os.symlink(os.path.join(batch['scripts'], script), path)
+
+
+def start_job(job, batch, logger):
+    """
+    Starts a job as a subprocess, writing its output to batch_logs/<name>.out.
+    """
+    if not os.path.isdir('batch_logs'):
+        os.makedirs('batch_logs')
+    job['log'] = open(os.path.join('batch_logs', job['name']+'.out'), 'a')
+    env = dict(os.environ)
+    env['PATH'] += os.pathsep + str(batch['casa'])
+    env['FLAG_STATS_DB'] = batch['flag_db']
+    if job['kind'] == 'project':
+        link_scripts(job['dir'], ['hi_segmented_pipeline.py'], batch)
+        command = [sys.executable, 'hi_segmented_pipeline.py', 'make', batch['target'], '--local', '-p', str(job['cores'])]
+    else:
+        link_scripts(job['dir'], ['combined_imaging/combine_dirty_image.py', 'combined_imaging/combine_clean_image.py', 'common_functions.py'], batch)
+        command = ['/bin/sh', '-c', 'casa --nologger --nogui -c combine_dirty_image.py {0} && casa --nologger --nogui -c combine_clean_image.py {0}'.format(job['configfile'])]
+    logger.info('Starting {0} ({1} core(s), {2:.1f} GB memory, {3:.1f} GB disk) in {4}.'.format(job['name'],job['cores'],job['memory'],job['disk'],job['dir']))
+    job['proc'] = subprocess.Popen(command, cwd=job['dir'], env=env, stdout=job['log'], stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    job['start'] = time.time()
+    job['status'] = 'running'
+
+
+def fits(job, running, batch):
+    """
+    Checks whether a job can start without the running jobs exceeding the core, memory and disk caps.
+    Memory and disk are reserved for the whole of each running job, as its usage grows while it runs.
+    """
+    cores = sum([other['cores'] for other in running])
+    if cores+job['cores'] > batch['max_cores']:
+        return False
+    memory = sum([other['memory'] for other in running])
+    if memory+job['memory'] > batch['max_memory'] or job['memory'] > mem_available()/2.**30:
+        return False
+    device = os.stat(job['dir']).st_dev
+    disk = sum([other['disk'] for other in running if os.stat(other['dir']).st_dev == device])
+    free = shutil.disk_usage(job['dir']).free/2.**30
+    if free-disk-job['disk'] < batch['min_free_disk']:
+        return False
+    return True
+
+
+def write_status(jobs, status_file):
+    """
+    Writes the state of every job to the batch status file.
+    """
+    status = collections.OrderedDict()
+    for job in jobs:
+        status[job['name']] = {key: job[key] for key in ['kind','dir','status','cores','memory','disk','cost','deps','start','end','error'] if key in job}
+    with open(status_file, 'w') as f:
+        json.dump(status, f, indent=1)
+
+
+def run_batch(config, logger, status_file='batch_status.json'):
+    """
+    Runs the pipeline for every project in the batch concurrently (within the resource caps) and the combined imaging
+    of each HCG once all of its projects have completed. Queued jobs are started from the most to the least expensive,
+    with smaller jobs filling any cores left free, so that the whole survey finishes as early as possible.
+    """
+    batch = config['batch']
+    projects = collections.OrderedDict()
+    for project_dir in config['projects']:
+        projects[project_dir] = project_job(project_dir, batch)
+    scale_costs(list(projects.values()), logger)
+    jobs = list(projects.values())+[combine_job(configfile, projects, batch) for configfile in config['combine']]
+    for job in jobs:
+        if job['status'] == 'failed':
+            logger.error('{0} will not be run: {1}.'.format(job['name'],job['error']))
+    by_name = {job['name']: job for job in jobs}
+    try:
+        while True:
+            for job in jobs:
+                if job['status'] == 'running' and job['proc'].poll() is not None:
+                    job['end'] = time.time()
+                    job['log'].close()
+                    if job['proc'].returncode == 0:
+                        job['status'] = 'done'
+                        logger.info('{0} completed in {1:.1f} h.'.format(job['name'],(job['end']-job['start'])/3600.))
+                    else:
+                        job['status'] = 'failed'
+                        job['error'] = 'exit status {}'.format(job['proc'].returncode)
+                        logger.error('{0} failed ({1}). See batch_logs/{0}.out.'.format(job['name'],job['error']))
+            for job in jobs:
+                if job['status'] != 'waiting':
+                    continue
+                deps = [by_name[dep]['status'] for dep in job['deps']]
+                if 'failed' in deps:
+                    job['status'] = 'failed'
+                    job['error'] = 'a project it depends on failed'
+                    logger.error('{0} will not be run: {1}.'.format(job['name'],job['error']))
+                elif all([dep == 'done' for dep in deps]):
+                    job['status'] = 'queued'
+            running = [job for job in jobs if job['status'] == 'running']
+            queued = sorted([job for job in jobs if job['status'] == 'queued'], key=lambda job: job['cost'], reverse=True)
+            for job in queued:
+                if fits(job, running, batch) or len(running) == 0:
+                    if len(running) == 0 and not fits(job, running, batch):
+                        logger.warning('{} exceeds the resource caps on its own. Running it alone.'.format(job['name']))
+                    start_job(job, batch, logger)
+                    running.append(job)
+            write_status(jobs, status_file)
+            if len(running) == 0 and not any([job['status'] in ['queued','waiting'] for job in jobs]):
+                break
+            time.sleep(batch['poll'])
+    except KeyboardInterrupt:
+        logger.warning('Interrupted. Stopping the running jobs.')
+        for job in jobs:
+            if job['status'] == 'running':
+                job['proc'].terminate()
+                job['status'] = 'failed'
+                job['error'] = 'interrupted'
+        write_status(jobs, status_file)
+        raise
+    failed = [job['name'] for job in jobs if job['status'] == 'failed']
+    if len(failed) > 0:
+        logger.error('Failed jobs: {}'.format(', '.join(failed)))
+        return 1
+    logger.info('All jobs completed.')
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Run the pipeline for a batch of projects and the combined imaging of each HCG.')
+    parser.add_argument('configfile', help='Batch parameters file (see batch_params.cfg).')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s',
+                        handlers=[logging.FileHandler('batch.log'), logging.StreamHandler(sys.stdout)])
+    logger = logging.getLogger('batch_pipeline')
+    config = read_batch_config(args.configfile)
+    return run_batch(config, logger)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import os, sys, numpy
+
+# Observation set up (L-band, VLA site)
+rest_freq = 1420.405751786 # MHz
+chan_width = 24.4140625 # kHz
+ref_time = '2020/05/01/04:00:00'
+fluxcal = ('3C286', 'J2000 13h31m08.288s +30d30m32.96s', 14.9)
+phasecal = ('J1310+3220', 'J2000 13h10m28.664s +32d20m43.78s', 2.0)
+
+
+def script_args():
+    """
+    Returns the command line arguments passed to this script (after the script name).
+    """
+    for i in range(len(sys.argv)):
+        if os.path.basename(sys.argv[i]) == 'make_synthetic_ms.py':
+            return sys.argv[i+1:]
+    return sys.argv[1:]
+
+def antenna_positions(nant):
+    """
+    Returns ITRF positions for 'nant' antennas on the three arms of a VLA-like Y (roughly D configuration).
+
+    Input:
+    nant = Number of antennas. (Integer)
+
+    Output:
+    x, y, z = ITRF coordinates of the antennas in m. (Lists of Floats)
+    names = Antenna names. (List of Strings)
+    pads = Pad names. (List of Strings)
+    """
+    site = me.measure(me.observatory('VLA'),'ITRF')
+    lon = site['m0']['value']
+    lat = site['m1']['value']
+    radius = site['m2']['value']
+    x0 = radius*numpy.cos(lat)*numpy.cos(lon)
+    y0 = radius*numpy.cos(lat)*numpy.sin(lon)
+    z0 = radius*numpy.sin(lat)
+    arms = [('N',355.),('E',115.),('W',235.)]
+    x, y, z, names, pads = [], [], [], [], []
+    for i in range(nant):
+        arm, azimuth = arms[i%3]
+        k = i//3+1
+        dist = 40.*k**1.716
+        east = dist*numpy.sin(numpy.radians(azimuth))
+        north = dist*numpy.cos(numpy.radians(azimuth))
+        x.append(x0-numpy.sin(lon)*east-numpy.sin(lat)*numpy.cos(lon)*north)
+        y.append(y0+numpy.cos(lon)*east-numpy.sin(lat)*numpy.sin(lon)*north)
+        z.append(z0+numpy.cos(lat)*north)
+        names.append('ea{:02d}'.format(i+1))
+        pads.append('{0}{1}'.format(arm,k))
+    return x, y, z, names, pads
+
+def target_fields(ntargets, mosaic):
+    """
+    Returns the names and directions of the science fields. A mosaic is a row of overlapping pointings of one target.
+    """
+    fields = []
+    for i in range(ntargets):
+        if mosaic:
+            fields.append(('MOS{}'.format(i), 'J2000 13h00m00.0s +30d{0:02d}m00.0s'.format(15*i)))
+        else:
+            fields.append(('T{}'.format(i), 'J2000 13h{0:02d}m00.0s +{1:d}d00m00.0s'.format(10*i,30-i)))
+    return fields
+
+def simulate(msname, nant, int_time, nspw, nchan, ntargets, mosaic, scan_min):
+    """
+    Simulates an L-band VLA-like MS with a flux/bandpass calibrator, a phase calibrator and the science target(s).
+    The SPWs overlap by half their bandwidth so that the pipeline combines them when splitting the targets.
+
+    Input:
+    msname = Name of the MS to create. (String)
+    nant = Number of antennas. (Integer)
+    int_time = Integration time in s. (Float)
+    nspw = Number of SPWs. (Integer)
+    nchan = Number of channels per SPW. (Integer)
+    ntargets = Number of target fields (or mosaic pointings). (Integer)
+    mosaic = Whether the target fields are pointings of a single mosaic. (Boolean)
+    scan_min = Length of each target scan in minutes. (Float)
+    """
+    x, y, z, names, pads = antenna_positions(nant)
+    bandwidth = nchan*chan_width/1000.
+    sm.open(msname)
+    sm.setconfig(telescopename='VLA', x=x, y=y, z=z, dishdiameter=[25.]*nant, mount=['alt-az'], antname=names, padname=pads,
+                 coordsystem='global', referencelocation=me.observatory('VLA'))
+    spw_names = []
+    for i in range(nspw):
+        spw_names.append('L{}'.format(i))
+        freq = rest_freq-bandwidth/2.+i*bandwidth/2.
+        sm.setspwindow(spwname=spw_names[-1], freq='{}MHz'.format(freq), deltafreq='{}kHz'.format(chan_width),
+                       freqresolution='{}kHz'.format(chan_width), nchannels=nchan, stokes='RR LL')
+    sm.setfeed(mode='perfect R L', pol=[''])
+    targets = target_fields(ntargets, mosaic)
+    for name, direction in [fluxcal[:2], phasecal[:2]]+targets:
+        sm.setfield(sourcename=name, sourcedirection=direction)
+    sm.setlimits(shadowlimit=0.001, elevationlimit='8.0deg')
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime='{}s'.format(int_time), usehourangle=False, referencetime=me.epoch('UTC',ref_time))
+    schedule = [(fluxcal[0], 5.)]
+    for name, direction in targets:
+        schedule.extend([(phasecal[0], 2.), (name, scan_min)])
+    schedule.append((phasecal[0], 2.))
+    start = 0.
+    for name, length in schedule:
+        for spw_name in spw_names:
+            sm.observe(sourcename=name, spwname=spw_name, starttime='{}s'.format(start), stoptime='{}s'.format(start+60.*length))
+        start += 60.*length+int_time
+    sm.close()
+
+    # Calibrator point sources (the targets are left as noise)
+    cl_file = msname+'.cl'
+    os.system('rm -rf '+cl_file)
+    for name, direction, flux in [fluxcal, phasecal]:
+        cl.addcomponent(dir=direction, flux=flux, fluxunit='Jy', freq='{}MHz'.format(rest_freq), shape='point',
+                        spectrumtype='spectral index', index=-0.5)
+    cl.rename(cl_file)
+    cl.close()
+    sm.openfromms(msname)
+    sm.predict(complist=cl_file)
+    sm.setgain(mode='fbm', amplitude=0.05)
+    sm.setnoise(mode='simplenoise', simplenoise='0.05Jy')
+    sm.corrupt()
+    sm.done()
+    os.system('rm -rf '+cl_file)
+
+
+args = script_args()
+if len(args) < 8:
+    print('Usage: casa --nologger --nogui -c make_synthetic_ms.py <msname> <nant> <int_time> <nspw> <nchan> <ntargets> <mosaic> <scan_min>')
+    sys.exit(-1)
+msname = args[0]
+os.system('rm -rf {0} {0}.flagversions'.format(msname))
+simulate(msname, int(args[1]), float(args[2]), int(args[3]), int(args[4]), int(args[5]), args[6] in ['True','true','1'], float(args[7]))
+print('Created {}'.format(msname))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import csv
+import json
+import time
+import shutil
+import socket
+import argparse
+import subprocess
+import collections
+import configparser
+
+
+# Synthetic data sets of increasing size (see make_synthetic_ms.py)
+SCALES = collections.OrderedDict([
+    ('small',  {'nant': 9,  'int_time': 10., 'nspw': 1, 'nchan': 64,   'ntargets': 1, 'mosaic': False, 'scan_min': 10., 'im_size': 128}),
+    ('medium', {'nant': 27, 'int_time': 10., 'nspw': 2, 'nchan': 256,  'ntargets': 2, 'mosaic': False, 'scan_min': 20., 'im_size': 256}),
+    ('large',  {'nant': 27, 'int_time': 5.,  'nspw': 2, 'nchan': 1024, 'ntargets': 4, 'mosaic': False, 'scan_min': 30., 'im_size': 512}),
+    ('mosaic', {'nant': 27, 'int_time': 10., 'nspw': 1, 'nchan': 256,  'ntargets': 4, 'mosaic': True,  'scan_min': 10., 'im_size': 512}),
+    ])
+
+# Stages run for each data set (the MS is simulated directly, so 'import_data' is not run)
+STAGES = ['flag_calib_split', 'dirty_cont_image', 'contsub_dirty_image', 'clean_image', 'moment_zero']
+SCRIPTS = ['common_functions', 'rfi_flagger', 'casa_worker', 'plot_spool'] + STAGES
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def repo_version():
+    """
+    Returns a description of the version of the pipeline being benchmarked.
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def write_config(config_file, name, scale):
+    """
+    Writes a non-interactive parameters file for a synthetic data set.
+    """
+    nchan = int(scale['nchan']*(1.+0.5*(scale['nspw']-1)))
+    if scale['mosaic']:
+        targets = ['MOS{}'.format(i) for i in range(scale['ntargets'])]
+        target_names = ['MOS']*scale['ntargets']
+        nimages = 1
+    else:
+        targets = ['T{}'.format(i) for i in range(scale['ntargets'])]
+        target_names = targets[:]
+        nimages = scale['ntargets']
+    linefree = '0:{0}~{1};{2}~{3}'.format(int(0.05*nchan), int(0.3*nchan), int(0.7*nchan), int(0.95*nchan)-1)
+    line = '0:{0}~{1}'.format(int(0.3*nchan), int(0.7*nchan))
+    config_raw = configparser.RawConfigParser()
+    sections = collections.OrderedDict([
+        ('global', {'project_name': name, 'rest_freq': '1420405751.786Hz', 'interactive': False, 'src_dir': 'sources',
+                    'img_dir': 'images', 'mom_dir': 'moments', 'cleanup_level': 0}),
+        ('importdata', {'data_path': './', 'jvla': False, 'mstransform': False, 'keep_obs': '', 'keep_spws': '', 'keep_fields': '',
+                        'hanning': False, 'chanavg': 0}),
+        ('flagging', {'shadow_tol': 5.0, 'quack_int': 5.0, 'timecutoff': 4.0, 'freqcutoff': 4.0, 'rthresh': 4.0,
+                      'no_rflag': False, 'no_tfcrop': False}),
+        ('calibration', {'refant': 'ea01', 'fluxcal': ['3C286']*scale['nspw'], 'fluxmod': ['3C286_L.im']*scale['nspw'],
+                         'man_mod': False, 'bandcal': ['3C286']*scale['nspw'], 'phasecal': ['J1310+3220']*len(targets),
+                         'targets': targets, 'target_names': target_names, 'mosaic': scale['mosaic']}),
+        ('continuum_subtraction', {'linefree_ch': [linefree]*nimages, 'fitorder': [1]*nimages, 'save_cont': False}),
+        ('clean', {'line_ch': [line]*nimages, 'robust': 2, 'pix_size': ['8arcsec']*nimages, 'im_size': [str(scale['im_size'])]*nimages,
+                   'automask': True, 'multiscale': False, 'beam_scales': [0, 1, 3, 9], 'phasecenter': '', 'sefd': 420.0,
+                   'corr_eff': 0.9, 'thresh': 2.5, 'automask_sl': 2.0, 'automask_ns': 3.0, 'automask_mbf': 0.3,
+                   'automask_lns': 1.5, 'automask_neg': 15.0}),
+        ('moment', {'mom_thresh': 3.0, 'mom_chans': [line]*nimages}),
+        ])
+    for section, options in sections.items():
+        config_raw.add_section(section)
+        for option, value in options.items():
+            config_raw.set(section, option, repr(value) if not isinstance(value, str) or value == '' else value)
+    with open(config_file, 'w') as f:
+        config_raw.write(f)
+
+
+def casa_command(casa, script, *args, xvfb=False):
+    """
+    Returns the command that runs a CASA script without a logger window (under a virtual X server if requested).
+    """
+    command = [os.path.join(casa, 'casa') if casa else 'casa', '--nologger', '--nogui', '-c', script] + [str(arg) for arg in args]
+    if xvfb:
+        command = ['xvfb-run', '-a'] + command
+    return command
+
+
+def read_csv(path):
+    """
+    Returns the rows of a CSV file (an empty list if it does not exist).
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r') as f:
+        return list(csv.DictReader(f))
+
+
+def summarise(rows, key):
+    """
+    Totals the wall time, CPU time and peak memory of profile rows grouped by 'key'.
+    """
+    totals = collections.OrderedDict()
+    for row in rows:
+        total = totals.setdefault(row[key], {'calls': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_rss': 0})
+        total['calls'] += 1
+        total['wall_time'] += float(row['wall_time'])
+        total['cpu_time'] += float(row['cpu_time'])
+        total['peak_rss'] = max(total['peak_rss'], int(float(row['peak_rss'])))
+    return totals
+
+
+def path_size(path):
+    """
+    Returns the total size in bytes of a directory tree.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def run_scale(name, scale, args):
+    """
+    Simulates one data set, runs the pipeline stages on it and returns the timings.
+    """
+    work_dir = os.path.join(os.path.abspath(args.workdir), name)
+    project = 'BENCH_{}'.format(name)
+    config_file = project+'_params.cfg'
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    for script in SCRIPTS:
+        os.symlink(os.path.join(REPO_DIR, script+'.py'), os.path.join(work_dir, script+'.py'))
+    os.symlink(os.path.join(BENCH_DIR, 'make_synthetic_ms.py'), os.path.join(work_dir, 'make_synthetic_ms.py'))
+    open(os.path.join(work_dir, 'manual_flags.list'), 'w').close()
+    write_config(os.path.join(work_dir, config_file), project, scale)
+    result = {'params': scale, 'stages': collections.OrderedDict(), 'status': 'ok'}
+    log = open(os.path.join(work_dir, 'benchmark.out'), 'w')
+
+    print('[{0}] Simulating {1}.ms: {2}'.format(name, project, scale))
+    start = time.time()
+    status = subprocess.call(casa_command(args.casa, 'make_synthetic_ms.py', project+'.ms', scale['nant'], scale['int_time'], scale['nspw'],
+                                          scale['nchan'], scale['ntargets'], scale['mosaic'], scale['scan_min'], xvfb=args.xvfb),
+                             cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+    result['simulate_time'] = time.time()-start
+    if status != 0 or not os.path.isdir(os.path.join(work_dir, project+'.ms')):
+        result['status'] = 'simulation failed'
+        log.close()
+        return result
+    result['ms_size'] = path_size(os.path.join(work_dir, project+'.ms'))
+
+    for stage in STAGES:
+        print('[{0}] Running {1}.'.format(name, stage))
+        start = time.time()
+        status = subprocess.call(casa_command(args.casa, stage+'.py', config_file, xvfb=args.xvfb), cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        result['stages'][stage] = time.time()-start
+        if status != 0:
+            result['status'] = '{} failed'.format(stage)
+            break
+    log.close()
+    summary_dir = os.path.join(work_dir, 'summary')
+    result['steps'] = summarise(read_csv(os.path.join(summary_dir, project+'.steps.csv')), 'step')
+    result['tasks'] = summarise(read_csv(os.path.join(summary_dir, project+'.profile.csv')), 'task')
+    if not args.keep:
+        shutil.rmtree(work_dir)
+    return result
+
+
+def run(args):
+    """
+    Runs the benchmark at each requested scale and writes the results to a JSON file.
+    """
+    scales = args.scales.split(',')
+    for name in scales:
+        if name not in SCALES:
+            raise ValueError(' Unknown scale: {0}. Options are: {1}'.format(name, ', '.join(SCALES.keys())))
+    if args.xvfb is None:
+        args.xvfb = 'DISPLAY' not in os.environ and shutil.which('xvfb-run') is not None
+    results = collections.OrderedDict([('label', args.label), ('version', repo_version()), ('date', time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())),
+                                       ('host', socket.gethostname()), ('cores', os.cpu_count()), ('scales', collections.OrderedDict())])
+    for name in scales:
+        results['scales'][name] = run_scale(name, SCALES[name], args)
+        print('[{0}] {1}: {2}'.format(name, results['scales'][name]['status'],
+                                      ', '.join(['{0} {1:.1f} s'.format(stage, wall) for stage, wall in results['scales'][name]['stages'].items()])))
+    out_file = args.output or os.path.join(BENCH_DIR, 'results', '{}.json'.format(args.label or results['version']))
+    if not os.path.isdir(os.path.dirname(out_file)):
+        os.makedirs(os.path.dirname(out_file))
+    with open(out_file, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results written to {}'.format(out_file))
+    return 0
+
+
+def compare(args):
+    """
+    Compares the step timings of two benchmark results and reports any that slowed down by more than the threshold.
+    """
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    print('Comparing {0} ({1}) with {2} ({3})'.format(args.new, new['version'], args.baseline, baseline['version']))
+    regressions = 0
+    for name in new['scales']:
+        if name not in baseline['scales']:
+            continue
+        print('\n{}:'.format(name))
+        for key in ['stages', 'steps']:
+            old_times = baseline['scales'][name].get(key, {})
+            new_times = new['scales'][name].get(key, {})
+            for item in new_times:
+                if item not in old_times:
+                    continue
+                old_wall = old_times[item] if key == 'stages' else old_times[item]['wall_time']
+                new_wall = new_times[item] if key == 'stages' else new_times[item]['wall_time']
+                ratio = new_wall/max(old_wall, 1e-3)
+                flag = ''
+                if ratio > 1.+args.threshold and new_wall-old_wall > args.min_time:
+                    flag = '  REGRESSION'
+                    regressions += 1
+                print('  {0:<22} {1:10.1f} s {2:10.1f} s {3:6.2f}x{4}'.format(item, old_wall, new_wall, ratio, flag))
+    if regressions > 0:
+        print('\n{} regression(s) found.'.format(regressions))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic VLA data sets.')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='Simulate the data sets and time the pipeline stages.')
+    run_parser.add_argument('--scales', default='small,medium', help='Comma separated list of scales ({}).'.format(', '.join(SCALES.keys())))
+    run_parser.add_argument('--casa', default='', help='Directory containing the casa executable (default: from PATH).')
+    run_parser.add_argument('--workdir', default='bench_work', help='Directory in which the data sets are simulated and processed.')
+    run_parser.add_argument('--label', default='', help='Name of the results file (default: the git version).')
+    run_parser.add_argument('--output', default='', help='Path of the results file.')
+    run_parser.add_argument('--keep', action='store_true', help='Keep the simulated data and pipeline products.')
+    run_parser.add_argument('--xvfb', action='store_true', default=None, help='Run CASA under xvfb-run (default: if there is no display).')
+    compare_parser = subparsers.add_parser('compare', help='Compare two benchmark results.')
+    compare_parser.add_argument('baseline', help='Results of the reference version.')
+    compare_parser.add_argument('new', help='Results of the version being tested.')
+    compare_parser.add_argument('--threshold', type=float, default=0.2, help='Fractional slow down reported as a regression.')
+    compare_parser.add_argument('--min_time', type=float, default=5., help='Ignore slow downs of less than this many seconds.')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'compare':
+        return compare(args)
+    parser.print_help()
+    return -1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
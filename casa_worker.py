@@ -0,0 +1,235 @@
+import os, sys, json, socket, time, traceback
+
+
+def worker_args():
+    """
+    Returns the command line arguments passed to this script (after the script name).
+
+    Output:
+    args = Arguments following 'casa_worker.py' on the command line. (List of Strings)
+    """
+    for i in range(len(sys.argv)):
+        if os.path.basename(sys.argv[i]) == 'casa_worker.py':
+            return sys.argv[i+1:]
+    return sys.argv[1:]
+
+def jsonable(obj):
+    """
+    Converts objects returned by CASA tasks (e.g. numpy arrays) to something JSON can encode.
+    """
+    if hasattr(obj,'tolist'):
+        return obj.tolist()
+    return repr(obj)
+
+def plain(obj):
+    """
+    Converts the unicode strings decoded from JSON (recursively) to plain strings, as CASA task parameters must be of type str.
+    """
+    if isinstance(obj,unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj,list):
+        return [plain(item) for item in obj]
+    if isinstance(obj,dict):
+        return dict((plain(key), plain(value)) for key, value in obj.items())
+    return obj
+
+def new_casalog(name, cwd):
+    """
+    Points the CASA log at a fresh file so that each request is checked for errors in isolation.
+
+    Input:
+    name = Label for the request (stage or task name). (String)
+    cwd = Directory where the log file will be written. (String)
+    """
+    logfile = os.path.join(cwd,'casa-{0}-{1}.log'.format(time.strftime('%Y%m%d-%H%M%S',time.gmtime()),name))
+    casalog.setlogfile(logfile)
+    return logfile
+
+def run_script(request, namespace):
+    """
+    Executes a pipeline stage script inside this (warm) CASA session.
+    The script sees the same globals and sys.argv as if it had been launched with 'casa -c'.
+
+    Input:
+    request = Must contain 'script', may contain 'args' and 'cwd'. (Dictionary)
+    namespace = Pristine CASA namespace to copy for the script. (Dictionary)
+
+    Output:
+    status = Exit status of the script (0 for success). (Integer)
+    error = Traceback or exit message if the script failed. (String)
+    """
+    script = request['script']
+    cwd = request.get('cwd',os.getcwd())
+    old_argv = sys.argv[:]
+    old_cwd = os.getcwd()
+    ns = dict(namespace)
+    ns['__name__'] = '__main__'
+    ns['__file__'] = script
+    status = 0
+    error = ''
+    try:
+        os.chdir(cwd)
+        new_casalog(os.path.splitext(os.path.basename(script))[0],cwd)
+        sys.argv = ['casa','--nologger','-c',script] + [str(arg) for arg in request.get('args',[])]
+        execfile(script, ns)
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code,int):
+            status = e.code
+        else:
+            status = 1
+            error = str(e.code)
+    except Exception:
+        status = 1
+        error = traceback.format_exc()
+    finally:
+        #The interpreter does not exit at the end of the stage, so its atexit hooks do not stop the plot workers it started
+        if 'common_functions' in sys.modules:
+            try:
+                sys.modules['common_functions'].stop_plot_workers()
+            except Exception:
+                error += traceback.format_exc()
+        sys.argv = old_argv
+        os.chdir(old_cwd)
+    return status, error
+
+def find_task(task, namespace):
+    """
+    Returns a CASA task from the namespace, or for a name of the form 'module.function' a function of a pipeline module in the working directory
+    (e.g. 'rfi_flagger.flag_job').
+    """
+    if '.' in task and task not in namespace:
+        import imp
+        module, function = task.rsplit('.',1)
+        if module not in sys.modules:
+            imp.load_source(module,module+'.py')
+        return getattr(sys.modules[module],function)
+    return namespace[task]
+
+def run_task(request, namespace):
+    """
+    Executes a single CASA task call inside this (warm) CASA session.
+
+    Input:
+    request = Must contain 'task', may contain 'kwargs' and 'cwd'. (Dictionary)
+    namespace = CASA namespace in which the tasks are defined. (Dictionary)
+
+    Output:
+    status = 0 for success, 1 otherwise. (Integer)
+    error = Traceback if the call failed. (String)
+    result = Return value of the task.
+    """
+    cwd = request.get('cwd',os.getcwd())
+    old_cwd = os.getcwd()
+    result = None
+    status = 0
+    error = ''
+    try:
+        os.chdir(cwd)
+        result = find_task(request['task'],namespace)(**plain(request.get('kwargs',{})))
+    except Exception:
+        status = 1
+        error = traceback.format_exc()
+    finally:
+        os.chdir(old_cwd)
+    return status, error, result
+
+def serve(sock_path, idle_timeout, namespace):
+    """
+    Listens on a Unix socket and runs each request (one JSON line per connection) in this CASA session.
+    The worker exits after 'idle_timeout' seconds without a request or when asked to shut down.
+
+    Input:
+    sock_path = Path of the Unix socket to listen on. (String)
+    idle_timeout = Seconds to wait for a new request before exiting. (Float)
+    namespace = Pristine CASA namespace. (Dictionary)
+    """
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(sock_path)
+    server.listen(1)
+    server.settimeout(idle_timeout)
+    print('CASA worker {0} listening on {1}'.format(os.getpid(),sock_path))
+    try:
+        while True:
+            try:
+                conn, addr = server.accept()
+            except socket.timeout:
+                print('CASA worker idle for {} s. Exiting.'.format(idle_timeout))
+                break
+            conn.settimeout(None)
+            data = ''
+            while not data.endswith('\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                request = json.loads(data)
+            except ValueError:
+                conn.sendall(json.dumps({'status': 1, 'error': 'Malformed request.'})+'\n')
+                conn.close()
+                continue
+            if request.get('shutdown'):
+                conn.sendall(json.dumps({'status': 0, 'error': ''})+'\n')
+                conn.close()
+                break
+            start = time.time()
+            if 'script' in request:
+                print('Running script: {0} {1}'.format(request['script'],request.get('args',[])))
+                status, error = run_script(request, namespace)
+                response = {'status': status, 'error': error}
+            else:
+                print('Running task: {0}'.format(request.get('task')))
+                status, error, result = run_task(request, namespace)
+                response = {'status': status, 'error': error, 'result': result}
+            response['wall_time'] = time.time()-start
+            try:
+                conn.sendall(json.dumps(response, default=jsonable)+'\n')
+            except socket.error:
+                print('Client disconnected before the response was sent.')
+            conn.close()
+    finally:
+        server.close()
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+
+def run_task_file(request_file, response_file, namespace):
+    """
+    Runs a single CASA task call read from a JSON file and writes the response to another, then exits with the status of the call.
+    Used to run independent task calls in parallel CASA processes (see run_tasks in common_functions.py).
+
+    Input:
+    request_file = Path of the request. Must contain 'task', may contain 'kwargs', 'cwd' and 'log'. (String)
+    response_file = Path where the response is written. (String)
+    namespace = CASA namespace in which the tasks are defined. (Dictionary)
+    """
+    request = json.load(open(request_file,'r'))
+    if 'log' in request:
+        casalog.setlogfile(request['log'])
+    start = time.time()
+    status, error, result = run_task(request, namespace)
+    response = {'status': status, 'error': error, 'result': result, 'wall_time': time.time()-start}
+    f = open(response_file,'w')
+    f.write(json.dumps(response, default=jsonable))
+    f.close()
+    sys.exit(status)
+
+
+# Keep a copy of the CASA namespace as it was before any request ran
+casa_namespace = dict((key, value) for key, value in globals().items() if not key.startswith('__'))
+
+args = worker_args()
+if len(args) > 0 and args[0] == 'serve':
+    idle_timeout = 900.
+    if len(args) > 2:
+        idle_timeout = float(args[2])
+    serve(args[1], idle_timeout, casa_namespace)
+elif len(args) > 2 and args[0] == 'task':
+    run_task_file(args[1], args[2], casa_namespace)
+else:
+    print('Usage: casa --nologger --nogui -c casa_worker.py serve <socket> [idle_timeout]')
+    print('       casa --nologger --nogui -c casa_worker.py task <request.json> <response.json>')
+    sys.exit(-1)
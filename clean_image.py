@@ -21,13 +21,16 @@ def noise_est(config,logger):
     src_dir = config['global']['src_dir']+'/'
     noise = []
     for target in targets:
-        msmd.open(src_dir+target+'.split.contsub')
-        N = msmd.nantennas()
-        t_int = msmd.effexposuretime()['value']
-        t_unit = msmd.effexposuretime()['unit']
+        if target_sel is not None and target != target_sel:
+            noise.append(None)
+            continue
+        meta = cf.ms_metadata(src_dir+target+'.split.contsub',logger)
+        N = meta['nantennas']
+        t_int = meta['effexposure']['value']
+        t_unit = meta['effexposure']['unit']
         if t_unit != 's' and 'sec' not in t_unit:
             logger.warning('Integration time units are not in seconds. Estimated noise may be incorrect.')
-        ch_wid = numpy.mean(msmd.chanwidths(0))
+        ch_wid = numpy.mean(meta['spws'][0]['chan_widths'])
         #Note: The above line may cause issues if different spectral windows
         #have very difference frequency resolutions
         corr_eff = cln_param['corr_eff']
@@ -48,12 +51,12 @@ def noise_est(config,logger):
                         else:
                             f_smo = 8./3.
         noise.append(SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid)))
-        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),msmd.effexposuretime()['unit']))
+        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),t_unit))
         logger.info('Expected rms noise for {0}: {1} Jy/beam'.format(target,SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid))))
-        msmd.close()
     logger.info('Completed making noise estimation.')
     return noise
 
+@cf.profile_step
 def image(config,config_raw,config_file,logger):
     """
     Generates a clean (continuum subtracted) image of each science target.
@@ -165,6 +168,8 @@ def image(config,config_raw,config_file,logger):
     for i in range(len(targets)):
         target = targets[i]
         field = fields[i]
+        if target_sel is not None and target != target_sel:
+            continue
         if numpy.all(cln_param['multiscale']):
             ms_clean = True
             algorithm = 'multiscale'
@@ -242,14 +247,13 @@ def image(config,config_raw,config_file,logger):
             pix_per_beam = rest_beam['major']['value']/pix_size
             scales = cln_param['beam_scales']
             scales = list(numpy.array(numpy.array(scales)*pix_per_beam,dtype='int'))
-            B_min = au.getBaselineLengths('{0}{1}.split.contsub'.format(src_dir,target), sort=True)[0][1]
-            msmd.open('{0}{1}.split.contsub'.format(src_dir,target))
-            spws = msmd.spwsforfield(field)
+            meta = cf.ms_metadata('{0}{1}.split.contsub'.format(src_dir,target),logger)
+            B_min = meta['baseline_lengths'][0]
+            spws = meta['field_spws'][field]
             f_min = None
             for spw in spws:
-                if f_min == None or f_min > min(msmd.chanfreqs(spw=spw,unit='Hz')):
-                    f_min = min(msmd.chanfreqs(spw=spw,unit='Hz'))
-            msmd.close()
+                if f_min == None or f_min > min(meta['spws'][spw]['chan_freqs']):
+                    f_min = min(meta['spws'][spw]['chan_freqs'])
             max_scale = 180.*3600.*299792458./(1.2*numpy.pi*f_min*B_min)
             logger.info('The maximum recoverable scale for {0} is {1} arcsec.'.format(target,int(max_scale)))
             if 'arcsec' not in cln_param['pix_size'][i]:
@@ -274,10 +278,16 @@ def image(config,config_raw,config_file,logger):
                 fields = numpy.array(calib['targets'],dtype='str')[inx]
             field = ','.join(fields)
             gridder = 'mosaic'
-        command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', spw='{3}', imagename='{4}{1}', cell='{5}', imsize=[{6},{6}], specmode='cube', outframe='bary', veltype='radio', restfreq='{7}', gridder='{8}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='{9}', scales={10}, restoringbeam='common', pbcor=True, weighting='briggs', robust={11}, niter=100000, gain=0.1, threshold='{12}Jy', usemask='{13}', phasecenter='{14}', sidelobethreshold={15}, noisethreshold={16}, lownoisethreshold={17}, minbeamfrac={18}, negativethreshold={19}, cyclefactor=2.0,interactive=False)".format(src_dir,target,field,cln_param['line_ch'][i],img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,algorithm,scales,cln_param['robust'],noises[i]*cln_param['thresh'],mask,cln_param['phasecenter'],cln_param['automask_sl'],cln_param['automask_ns'],cln_param['automask_lns'],cln_param['automask_mbf'],cln_param['automask_neg'])
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        im_size = int(cln_param['im_size'][i])
+        if scales is not None:
+            scales = [int(scale) for scale in scales]
+        cf.run_task('tclean',config,config_raw,logger,vis=src_dir+target+'.split.contsub',field=field,spw=cln_param['line_ch'][i],imagename=img_dir+target,
+                    cell=cln_param['pix_size'][i],imsize=[im_size,im_size],specmode='cube',outframe='bary',veltype='radio',restfreq=rest_freq,
+                    gridder=gridder,wprojplanes=-1,pblimit=0.1,normtype='flatnoise',deconvolver=algorithm,scales=scales,restoringbeam='common',
+                    pbcor=True,weighting='briggs',robust=cln_param['robust'],niter=100000,gain=0.1,threshold='{}Jy'.format(noises[i]*cln_param['thresh']),
+                    usemask=mask,phasecenter=cln_param['phasecenter'],sidelobethreshold=cln_param['automask_sl'],noisethreshold=cln_param['automask_ns'],
+                    lownoisethreshold=cln_param['automask_lns'],minbeamfrac=cln_param['automask_mbf'],negativethreshold=cln_param['automask_neg'],
+                    cyclefactor=2.0,interactive=False)
         logger.info('CLEANing finished. Image cube saved as {}.'.format(target+'.image'))
         ia.open(img_dir+target+'.dirty.image')
         coords = ia.coordsys()
@@ -285,15 +295,11 @@ def image(config,config_raw,config_file,logger):
         if 'J2000' not in coords.referencecode()[0]:
             coord_chn = True
             logger.info('Coordinate system not J2000. Image will be regridded.')
-            command = "imregrid(imagename='{0}{1}'+'.image', template='J2000', output='{0}{1}'+'.image.J2000', asvelocity=True, interpolation='linear', decimate=10, overwrite=True)".format(img_dir,target)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
+            cf.run_task('imregrid',config,config_raw,logger,imagename=img_dir+target+'.image',template='J2000',output=img_dir+target+'.image.J2000',
+                        asvelocity=True,interpolation='linear',decimate=10,overwrite=True)
             logger.info('{} regridded in J2000 coordinates.'.format(target+'.image.J2000'))
-            command = "imregrid(imagename='{0}{1}'+'.image.pbcor', template='J2000', output='{0}{1}'+'.image.pbcor.J2000', asvelocity=True, interpolation='linear', decimate=10, overwrite=True)".format(img_dir,target)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
+            cf.run_task('imregrid',config,config_raw,logger,imagename=img_dir+target+'.image.pbcor',template='J2000',output=img_dir+target+'.image.pbcor.J2000',
+                        asvelocity=True,interpolation='linear',decimate=10,overwrite=True)
             logger.info('{} regridded in J2000 coordinates.'.format(target+'.image.pbcor.J2000'))
         coords.done()
         ia.close()
@@ -303,28 +309,28 @@ def image(config,config_raw,config_file,logger):
             imagename = target+'.image.J2000'
         else:
             imagename = target+'.image'
-        command = "exportfits(imagename='{0}{1}', fitsimage='{0}{2}', velocity=True,optical=False,overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(img_dir,imagename,fitsname)
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        cf.run_task('exportfits',config,config_raw,logger,imagename=img_dir+imagename,fitsimage=img_dir+fitsname,velocity=True,optical=False,
+                    overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)
         fitsname = target+'_HI.pbcor.fits'
         logger.info('Saving primary beam corrected image cube as {}'.format(fitsname))
         if coord_chn:
             imagename = target+'.image.pbcor.J2000'
         else:
             imagename = target+'.image.pbcor'
-        command = "exportfits(imagename='{0}{1}', fitsimage='{0}{2}', velocity=True,optical=False,overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(img_dir,imagename,fitsname)
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        cf.run_task('exportfits',config,config_raw,logger,imagename=img_dir+imagename,fitsimage=img_dir+fitsname,velocity=True,optical=False,
+                    overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)
         coord_chn = False
     logger.info('Completed generation of clean image(s).')
     
     
-# Read configuration file with parameters
-config_file = sys.argv[-1]
+# Read configuration file with parameters (and optionally the single target to image)
+script_args = cf.get_script_args()
+config_file = script_args[0]
 config,config_raw = cf.read_config(config_file)
 interactive = config['global']['interactive']
+target_sel = None
+if len(script_args) > 1:
+    target_sel = script_args[1]
 
 # Set up your logger
 logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['project_name']),
@@ -335,6 +341,8 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 #Remove previous image files
 targets = config['calibration']['target_names']
+if target_sel is not None:
+    targets = [target_sel]
 img_path = config['global']['img_dir']+'/'
 cf.check_casaversion(logger)
 logger.info('Deleting any existing clean image(s).')
@@ -357,6 +365,10 @@ for target in targets:
 #Make clean image
 image(config,config_raw,config_file,logger)
 
-#Review and backup parameters file
-cf.diff_pipeline_params(config_file,logger)
-cf.backup_pipeline_params(config_file,logger)
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
+
+#Review and backup parameters file (the runs for single targets run at once, so the pipeline backs up the file after all of them)
+if target_sel is None:
+    cf.diff_pipeline_params(config_file,logger)
+    cf.backup_pipeline_params(config_file,logger)
@@ -23,12 +23,22 @@ def cleanup(config,logger):
         del_list = glob.glob('./*.last')
         for file_path in del_list:
             cf.rmfile(file_path,logger)
+        logger.info('Deleting logs of task calls run in separate CASA processes.')
+        cf.rmdir('./.casa_tasks',logger)
+        cf.rmdir('./.rfi_flagger',logger)
+        logger.info('Deleting logs of the plot workers.')
+        cf.rmdir('./.casa_plots',logger)
+        cf.rmdir(cf.plot_spool_dir,logger)
         logger.info('Deleting calibration tables.')
         cf.rmdir('./cal_tabs',logger)
+        logger.info('Deleting flagging and calibration checkpoints.')
+        cf.rmdir('./checkpoints',logger)
         logger.info('Deleting flag tables.')
         cf.rmdir('./{}.flagversions'.format(msfile),logger)
+        cf.rmdir('./{}.flagdeltas'.format(msfile),logger)
         logger.info('Deleting full measurement set.')
         cf.rmdir('./{}'.format(msfile),logger) 
+        cf.rmfile('./{}.metadata.json'.format(msfile),logger)
     if cln_lvl >= 2:       
         logger.info('Deleting dirty images.')
         del_list = glob.glob(img_dir+'*.dirty.*')
@@ -82,5 +92,8 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 # Define MS file name
 msfile = '{0}.ms'.format(config['global']['project_name'])
 
+#Wait for any deferred QA plots, as they may read files that are about to be deleted
+cf.join_plot_consumer(config,config_raw,logger,reason='before the files are deleted')
+
 #Cleanup unwanted files
 cleanup(config,logger)
@@ -28,10 +28,7 @@ for proj in proj_IDs:
         
 logger.info('Setting relative weights of each MS.')
 for msfile in msfiles:
-    command = "initweights(vis='{0}', wtmode='nyq')".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('initweights',config,config_raw,logger,vis=msfile,wtmode='nyq')
         
 logger.info('Starting to make combined clean image.')
 
@@ -42,13 +39,16 @@ img_param['msfiles'] = msfiles
 img_param['img_dir'] = img_dir
 img_param['HCG'] = HCG
 img_param['clean_thresh'] = 2.5*img_param['rms']
-if not config_raw.has_option('image','restoringbeam'):
-    command = "tclean(vis={msfiles}, imagename='{img_dir}/HCG{HCG}', cell='{pix_size}', imsize={im_size}, spw='{im_chns}', specmode='cube', outframe='bary', veltype='radio', restfreq='{rest_freq}', gridder='mosaic', wprojplanes=128, pblimit=0.1, normtype='flatnoise', deconvolver='multiscale', scales={scales}, weighting='briggs', robust={robust}, restoringbeam='common', pbcor=True, niter=100000, gain=0.1, cyclefactor=2.0, interactive=False, threshold='{clean_thresh}mJy', usemask='auto-multithresh', phasecenter='{phasecenter}', sidelobethreshold={automask_sl}, noisethreshold={automask_ns}, lownoisethreshold={automask_lns}, minbeamfrac={automask_mbf}, negativethreshold={automask_neg})".format(**img_param)
-else:
-    command = "tclean(vis={msfiles}, imagename='{img_dir}/HCG{HCG}', cell='{pix_size}', imsize={im_size}, spw='{im_chns}', specmode='cube', outframe='bary', veltype='radio', restfreq='{rest_freq}', gridder='mosaic', wprojplanes=128, pblimit=0.1, normtype='flatnoise', deconvolver='multiscale', scales={scales}, weighting='briggs', robust={robust}, restoringbeam={restoringbeam}, pbcor=True, niter=100000, gain=0.1, cyclefactor=2.0, interactive=False, threshold='{clean_thresh}mJy', usemask='auto-multithresh', phasecenter='{phasecenter}', sidelobethreshold={automask_sl}, noisethreshold={automask_ns}, lownoisethreshold={automask_lns}, minbeamfrac={automask_mbf}, negativethreshold={automask_neg})".format(**img_param)
-logger.info('Executing command: '+command)
-exec(command)
-cf.check_casalog(config,config_raw,logger,casalog)
+restoringbeam = 'common'
+if config_raw.has_option('image','restoringbeam'):
+    restoringbeam = img_param['restoringbeam']
+cf.run_task('tclean',config,config_raw,logger,vis=msfiles,imagename='{img_dir}/HCG{HCG}'.format(**img_param),cell=img_param['pix_size'],
+            imsize=img_param['im_size'],spw=img_param['im_chns'],specmode='cube',outframe='bary',veltype='radio',restfreq=img_param['rest_freq'],
+            gridder='mosaic',wprojplanes=128,pblimit=0.1,normtype='flatnoise',deconvolver='multiscale',scales=img_param['scales'],weighting='briggs',
+            robust=img_param['robust'],restoringbeam=restoringbeam,pbcor=True,niter=100000,gain=0.1,cyclefactor=2.0,interactive=False,
+            threshold='{clean_thresh}mJy'.format(**img_param),usemask='auto-multithresh',phasecenter=img_param['phasecenter'],
+            sidelobethreshold=img_param['automask_sl'],noisethreshold=img_param['automask_ns'],lownoisethreshold=img_param['automask_lns'],
+            minbeamfrac=img_param['automask_mbf'],negativethreshold=img_param['automask_neg'])
 
 logger.info('Completed joint (clean) imaging of HCG {0}.'.format(str(HCG)))
 
@@ -60,14 +60,10 @@ coord_chn = False
 if 'J2000' not in coords.referencecode()[0]:
     coord_chn = True
     logger.info('Coordinate system not J2000. Image will be regridded.')
-    command = "imregrid(imagename='{0}/HCG{1}.image', template='J2000', output='{0}/HCG{1}.image.J2000', asvelocity=True, interpolation='linear', decimate=10, overwrite=True)".format(img_dir,HCG)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    command = "imregrid(imagename='{0}/HCG{1}.image.pbcor', template='J2000', output='{0}/HCG{1}.image.pbcor.J2000', asvelocity=True, interpolation='linear', decimate=10, overwrite=True)".format(img_dir,HCG)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('imregrid',config,config_raw,logger,imagename='{0}/HCG{1}.image'.format(img_dir,HCG),template='J2000',
+                output='{0}/HCG{1}.image.J2000'.format(img_dir,HCG),asvelocity=True,interpolation='linear',decimate=10,overwrite=True)
+    cf.run_task('imregrid',config,config_raw,logger,imagename='{0}/HCG{1}.image.pbcor'.format(img_dir,HCG),template='J2000',
+                output='{0}/HCG{1}.image.pbcor.J2000'.format(img_dir,HCG),asvelocity=True,interpolation='linear',decimate=10,overwrite=True)
 coords.done()
 ia.close()
 
@@ -77,23 +73,21 @@ if coord_chn:
     imagename = 'HCG{0}.image.J2000'.format(str(HCG))
 else:
     imagename = 'HCG{0}.image'.format(str(HCG))
-command = "exportfits(imagename='{0}/{1}', fitsimage='{0}/{2}', velocity=True,optical=False,overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(img_dir,imagename,fitsname)
-logger.info('Executing command: '+command)
-exec(command)
-cf.check_casalog(config,config_raw,logger,casalog)
+cf.run_task('exportfits',config,config_raw,logger,imagename=img_dir+'/'+imagename,fitsimage=img_dir+'/'+fitsname,velocity=True,optical=False,
+            overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)
 fitsname = 'HCG{}_HI.pbcor.fits'.format(str(HCG))
 logger.info('Saving primary beam corrected image cube as {}'.format(fitsname))
 if coord_chn:
     imagename = 'HCG{0}.image.pbcor.J2000'.format(str(HCG))
 else:
     imagename = 'HCG{0}.image.pbcor'.format(str(HCG))
-command = "exportfits(imagename='{0}/{1}', fitsimage='{0}/{2}', velocity=True,optical=False,overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(img_dir,imagename,fitsname)
-logger.info('Executing command: '+command)
-exec(command)
-cf.check_casalog(config,config_raw,logger,casalog)
+cf.run_task('exportfits',config,config_raw,logger,imagename=img_dir+'/'+imagename,fitsimage=img_dir+'/'+fitsname,velocity=True,optical=False,
+            overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)
 
 logger.info('Completed generating fits files.')
 
+cf.profile_summary(config,logger)
+
 logger.info('Moving logs to source directory.')
 
 os.system('mv {0} HCG{1}/.'.format(casalog.logfile(),str(HCG)))
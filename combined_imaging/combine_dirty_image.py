@@ -28,10 +28,7 @@ for proj in proj_IDs:
         
 logger.info('Setting relative weights of each MS.')
 for msfile in msfiles:
-    command = "initweights(vis='{0}', wtmode='nyq')".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('initweights',config,config_raw,logger,vis=msfile,wtmode='nyq')
         
 logger.info('Starting to make combined dirty image.')
 
@@ -42,13 +39,16 @@ img_param['msfiles'] = msfiles
 img_param['img_dir'] = img_dir
 img_param['HCG'] = HCG
 img_param['clean_thresh'] = 2.5*img_param['rms']
-command = "tclean(vis={msfiles}, imagename='{img_dir}/HCG{HCG}.dirty', cell='{pix_size}', imsize={im_size}, spw='{im_chns}', specmode='cube', outframe='bary', veltype='radio', restfreq='{rest_freq}', gridder='mosaic', wprojplanes=128, pblimit=0.1, normtype='flatnoise', deconvolver='multiscale', scales={scales}, weighting='briggs', robust={robust}, pbcor=True, niter=0, gain=0.1, cyclefactor=2.0, interactive=False, threshold='{clean_thresh}mJy', usemask='auto-multithresh', phasecenter='{phasecenter}')".format(**img_param)
-logger.info('Executing command: '+command)
-exec(command)
-cf.check_casalog(config,config_raw,logger,casalog)
+cf.run_task('tclean',config,config_raw,logger,vis=msfiles,imagename='{img_dir}/HCG{HCG}.dirty'.format(**img_param),cell=img_param['pix_size'],
+            imsize=img_param['im_size'],spw=img_param['im_chns'],specmode='cube',outframe='bary',veltype='radio',restfreq=img_param['rest_freq'],
+            gridder='mosaic',wprojplanes=128,pblimit=0.1,normtype='flatnoise',deconvolver='multiscale',scales=img_param['scales'],weighting='briggs',
+            robust=img_param['robust'],pbcor=True,niter=0,gain=0.1,cyclefactor=2.0,interactive=False,threshold='{clean_thresh}mJy'.format(**img_param),
+            usemask='auto-multithresh',phasecenter=img_param['phasecenter'])
 
 logger.info('Completed joint (dirty) imaging of HCG {0}.'.format(str(HCG)))
 
+cf.profile_summary(config,logger)
+
 logger.info('Moving CASA log to source directory.')
 
 os.system('mv {0} HCG{1}/.'.format(casalog.logfile(),str(HCG)))
\ No newline at end of file
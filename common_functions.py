@@ -10,6 +10,23 @@ import ConfigParser
 from ast import literal_eval
 import glob
 import collections
+import functools
+import resource
+import fcntl
+import re
+import csv
+import json
+import sqlite3
+import datetime
+import calendar
+import subprocess
+import multiprocessing
+import threading
+import socket
+import atexit
+import imp
+from distutils.spawn import find_executable
+from contextlib import contextmanager
 import casadef
 
 
@@ -42,6 +59,21 @@ def read_config(configfile):
                 pass
     return config,config_raw
 
+def get_script_args():
+    '''
+    Returns the arguments passed to the CASA script being executed (everything after the script name).
+    The first argument is the configuration file. Imaging steps may also be passed a single target name.
+
+    Output:
+    args = The script arguments. (List of Strings)
+    '''
+    for i in reversed(range(len(sys.argv))):
+        if sys.argv[i].endswith('.py'):
+            if len(sys.argv[i+1:]) > 0:
+                return sys.argv[i+1:]
+            break
+    return sys.argv[-1:]
+
 # Utilities
 def makedir(pathdir,logger):
     '''
@@ -154,6 +186,10 @@ def get_logger(
 
     """ Set up a logger with UTC timestamps"""
     logger = logging.getLogger(LOG_NAME)
+    # A long-lived CASA worker runs many stages in one process, so drop handlers from previous stages
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
     log_formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=DATE_FORMAT)
     logging.Formatter.converter = time.gmtime
 
@@ -204,7 +240,13 @@ def check_casalog(config,config_raw,logger,casalog):
     """
     Checks the casa log for severe errors.
     """
-    current_log = open(casalog.logfile(), 'r')
+    check_logfile(casalog.logfile(),config,config_raw,logger)
+
+def check_logfile(logfile,config,config_raw,logger):
+    """
+    Checks a casa log file (e.g. of a task run in a separate CASA process) for severe errors.
+    """
+    current_log = open(logfile, 'r')
     casalog_lines = current_log.readlines()
     current_log.close()
     sev_err = False
@@ -239,3 +281,2221 @@ def check_casaversion(logger):
     Checks the casa log for the version number.
     """
     logger.info('CASA version: {}'.format(casadef.casa_version))
+
+# Task profiling
+profile_fields = ['stage','target','task','data','data_size','start','wall_time','cpu_time','peak_rss','read_bytes','write_bytes','status']
+task_profiles = []
+
+def script_name():
+    """
+    Returns the name of the pipeline stage script being executed (without extension).
+    """
+    for i in reversed(range(len(sys.argv))):
+        if sys.argv[i].endswith('.py'):
+            return os.path.splitext(os.path.basename(sys.argv[i]))[0]
+    return 'casa'
+
+def path_size(path):
+    """
+    Returns the total size in bytes of a file or directory (e.g. an MS or CASA image).
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root,name))
+            except OSError:
+                pass
+    return size
+
+def read_proc_io():
+    """
+    Returns the bytes read from and written to storage by this process so far (zero if not available).
+    """
+    io_counts = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        f = open('/proc/self/io','r')
+        for line in f.readlines():
+            key, value = line.split(':')
+            if key in io_counts:
+                io_counts[key] = int(value)
+        f.close()
+    except (IOError, ValueError):
+        pass
+    return io_counts
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory counter of this process (VmHWM, Linux only) so that the peak of the next task can be measured.
+    
+    Output:
+    start = Whether the counter was reset and the peak of the finished child processes so far, for read_peak_rss. (Dictionary)
+    """
+    start = {'reset': True, 'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024}
+    try:
+        f = open('/proc/self/clear_refs','w')
+        f.write('5')
+        f.close()
+    except IOError:
+        start['reset'] = False
+    return start
+
+def read_peak_rss(start):
+    """
+    Returns the peak resident memory in bytes since reset_peak_rss. The peak of the finished child processes is only counted if one of them
+    used more than all the earlier ones (the kernel only keeps the largest). If the counter of this process could not be reset (or /proc is not
+    available) its peak is that of the whole life of the process.
+    
+    Input:
+    start = As returned by reset_peak_rss. (Dictionary)
+    """
+    peak = 0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024
+    if children > start['children']:
+        peak = children
+    try:
+        f = open('/proc/self/status','r')
+        for line in f.readlines():
+            if line.startswith('VmHWM:'):
+                peak = max(peak,int(line.split()[1])*1024)
+        f.close()
+    except (IOError, ValueError):
+        peak = max(peak,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024)
+    return peak
+
+def cpu_time():
+    """
+    Returns the user plus system CPU time used by this process and its finished children.
+    """
+    cpu = 0.
+    for who in [resource.RUSAGE_SELF,resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime+usage.ru_stime
+    return cpu
+
+def command_data(command):
+    """
+    Returns the MS or image that a CASA task command string operates on.
+    """
+    for key in ['vis','imagename','infile','imfile']:
+        match = re.search(r"\b{}\s*=\s*'([^']*)'".format(key),command)
+        if match is not None:
+            return match.group(1)
+    return ''
+
+def profile_name(config):
+    """
+    Returns the name of the profile file: the project name, or the HCG number for combined imaging.
+    """
+    if config is None:
+        return 'pipeline'
+    if 'global' in config:
+        return config['global']['project_name']
+    if 'combine' in config:
+        return 'HCG{}'.format(config['combine']['hcg'])
+    return 'pipeline'
+
+def write_profile(config,row,kind='profile',fields=None):
+    """
+    Appends a row to a per-project profile file (summary/<project>.<kind>.csv).
+    The file is locked while writing as several imaging jobs may run at once.
+    """
+    if fields is None:
+        fields = profile_fields
+    sum_dir = './summary/'
+    if not os.path.isdir(sum_dir):
+        try:
+            os.makedirs(sum_dir)
+        except OSError:
+            pass
+    out_file = sum_dir+'{0}.{1}.csv'.format(profile_name(config),kind)
+    f = open(out_file,'a')
+    fcntl.flock(f,fcntl.LOCK_EX)
+    try:
+        writer = csv.DictWriter(f,fieldnames=fields)
+        if os.path.getsize(out_file) == 0:
+            writer.writeheader()
+        writer.writerow(row)
+        f.flush()
+    finally:
+        fcntl.flock(f,fcntl.LOCK_UN)
+        f.close()
+
+@contextmanager
+def task_profile(command,config,logger,data=None):
+    """
+    Measures the wall time, CPU time, peak memory and I/O of a CASA task call and records it in the project profile.
+    Used by run_task for every task call.
+    
+    Input:
+    command = The task call being executed. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    data = MS or image the task operates on. Read from the command if not given. (String)
+    """
+    task = command.split('(')[0].split('=')[-1].strip()
+    if data is None:
+        data = command_data(command)
+    args = get_script_args()
+    row = {'stage': script_name(), 'target': args[1] if len(args) > 1 else '', 'task': task, 'data': data,
+           'start': time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime())}
+    rss_start = reset_peak_rss()
+    io_start = read_proc_io()
+    cpu_start = cpu_time()
+    wall_start = time.time()
+    status = 'ok'
+    try:
+        yield row
+    except:
+        status = 'failed'
+        raise
+    finally:
+        row['wall_time'] = round(time.time()-wall_start,3)
+        row['cpu_time'] = round(cpu_time()-cpu_start,3)
+        row['peak_rss'] = read_peak_rss(rss_start)
+        io_end = read_proc_io()
+        row['read_bytes'] = io_end['read_bytes']-io_start['read_bytes']
+        row['write_bytes'] = io_end['write_bytes']-io_start['write_bytes']
+        row['data_size'] = path_size(data) if data != '' and os.path.exists(data) else 0
+        row['status'] = status
+        task_profiles.append(row)
+        try:
+            write_profile(config,row)
+        except IOError:
+            logger.debug('Could not write task profile for {}.'.format(task))
+
+step_fields = ['stage','step','target','start','wall_time','cpu_time','peak_rss','status']
+
+def profile_step(step):
+    """
+    Decorator that records the wall time, CPU time and peak memory of a pipeline step (e.g. 'calibration') in summary/<project>.steps.csv.
+    The configuration (used to name the file) is taken from the 'config' argument of the step.
+    """
+    @functools.wraps(step)
+    def wrapper(*args, **kwargs):
+        config = kwargs.get('config')
+        if config is None:
+            for arg in args:
+                if isinstance(arg,dict) and 'global' in arg:
+                    config = arg
+                    break
+        args_in = get_script_args()
+        row = {'stage': script_name(), 'step': step.__name__, 'target': args_in[1] if len(args_in) > 1 else '',
+               'start': time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime())}
+        ntasks = len(task_profiles)
+        rss_start = reset_peak_rss()
+        cpu_start = cpu_time()
+        wall_start = time.time()
+        status = 'ok'
+        try:
+            return step(*args, **kwargs)
+        except:
+            status = 'failed'
+            raise
+        finally:
+            row['wall_time'] = round(time.time()-wall_start,3)
+            row['cpu_time'] = round(cpu_time()-cpu_start,3)
+            row['peak_rss'] = max([read_peak_rss(rss_start)]+[task['peak_rss'] for task in task_profiles[ntasks:]])
+            row['status'] = status
+            try:
+                write_profile(config,row,kind='steps',fields=step_fields)
+            except IOError:
+                pass
+    return wrapper
+
+# Task dispatcher
+task_order = ['vis','imagename','infile','outputvis','outfile','caltable','field','spw']
+
+def get_task(task):
+    """
+    Returns the CASA task function with the given name. A name of the form 'module.function' is a function of a pipeline module
+    (e.g. 'rfi_flagger.flag_job'), loaded from the working directory.
+    """
+    if '.' in task:
+        module, function = task.rsplit('.',1)
+        if module not in sys.modules:
+            imp.load_source(module,module+'.py')
+        return getattr(sys.modules[module],function)
+    try:
+        import casatasks
+        if hasattr(casatasks,task):
+            return getattr(casatasks,task)
+    except ImportError:
+        pass
+    import tasks
+    return getattr(tasks,task)
+
+def get_casalog():
+    """
+    Returns the CASA logger of this session.
+    """
+    try:
+        from casatasks import casalog
+    except ImportError:
+        from taskinit import casalog
+    return casalog
+
+def task_command(task,**kwargs):
+    """
+    Returns the command line equivalent to a CASA task call (data parameters first), so that it can be logged and rerun by hand.
+    
+    Input:
+    task = Name of the CASA task. (String)
+    kwargs = Parameters passed to the task.
+    
+    Output:
+    command = The reproducible command. (String)
+    """
+    keys = [key for key in task_order if key in kwargs]
+    keys.extend(sorted([key for key in kwargs.keys() if key not in task_order]))
+    return '{0}({1})'.format(task,', '.join(['{0}={1!r}'.format(key,kwargs[key]) for key in keys]))
+
+def run_task(task,config,config_raw,logger,check=True,**kwargs):
+    """
+    Runs a CASA task. The equivalent command is logged, the call is profiled and the CASA log is checked for severe errors.
+    
+    Input:
+    task = Name of the CASA task. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    check = Check the CASA log for severe errors after the call. (Boolean)
+    kwargs = Parameters passed to the task.
+    
+    Output:
+    result = The value returned by the task (e.g. the dictionary of flagdata in summary mode).
+    """
+    command = task_command(task,**kwargs)
+    logger.info('Executing command: '+command)
+    task_function = get_task(task)
+    with task_profile(command,config,logger):
+        result = task_function(**kwargs)
+    if check:
+        check_casalog(config,config_raw,logger,get_casalog())
+    return result
+
+def run_tasks(task,calls,config,config_raw,logger,nproc=1,check=True):
+    """
+    Runs several independent calls of a CASA task at once, each in a separate CASA process (using casa_worker.py).
+    If CASA or casa_worker.py cannot be found, or nproc is 1, the calls are run one after another in this session.
+    The task may also be a function of a pipeline module (see get_task), whose parameters and return value must be JSON serialisable.
+    
+    Input:
+    task = Name of the CASA task. (String)
+    calls = Parameters of each call. (List of Dictionaries)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    nproc = Maximum number of calls running at once. (Integer)
+    check = Check the CASA log of each call for severe errors. (Boolean)
+    
+    Output:
+    results = The value returned by each call. (List)
+    """
+    casa = find_executable('casa')
+    if nproc < 2 or len(calls) < 2 or casa is None or not os.path.isfile('casa_worker.py'):
+        if nproc > 1 and len(calls) > 1:
+            logger.warning('CASA or casa_worker.py not found. The {} calls will be run serially.'.format(task))
+        return [run_task(task,config,config_raw,logger,check=check,**kwargs) for kwargs in calls]
+    task_dir = './.casa_tasks/'
+    makedir(task_dir,logger)
+    jobs = []
+    for i in range(len(calls)):
+        root = task_dir+'{0}.{1}.{2}'.format(task,os.getpid(),i)
+        logger.info('Executing command (in parallel): '+task_command(task,**calls[i]))
+        request = {'task': task, 'kwargs': calls[i], 'cwd': os.getcwd(), 'log': os.path.abspath(root+'.log')}
+        request_file = open(root+'.json','w')
+        json.dump(request,request_file)
+        request_file.close()
+        jobs.append({'root': root, 'command': [casa,'--nologger','--nogui','-c','casa_worker.py','task',root+'.json',root+'.response.json']})
+    results = [None]*len(calls)
+    failed = []
+    with task_profile('{0}(<{1} calls in {2} processes>)'.format(task,len(calls),nproc),config,logger,data=''):
+        queue = list(range(len(jobs)))
+        running = {}
+        while len(queue) > 0 or len(running) > 0:
+            while len(queue) > 0 and len(running) < nproc:
+                i = queue.pop(0)
+                out_file = open(jobs[i]['root']+'.out','w')
+                running[i] = (subprocess.Popen(jobs[i]['command'],stdout=out_file,stderr=subprocess.STDOUT),out_file)
+            for i in list(running.keys()):
+                proc, out_file = running[i]
+                if proc.poll() is None:
+                    continue
+                out_file.close()
+                del running[i]
+                response = {'status': proc.returncode, 'error': 'No response. See {}.'.format(jobs[i]['root']+'.out')}
+                if os.path.isfile(jobs[i]['root']+'.response.json'):
+                    response = json.load(open(jobs[i]['root']+'.response.json','r'))
+                if response['status'] != 0:
+                    logger.critical('{0} call {1} failed: {2}'.format(task,i,response['error']))
+                    failed.append(i)
+                else:
+                    results[i] = response.get('result')
+                    logger.info('Completed {0} call {1} of {2}.'.format(task,i+1,len(calls)))
+            time.sleep(1)
+    if len(failed) > 0:
+        raise RuntimeError('{0} of the {1} calls of {2} failed.'.format(len(failed),len(calls),task))
+    for job in jobs:
+        if check:
+            check_logfile(job['root']+'.log',config,config_raw,logger)
+        for ext in ['.json','.response.json']:
+            os.remove(job['root']+ext)
+    return results
+
+def import_procs(config,config_raw,nfiles):
+    """
+    Returns the number of CASA processes used to import the VLA archive files (one file per process).
+    This is the number of cores (or 'import_procs' in the parameters file), but no more than the number of files.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    nfiles = Number of archive files. (Integer)
+    """
+    nproc = multiprocessing.cpu_count()
+    if config_raw.has_option('importdata','import_procs'):
+        nproc = int(config['importdata']['import_procs'])
+    return max(1,min(nproc,nfiles))
+
+def profile_summary(config,logger):
+    """
+    Logs a summary of the time and resources used by each CASA task during this stage.
+    """
+    if len(task_profiles) == 0:
+        return
+    totals = collections.OrderedDict()
+    for row in task_profiles:
+        if row['task'] not in totals:
+            totals[row['task']] = {'calls': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_rss': 0, 'read_bytes': 0, 'write_bytes': 0}
+        total = totals[row['task']]
+        total['calls'] += 1
+        total['wall_time'] += row['wall_time']
+        total['cpu_time'] += row['cpu_time']
+        total['peak_rss'] = max(total['peak_rss'],row['peak_rss'])
+        total['read_bytes'] += row['read_bytes']
+        total['write_bytes'] += row['write_bytes']
+    stage_wall = sum([total['wall_time'] for total in totals.values()])
+    logger.info('Task profile for {0} (also written to ./summary/{1}.profile.csv):'.format(script_name(),profile_name(config)))
+    for task in sorted(totals.keys(), key=lambda task: totals[task]['wall_time'], reverse=True):
+        total = totals[task]
+        logger.info('{0}: {1} call(s), {2:.1f} s wall ({3:.0f}%), {4:.1f} s CPU, {5:.2f} GB peak RSS, {6:.2f} GB read, {7:.2f} GB written.'.format(
+            task,total['calls'],total['wall_time'],100.*total['wall_time']/max(stage_wall,1e-6),total['cpu_time'],
+            total['peak_rss']/1e9,total['read_bytes']/1e9,total['write_bytes']/1e9))
+
+# MS metadata cache
+ms_meta_cache = {}
+ms_meta_version = 2 # Increased whenever read_ms_metadata adds an item, so that older sidecar files are read again
+
+def get_tool(name):
+    """
+    Returns a new instance of a CASA tool ('msmd' or 'tb').
+    """
+    try:
+        import casatools
+        return {'msmd': casatools.msmetadata, 'tb': casatools.table}[name]()
+    except ImportError:
+        from taskinit import msmdtool, tbtool
+        return {'msmd': msmdtool, 'tb': tbtool}[name]()
+
+def plain_strings(obj):
+    """
+    Converts the unicode strings read from JSON (recursively) to plain strings, as CASA task parameters must be of type str.
+    """
+    if isinstance(obj,unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj,list):
+        return [plain_strings(item) for item in obj]
+    if isinstance(obj,dict):
+        return dict((plain_strings(key), plain_strings(value)) for key, value in obj.items())
+    return obj
+
+def ms_stamp(msfile):
+    """
+    Returns the sizes and modification times of the table description of an MS (and of any sub-MSs of a multi-MS) and of all the files of its subtables.
+    These change whenever the MS is rewritten or its structure changes, but not when only the data or flag columns are modified
+    (the HISTORY and FLAG_CMD subtables, which most tasks append to, are also ignored).
+    
+    Input:
+    msfile = Path to the MS. (String)
+    
+    Output:
+    stamp = [path, size, modification time] of each file. (List)
+    """
+    paths = [os.path.join(msfile,'table.dat')]
+    subms_dir = os.path.join(msfile,'SUBMSS')
+    if os.path.isdir(subms_dir):
+        paths.extend([os.path.join(subms_dir,name,'table.dat') for name in sorted(os.listdir(subms_dir))])
+    for name in sorted(os.listdir(msfile)):
+        table = os.path.join(msfile,name)
+        if os.path.isdir(table) and name not in ['SUBMSS','HISTORY','FLAG_CMD']:
+            paths.extend([os.path.join(table,file_name) for file_name in sorted(os.listdir(table)) if file_name != 'table.lock'])
+    stamp = []
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stamp.append([os.path.relpath(path,msfile),stat.st_size,round(stat.st_mtime,3)])
+    return stamp
+
+def read_ms_metadata(msfile):
+    """
+    Reads the metadata of an MS with msmd and tb.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    
+    Output:
+    meta = Fields, SPWs (names, channel frequencies and widths), antennas, scans (also by observation), observations, effective exposure
+           and baseline lengths. (Dictionary)
+    """
+    meta = {}
+    msmd_tool = get_tool('msmd')
+    msmd_tool.open(msfile)
+    meta['fields'] = list(msmd_tool.fieldnames())
+    nspw = msmd_tool.nspw()
+    meta['spws'] = []
+    for spw in range(nspw):
+        meta['spws'].append({'name': str(msmd_tool.namesforspws(spw)[0]), 'nchan': int(msmd_tool.nchan(spw)),
+                             'chan_freqs': msmd_tool.chanfreqs(spw).tolist(), 'chan_widths': msmd_tool.chanwidths(spw).tolist()})
+    meta['field_spws'] = {}
+    for field in set(meta['fields']):
+        meta['field_spws'][field] = sorted([int(spw) for spw in msmd_tool.spwsforfield(field)])
+    meta['spw_fields'] = [list(msmd_tool.fieldsforspw(spw,asnames=True)) for spw in range(nspw)]
+    meta['antennas'] = list(msmd_tool.antennanames())
+    meta['nantennas'] = int(msmd_tool.nantennas())
+    meta['nobservations'] = int(msmd_tool.nobservations())
+    meta['scans'] = []
+    for scan in msmd_tool.scannumbers():
+        meta['scans'].append({'scan': int(scan), 'fields': list(msmd_tool.fieldsforscan(scan,asnames=True)),
+                              'spws': [int(spw) for spw in msmd_tool.spwsforscan(scan)]})
+    meta['obs_scans'] = []
+    for obs in range(meta['nobservations']):
+        meta['obs_scans'].append([])
+        for scan in msmd_tool.scannumbers(obsid=obs):
+            meta['obs_scans'][obs].append({'scan': int(scan), 'fields': list(msmd_tool.fieldsforscan(scan,asnames=True,obsid=obs)),
+                                           'spws': [int(spw) for spw in msmd_tool.spwsforscan(scan,obsid=obs)]})
+    exposure = msmd_tool.effexposuretime()
+    meta['effexposure'] = {'value': float(exposure['value']), 'unit': str(exposure['unit'])}
+    msmd_tool.close()
+    tb_tool = get_tool('tb')
+    tb_tool.open(msfile+'/OBSERVATION')
+    meta['obs_time_ranges'] = tb_tool.getcol('TIME_RANGE').T.tolist()
+    meta['projects'] = list(tb_tool.getcol('PROJECT'))
+    tb_tool.close()
+    tb_tool.open(msfile+'/SPECTRAL_WINDOW')
+    meta['spw_doppler_ids'] = tb_tool.getcol('DOPPLER_ID').tolist()
+    meta['spw_freq_groups'] = tb_tool.getcol('FREQ_GROUP').tolist()
+    tb_tool.close()
+    tb_tool.open(msfile+'/ANTENNA')
+    positions = tb_tool.getcol('POSITION')
+    tb_tool.close()
+    lengths = []
+    for i in range(positions.shape[1]):
+        for j in range(i+1,positions.shape[1]):
+            lengths.append(float(numpy.sqrt(numpy.sum((positions[:,i]-positions[:,j])**2))))
+    meta['baseline_lengths'] = sorted(lengths)
+    return meta
+
+def ms_metadata(msfile,logger=None):
+    """
+    Returns the metadata of an MS (see read_ms_metadata). It is read once and cached in a sidecar file (<msfile>.metadata.json),
+    which is used for as long as the stamp of the MS tables (see ms_stamp) is unchanged.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    
+    Output:
+    meta = The metadata. (Dictionary)
+    """
+    msfile = msfile.rstrip('/')
+    stamp = ms_stamp(msfile)
+    if msfile in ms_meta_cache and ms_meta_cache[msfile]['stamp'] == stamp:
+        return ms_meta_cache[msfile]
+    sidecar = msfile+'.metadata.json'
+    meta = None
+    if os.path.isfile(sidecar):
+        try:
+            f = open(sidecar,'r')
+            meta = plain_strings(json.load(f))
+            f.close()
+        except ValueError:
+            meta = None
+        if meta is not None and (meta.get('stamp') != stamp or meta.get('version') != ms_meta_version):
+            meta = None
+    if meta is None:
+        if logger is not None:
+            logger.info('Reading metadata of {0} (cached in {1}).'.format(msfile,sidecar))
+        meta = read_ms_metadata(msfile)
+        meta['stamp'] = stamp
+        meta['version'] = ms_meta_version
+        try:
+            f = open(sidecar,'w')
+            json.dump(meta,f)
+            f.close()
+        except IOError:
+            if logger is not None:
+                logger.debug('Could not write metadata cache {}.'.format(sidecar))
+    ms_meta_cache[msfile] = meta
+    return meta
+
+def spws_for_fields(meta,fields):
+    """
+    Returns the (sorted, unique) SPW IDs in which any of the given fields were observed.
+    
+    Input:
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    fields = Field names. (List of Strings)
+    """
+    spws = []
+    for field in fields:
+        spws.extend(meta['field_spws'].get(field,[]))
+    return sorted(list(set(spws)))
+
+# Partitioned calibration solves
+def solve_procs(config,config_raw):
+    """
+    Returns the number of CASA processes used for each calibration solve ('solve_procs' in the calibration section of the parameters file).
+    The default is 1, i.e. each solve is a single call over all the SPWs and observations.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    if config_raw.has_option('calibration','solve_procs'):
+        return max(1,int(config['calibration']['solve_procs']))
+    return 1
+
+def solve_partitions(meta,fields,spws):
+    """
+    Returns the (SPW, observation) pairs in which any of the given fields were observed.
+    
+    Input:
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    fields = Field names. (List of Strings)
+    spws = SPW IDs. (List of Integers)
+    """
+    parts = set()
+    for obs in range(len(meta['obs_scans'])):
+        for scan in meta['obs_scans'][obs]:
+            if len(set(scan['fields']).intersection(fields)) > 0:
+                parts.update([(spw,obs) for spw in scan['spws'] if spw in spws])
+    return sorted(parts)
+
+def merge_caltables(part_tables,caltable,logger):
+    """
+    Merges calibration tables solved for separate SPWs (and observations) of the same MS into one table. The solutions are appended to a copy
+    of the first table, and the SPECTRAL_WINDOW row of each SPW is taken from a table that solved it (as some solves, e.g. delays, change it).
+    
+    Input:
+    part_tables = Paths of the tables to merge. (List of Strings)
+    caltable = Path of the merged table. (String)
+    """
+    tb_tool = get_tool('tb')
+    tb_tool.open(part_tables[0])
+    tb_tool.copy(caltable,deep=True,valuecopy=True)
+    tb_tool.close()
+    for part in part_tables[1:]:
+        tb_tool.open(part)
+        tb_tool.copyrows(caltable)
+        tb_tool.close()
+    spw_tool = get_tool('tb')
+    spw_tool.open(caltable+'/SPECTRAL_WINDOW',nomodify=False)
+    for part in part_tables[1:]:
+        tb_tool.open(part)
+        solved = sorted(set(tb_tool.getcol('SPECTRAL_WINDOW_ID').tolist())) if tb_tool.nrows() > 0 else []
+        tb_tool.close()
+        tb_tool.open(part+'/SPECTRAL_WINDOW')
+        for spw in solved:
+            for col in tb_tool.colnames():
+                if tb_tool.iscelldefined(col,spw):
+                    spw_tool.putcell(col,spw,tb_tool.getcell(col,spw))
+        tb_tool.close()
+    spw_tool.close()
+    tb_tool.open(caltable)
+    logger.info('Merged {0} solution tables into {1} ({2} solutions).'.format(len(part_tables),caltable,tb_tool.nrows()))
+    tb_tool.close()
+
+def partitioned_solve(task,msfile,caltable,fields,spws,config,config_raw,logger,**kwargs):
+    """
+    Runs a calibration solve (gaincal or bandpass). If 'solve_procs' is more than 1 the solve is partitioned by SPW and observation, the
+    partitions are solved at once in separate CASA processes (reading the same MS) and their tables are merged into 'caltable'.
+    As no solution interval spans more than one SPW or observation (unless 'spw' or 'obs' are combined, which these solves do not do),
+    the merged table holds the same solutions as a single call.
+    
+    Input:
+    task = 'gaincal' or 'bandpass'. (String)
+    msfile = Path to the MS. (String)
+    caltable = Path of the calibration table. (String)
+    fields = Fields to solve for. (List of Strings)
+    spws = SPW IDs to solve for. (List of Integers)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    kwargs = The other parameters of the solve.
+    """
+    nproc = solve_procs(config,config_raw)
+    parts = solve_partitions(ms_metadata(msfile,logger),fields,spws)
+    if nproc < 2 or len(parts) < 2:
+        run_task(task,config,config_raw,logger,vis=msfile,caltable=caltable,field=','.join(fields),spw=','.join([str(spw) for spw in spws]),**kwargs)
+        return
+    part_dir = caltable+'.parts/'
+    rmdir(caltable,logger)
+    rmdir(part_dir,logger)
+    makedir(part_dir,logger)
+    part_tables = [part_dir+'spw{0}_obs{1}'.format(spw,obs) for spw, obs in parts]
+    calls = []
+    for i in range(len(parts)):
+        call = dict(kwargs)
+        call.update({'vis': msfile, 'caltable': part_tables[i], 'field': ','.join(fields), 'spw': str(parts[i][0]), 'observation': str(parts[i][1])})
+        calls.append(call)
+    logger.info('Solving {0} in {1} partitions (SPW x observation) with {2} processes.'.format(caltable,len(parts),nproc))
+    run_tasks(task,calls,config,config_raw,logger,nproc=nproc)
+    part_tables = [table for table in part_tables if os.path.isdir(table)]
+    if len(part_tables) == 0:
+        logger.warning('No solutions were found for {}.'.format(caltable))
+    else:
+        merge_caltables(part_tables,caltable,logger)
+    rmdir(part_dir,logger)
+
+# Accumulated calibration tables
+collapse_tolerance = 0.01 # Largest median fractional difference (and fraction of differing flags) accepted between the collapsed and stacked tables
+
+def read_caltable(caltable,param='CPARAM'):
+    """
+    Reads the solutions of a calibration table, grouped by field, SPW and antenna.
+    
+    Input:
+    caltable = Path of the calibration table. (String)
+    param = Column holding the solutions (CPARAM or FPARAM). (String)
+    
+    Output:
+    solutions = For each (field, SPW, antenna): 'time', 'obs', 'param' (correlation x channel x solution) and 'flag'. (Dictionary)
+    """
+    tb_tool = get_tool('tb')
+    tb_tool.open(caltable)
+    keys = zip(tb_tool.getcol('FIELD_ID').tolist(),tb_tool.getcol('SPECTRAL_WINDOW_ID').tolist(),tb_tool.getcol('ANTENNA1').tolist())
+    times = tb_tool.getcol('TIME')
+    obs = tb_tool.getcol('OBSERVATION_ID')
+    solutions = {}
+    for row in range(len(times)):
+        if keys[row] not in solutions:
+            solutions[keys[row]] = {'rows': [], 'time': [], 'obs': [], 'param': [], 'flag': []}
+        solution = solutions[keys[row]]
+        solution['rows'].append(row)
+        solution['time'].append(times[row])
+        solution['obs'].append(obs[row])
+        solution['param'].append(tb_tool.getcell(param,row))
+        solution['flag'].append(tb_tool.getcell('FLAG',row))
+    tb_tool.close()
+    for solution in solutions.values():
+        for key in ['param','flag']:
+            solution[key] = numpy.dstack(solution[key])
+        for key in ['time','obs']:
+            solution[key] = numpy.array(solution[key])
+    return solutions
+
+def interpolate_gains(solution,times):
+    """
+    Interpolates complex gain solutions (one channel) linearly in time, amplitude and phase separately, skipping flagged solutions.
+    Beyond the first and last solutions the nearest one is used, as applycal does.
+    
+    Input:
+    solution = Solutions of one field, SPW and antenna, from read_caltable. (Dictionary)
+    times = Times to interpolate to. (Array)
+    
+    Output:
+    gains = Gains (correlation x time). (Complex array)
+    flags = Times without an unflagged solution to interpolate from (correlation x time). (Boolean array)
+    """
+    npol = solution['param'].shape[0]
+    gains = numpy.ones((npol,len(times)),dtype=complex)
+    flags = numpy.zeros((npol,len(times)),dtype=bool)
+    order = numpy.argsort(solution['time'])
+    for pol in range(npol):
+        good = order[~solution['flag'][pol,0,order]]
+        if len(good) == 0:
+            flags[pol] = True
+            continue
+        values = solution['param'][pol,0,good]
+        amp = numpy.interp(times,solution['time'][good],numpy.abs(values))
+        phase = numpy.interp(times,solution['time'][good],numpy.unwrap(numpy.angle(values)))
+        gains[pol] = amp*numpy.exp(1j*phase)
+    return gains, flags
+
+def fold_delays(dltab,bstab,kbtab,logger):
+    """
+    Folds the delays into the bandpass: writes a bandpass table (kbtab) whose solutions are those of bstab multiplied by the phase slope
+    of the delay of the same field, SPW, antenna and observation (2 pi delay (frequency - REF_FREQUENCY of the SPW in the delay table),
+    as applycal applies it).
+    This is only done if the delays are constant over each bandpass solution (one delay per field, SPW, antenna and observation).
+    
+    Input:
+    dltab = Path of the delay (K) table. (String)
+    bstab = Path of the bandpass table. (String)
+    kbtab = Path of the table to write. (String)
+    
+    Output:
+    done = Whether the table was written. (Boolean)
+    """
+    delays = read_caltable(dltab,param='FPARAM')
+    for key, solution in delays.items():
+        if len(set(solution['obs'].tolist())) < len(solution['obs']):
+            logger.info('The delays of {0} vary within an observation (field, SPW, antenna {1}). They will not be folded into the bandpass.'.format(dltab,key))
+            return False
+    tb_tool = get_tool('tb')
+    tb_tool.open(dltab+'/SPECTRAL_WINDOW')
+    ref_freqs = tb_tool.getcol('REF_FREQUENCY')
+    tb_tool.close()
+    tb_tool.open(bstab+'/SPECTRAL_WINDOW')
+    chan_freqs = [tb_tool.getcell('CHAN_FREQ',spw) if tb_tool.iscelldefined('CHAN_FREQ',spw) else None for spw in range(tb_tool.nrows())]
+    tb_tool.close()
+    rmdir(kbtab,logger)
+    tb_tool.open(bstab)
+    tb_tool.copy(kbtab,deep=True,valuecopy=True)
+    tb_tool.close()
+    tb_tool.open(kbtab,nomodify=False)
+    fields = tb_tool.getcol('FIELD_ID')
+    spws = tb_tool.getcol('SPECTRAL_WINDOW_ID')
+    antennas = tb_tool.getcol('ANTENNA1')
+    obs = tb_tool.getcol('OBSERVATION_ID')
+    for row in range(tb_tool.nrows()):
+        param = tb_tool.getcell('CPARAM',row)
+        flag = tb_tool.getcell('FLAG',row)
+        delay = delays.get((fields[row],spws[row],antennas[row]))
+        match = [] if delay is None else numpy.where(delay['obs'] == obs[row])[0]
+        if len(match) == 0:
+            flag[:] = True
+        else:
+            tau = delay['param'][:,0,match[0]]*1e-9
+            phase = 2.*numpy.pi*numpy.outer(tau,chan_freqs[spws[row]]-ref_freqs[spws[row]])
+            param = param*numpy.exp(1j*phase)
+            flag |= delay['flag'][:,0:1,match[0]]
+        tb_tool.putcell('CPARAM',row,param)
+        tb_tool.putcell('FLAG',row,flag)
+    tb_tool.close()
+    logger.info('Folded the delays of {0} into the bandpass of {1} ({2}).'.format(dltab,bstab,kbtab))
+    return True
+
+def accumulate_gains(iptab,amtab,fxtab,gtab,logger):
+    """
+    Accumulates the integration phase, amplitude and flux scale solutions (applied with the same solution field) into one gain table on the
+    time grid of the integration phases: each phase solution is multiplied by the amplitude and flux scale solutions of the same field,
+    SPW and antenna, interpolated to its time. A field without flux scale solutions (a flux calibrator) is given a scale of 1.
+    
+    Input:
+    iptab = Path of the integration phase table. (String)
+    amtab = Path of the amplitude table. (String)
+    fxtab = Path of the flux scale table, or None. (String)
+    gtab = Path of the table to write. (String)
+    """
+    factors = [read_caltable(amtab)]
+    if fxtab is not None:
+        factors.append(read_caltable(fxtab))
+    rmdir(gtab,logger)
+    tb_tool = get_tool('tb')
+    tb_tool.open(iptab)
+    tb_tool.copy(gtab,deep=True,valuecopy=True)
+    tb_tool.close()
+    phases = read_caltable(gtab)
+    tb_tool.open(gtab,nomodify=False)
+    for key, solution in phases.items():
+        param = solution['param'].copy()
+        flag = solution['flag'].copy()
+        for i in range(len(factors)):
+            if key not in factors[i]:
+                if i == 0:
+                    flag[:] = True
+                continue
+            gains, gain_flags = interpolate_gains(factors[i][key],solution['time'])
+            param[:,0,:] *= gains
+            flag[:,0,:] |= gain_flags
+        for k in range(len(solution['rows'])):
+            tb_tool.putcell('CPARAM',solution['rows'][k],param[:,:,k])
+            tb_tool.putcell('FLAG',solution['rows'][k],flag[:,:,k])
+    tb_tool.close()
+    logger.info('Accumulated {0} into {1}.'.format(', '.join([table for table in [iptab,amtab,fxtab] if table is not None]),gtab))
+
+def compare_corrected(snapshot,callibs,field,spw,config,config_raw,logger):
+    """
+    Applies two cal libraries in turn to a copy of a sample of an MS (holding only the rows of the selected fields and SPWs) and compares
+    the corrected data. The flags of the sample are restored after each applycal.
+    
+    Input:
+    snapshot = Path of the sample MS (see snapshot_ms). (String)
+    callibs = The two cal library files. (List of Strings)
+    field = Field selection of applycal. (String)
+    spw = SPW selection of applycal. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    
+    Output:
+    diff = Median fractional difference of the data unflagged after both. (Float)
+    flag_diff = Fraction of the data flagged after only one. (Float)
+    """
+    tb_tool = get_tool('tb')
+    tb_tool.open(snapshot)
+    flags = tb_tool.getcol('FLAG')
+    flag_row = tb_tool.getcol('FLAG_ROW')
+    tb_tool.close()
+    results = []
+    for callib in callibs:
+        run_task('applycal',config,config_raw,logger,vis=snapshot,field=field,spw=spw,docallib=True,callib=callib,flagbackup=False)
+        tb_tool.open(snapshot,nomodify=False)
+        results.append([tb_tool.getcol('CORRECTED_DATA'),tb_tool.getcol('FLAG')])
+        tb_tool.putcol('FLAG',flags)
+        tb_tool.putcol('FLAG_ROW',flag_row)
+        tb_tool.close()
+    (data_a, flag_a), (data_b, flag_b) = results
+    good = ~flag_a & ~flag_b
+    diff = 0.
+    if numpy.any(good):
+        diff = float(numpy.median(numpy.abs(data_a[good]-data_b[good])/numpy.maximum(numpy.abs(data_a[good]),1e-12)))
+    return diff, float(numpy.mean(flag_a != flag_b))
+
+# QA plot farm
+plot_queue = []
+plot_workers = []
+#Whether stop_plot_workers is registered to run at exit. Kept when this module is reloaded (by each stage run in a persistent worker) so it is only registered once.
+if 'plot_exit_registered' not in globals():
+    plot_exit_registered = False
+
+def queue_plot(logger,flag_version=None,snapshot=False,**kwargs):
+    """
+    Adds a plotms call to the queue of QA plots. The queued plots are rendered together by render_plots.
+    The other two parameters only matter if the plots are deferred (see spool_plots), as the MS may have changed by the time they are rendered.
+    
+    Input:
+    flag_version = Flag version holding the flags to plot. (String)
+    snapshot = Copy the selected data (field and antenna) before the stage continues, e.g. for plots of the corrected data. (Boolean)
+    kwargs = Parameters passed to plotms. (The plot is always made without the GUI.)
+    """
+    kwargs['showgui'] = False
+    logger.info('Queueing plot: {}'.format(kwargs.get('plotfile','')))
+    plot_queue.append({'kwargs': kwargs, 'flag_version': flag_version, 'snapshot': snapshot})
+
+def plot_procs(config,config_raw):
+    """
+    Returns the number of headless CASA processes used to render the QA plots.
+    This is the number of cores (at most 4), or 'plot_procs' in the global section of the parameters file.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    nproc = min(4,multiprocessing.cpu_count())
+    if config_raw is not None and config_raw.has_option('global','plot_procs'):
+        nproc = int(config['global']['plot_procs'])
+    return max(1,nproc)
+
+def plot_request(sock_path,request):
+    """
+    Sends a request to a plot worker and waits for the response.
+    
+    Input:
+    sock_path = Path of the Unix socket of the worker. (String)
+    request = The plotms call, see casa_worker.py. (Dictionary)
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(sock_path)
+        client.sendall(json.dumps(request)+'\n')
+        data = ''
+        while not data.endswith('\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        client.close()
+    if len(data) == 0:
+        return {'status': 1, 'error': 'The plot worker exited.'}
+    return json.loads(data)
+
+def start_plot_worker(i,casa,logger):
+    """
+    Starts (or reuses) plot worker number i: a CASA session running casa_worker.py without a GUI, run with xvfb-run if there is no display.
+    The worker keeps its plotms backend running between plots and exits when this stage ends (or after 5 minutes idle).
+    
+    Input:
+    i = Number of the worker. (Integer)
+    casa = Path to the CASA executable. (String)
+    
+    Output:
+    sock_path = Path of the Unix socket of the worker, or None if it did not start. (String)
+    """
+    global plot_exit_registered
+    while len(plot_workers) <= i:
+        plot_workers.append(None)
+    if plot_workers[i] is not None and plot_workers[i]['proc'].poll() is None:
+        return plot_workers[i]['sock']
+    plot_dir = './.casa_plots/'
+    if not os.path.isdir(plot_dir):
+        os.makedirs(plot_dir)
+    root = plot_dir+'plot{0}.{1}'.format(os.getpid(),i)
+    if os.path.exists(root+'.sock'):
+        os.remove(root+'.sock')
+    command = [casa,'--nologger','--nogui','--logfile',root+'.log','-c','casa_worker.py','serve',root+'.sock','300']
+    if 'DISPLAY' not in os.environ and find_executable('xvfb-run') is not None:
+        command = ['xvfb-run','-a'] + command
+    logger.info('Starting plot worker {0} ({1}).'.format(i,root+'.sock'))
+    out_file = open(root+'.out','w')
+    proc = subprocess.Popen(command,stdout=out_file,stderr=subprocess.STDOUT)
+    out_file.close()
+    plot_workers[i] = {'sock': root+'.sock', 'proc': proc}
+    if not plot_exit_registered:
+        atexit.register(stop_plot_workers)
+        plot_exit_registered = True
+    start = time.time()
+    while time.time()-start < 600 and proc.poll() is None:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(root+'.sock')
+            return root+'.sock'
+        except socket.error:
+            time.sleep(1)
+        finally:
+            client.close()
+    logger.warning('Plot worker {0} did not start. See {1}.'.format(i,root+'.out'))
+    return None
+
+def stop_plot_workers():
+    """
+    Asks the plot workers to exit. Registered to run when the stage ends (once the first worker is started), and called by casa_worker.py at the end of a stage run in a
+    persistent worker (where the interpreter does not exit).
+    """
+    for worker in plot_workers:
+        if worker is None or worker['proc'].poll() is not None:
+            continue
+        try:
+            plot_request(worker['sock'],{'shutdown': True})
+        except socket.error:
+            worker['proc'].terminate()
+        worker['proc'].wait()
+    del plot_workers[:]
+
+def render_plots(config,config_raw,logger,defer=True):
+    """
+    Renders all the queued QA plots (see queue_plot), shared between a pool of headless plot workers, and returns when they are all written.
+    If CASA or casa_worker.py cannot be found, or only one process is allowed, the plots are made one after another in this session.
+    A plot that fails is reported but does not stop the pipeline.
+    If 'defer_plots' is set the plots are instead passed to the background plot consumer (see spool_plots).
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    defer = Allow the plots to be deferred. (Boolean)
+    """
+    if len(plot_queue) == 0:
+        return
+    if defer and defer_plots(config,config_raw):
+        if spool_plots(config,config_raw,logger):
+            return
+    plots = [plot['kwargs'] for plot in plot_queue if 'kwargs' in plot]
+    jobs = [plot['flag_plots'] for plot in plot_queue if 'flag_plots' in plot]
+    del plot_queue[:]
+    for job in jobs:
+        if not flag_plots(job,config,logger):
+            plots.extend(flag_plot_calls(job,ms_metadata(job['vis'],logger)))
+    if len(plots) == 0:
+        return
+    nproc = min(plot_procs(config,config_raw),len(plots))
+    casa = find_executable('casa')
+    if nproc < 2 or casa is None or not os.path.isfile('casa_worker.py'):
+        for kwargs in plots:
+            run_task('plotms',config,config_raw,logger,check=False,**kwargs)
+        return
+    logger.info('Rendering {0} plots with {1} plot workers.'.format(len(plots),nproc))
+    lock = threading.Lock()
+    failed = []
+    def render(i):
+        sock_path = start_plot_worker(i,casa,logger)
+        while sock_path is not None:
+            with lock:
+                if len(plots) == 0:
+                    return
+                kwargs = plots.pop(0)
+            try:
+                response = plot_request(sock_path,{'task': 'plotms', 'kwargs': kwargs, 'cwd': os.getcwd()})
+            except socket.error as e:
+                response = {'status': 1, 'error': str(e)}
+            if response['status'] != 0:
+                logger.warning('Plot {0} failed: {1}'.format(kwargs.get('plotfile',''),response['error']))
+                with lock:
+                    failed.append(kwargs)
+                sock_path = start_plot_worker(i,casa,logger)
+            else:
+                logger.info('Completed plot: {}'.format(kwargs.get('plotfile','')))
+    with task_profile('plotms(<{0} plots in {1} workers>)'.format(len(plots),nproc),config,logger,data=''):
+        threads = [threading.Thread(target=render,args=(i,)) for i in range(nproc)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if len(plots) > 0:
+        logger.warning('No plot worker could be started. Making the remaining {} plots in this session.'.format(len(plots)))
+        for kwargs in plots:
+            run_task('plotms',config,config_raw,logger,check=False,**kwargs)
+    if len(failed) > 0:
+        logger.warning('{0} plots failed: {1}'.format(len(failed),', '.join([kwargs.get('plotfile','') for kwargs in failed])))
+
+# Deferred QA plots
+plot_spool_dir = './.plot_spool/'
+
+def defer_plots(config,config_raw):
+    """
+    Returns whether the QA plots are deferred to the background plot consumer ('defer_plots' in the global section of the parameters file).
+    """
+    if config_raw is None or not config_raw.has_option('global','defer_plots'):
+        return False
+    return config['global']['defer_plots']
+
+def snapshot_where(meta,kwargs):
+    """
+    Returns the TaQL condition selecting the rows of an MS needed for a plot (its fields and antennas, by name).
+    Selections that cannot be translated are ignored, i.e. more rows than needed are copied.
+    
+    Input:
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    kwargs = Parameters of the plotms call. (Dictionary)
+    """
+    conditions = []
+    fields = [field.strip() for field in kwargs.get('field','').split(',') if field.strip() != '']
+    if len(fields) > 0 and all([field in meta['fields'] for field in fields]):
+        ids = [i for i in range(len(meta['fields'])) if meta['fields'][i] in fields]
+        conditions.append('FIELD_ID IN [{}]'.format(','.join([str(i) for i in ids])))
+    antennas = [antenna.strip() for antenna in kwargs.get('antenna','').split(',') if antenna.strip() != '']
+    if len(antennas) > 0 and all([antenna in meta['antennas'] for antenna in antennas]):
+        ids = ','.join([str(meta['antennas'].index(antenna)) for antenna in antennas])
+        conditions.append('(ANTENNA1 IN [{0}] OR ANTENNA2 IN [{0}])'.format(ids))
+    if len(conditions) == 0:
+        return 'T'
+    return ' AND '.join(conditions)
+
+def snapshot_ms(vis,snapshot,where,flag_version=None):
+    """
+    Copies the selected rows of an MS (with its subtables, but without the model data) to a new MS.
+    If a flag version is given the flags of the copy are replaced with those saved in that version, and the corrected data are not copied.
+    
+    Input:
+    vis = Path to the MS. (String)
+    snapshot = Path of the copy. (String)
+    where = TaQL condition selecting the rows, from snapshot_where. (String)
+    flag_version = Name of a flag version of the MS (see save_flag_version). (String)
+    
+    Output:
+    rows = Rows of the MS that were copied, in the order of the copy. (Array)
+    """
+    exclude = ['MODEL_DATA']
+    if flag_version is not None:
+        exclude.append('CORRECTED_DATA')
+    tb_tool = get_tool('tb')
+    tb_tool.open(vis)
+    columns = [col for col in tb_tool.colnames() if col not in exclude]
+    selection = tb_tool.query(where,columns=','.join(columns))
+    rows = numpy.array(selection.rownumbers())
+    selection.copy(snapshot,deep=True,valuecopy=True)
+    selection.close()
+    tb_tool.close()
+    if flag_version is None:
+        return rows
+    cache = {}
+    tb_tool.open(snapshot,nomodify=False)
+    ddids = tb_tool.getcol('DATA_DESC_ID')
+    #The flag arrays have the same shape for all the rows of one data description, so they can be copied in blocks
+    chunk = 10000
+    for ddid in numpy.unique(ddids):
+        snap_rows = numpy.where(ddids == ddid)[0]
+        for start in range(0,len(snap_rows),chunk):
+            block = snap_rows[start:start+chunk]
+            flags = version_flags(vis,flag_version,int(ddid),rows[block],cache)
+            copies = tb_tool.selectrows([int(row) for row in block])
+            copies.putcol('FLAG',flags)
+            copies.putcol('FLAG_ROW',flags.all(axis=(0,1)))
+            copies.close()
+    tb_tool.close()
+    return rows
+
+def merge_snapshot_flags(snapshot,vis,rows):
+    """
+    Writes the flags of a copy made by snapshot_ms back to the rows of the MS they were copied from (e.g. once the copy has been flagged).
+    
+    Input:
+    snapshot = Path of the copy. (String)
+    vis = Path to the MS. (String)
+    rows = Rows of the MS that were copied, as returned by snapshot_ms. (Array)
+    """
+    snap_tool = get_tool('tb')
+    tb_tool = get_tool('tb')
+    snap_tool.open(snapshot)
+    tb_tool.open(vis,nomodify=False)
+    ddids = snap_tool.getcol('DATA_DESC_ID')
+    chunk = 10000
+    for ddid in numpy.unique(ddids):
+        snap_rows = numpy.where(ddids == ddid)[0]
+        for start in range(0,len(snap_rows),chunk):
+            block = snap_rows[start:start+chunk]
+            copies = snap_tool.selectrows([int(row) for row in block])
+            flags = copies.getcol('FLAG')
+            flag_row = copies.getcol('FLAG_ROW')
+            copies.close()
+            originals = tb_tool.selectrows([int(row) for row in rows[block]])
+            originals.putcol('FLAG',flags)
+            originals.putcol('FLAG_ROW',flag_row)
+            originals.close()
+    tb_tool.close()
+    snap_tool.close()
+
+def spool_plots(config,config_raw,logger):
+    """
+    Defers the queued QA plots: they are written as a request to the plot spool (plot_spool_dir) and rendered by a background consumer
+    (plot_spool.py) while the pipeline continues. Calibration tables are copied into the spool and plots marked for a snapshot have their data
+    copied (see snapshot_ms), as these will change. Plots with a flag version are rendered by the consumer from a copy with those flags.
+    Other plots read the MS when they are rendered, so they must be of data that do not change before cleanup, which waits for the spool.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    
+    Output:
+    spooled = The plots were deferred. If CASA or plot_spool.py cannot be found they are not. (Boolean)
+    """
+    if find_executable('casa') is None or not os.path.isfile('plot_spool.py'):
+        logger.warning('CASA or plot_spool.py not found. The plots cannot be deferred.')
+        return False
+    if not os.path.isdir(plot_spool_dir):
+        os.makedirs(plot_spool_dir)
+    name = '{0:.6f}.{1}'.format(time.time(),os.getpid())
+    request = {'plots': [], 'copies': []}
+    snapshots = {}
+    for plot in plot_queue:
+        if 'flag_plots' in plot:
+            request['plots'].append(plot)
+            continue
+        kwargs = dict(plot['kwargs'])
+        vis = kwargs['vis'].rstrip('/')
+        if not os.path.isdir(os.path.join(vis,'DATA_DESCRIPTION')):
+            if vis not in snapshots:
+                snapshots[vis] = plot_spool_dir+'{0}.{1}.{2}'.format(name,len(snapshots),os.path.basename(vis))
+                cpdir(vis,snapshots[vis],logger)
+                request['copies'].append(snapshots[vis])
+            kwargs['vis'] = snapshots[vis]
+        elif plot['snapshot']:
+            where = snapshot_where(ms_metadata(vis,logger),kwargs)
+            if (vis,where) not in snapshots:
+                snapshots[(vis,where)] = plot_spool_dir+'{0}.{1}.ms'.format(name,len(snapshots))
+                logger.info('Copying the data of {0} where {1} to {2} for the deferred plots.'.format(vis,where,snapshots[(vis,where)]))
+                with task_profile('snapshot_ms(vis={!r})'.format(vis),config,logger):
+                    snapshot_ms(vis,snapshots[(vis,where)],where)
+                request['copies'].append(snapshots[(vis,where)])
+            kwargs['vis'] = snapshots[(vis,where)]
+        request['plots'].append({'kwargs': kwargs, 'flag_version': plot['flag_version'], 'vis': vis})
+    del plot_queue[:]
+    f = open(plot_spool_dir+name+'.tmp','w')
+    json.dump(request,f)
+    f.close()
+    os.rename(plot_spool_dir+name+'.tmp',plot_spool_dir+name+'.json')
+    logger.info('Deferred {0} plots to the plot spool ({1}).'.format(len(request['plots']),plot_spool_dir+name+'.json'))
+    start_plot_consumer(logger)
+    return True
+
+def start_plot_consumer(logger):
+    """
+    Starts the background plot consumer (plot_spool.py, with the configuration file of this stage) unless it is already running.
+    """
+    lock = open(plot_spool_dir+'consumer.lock','a')
+    try:
+        fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+        lock.close()
+        return
+    fcntl.flock(lock,fcntl.LOCK_UN)
+    lock.close()
+    command = [find_executable('casa'),'--nologger','--nogui','--logfile',plot_spool_dir+'consumer.log','-c','plot_spool.py',get_script_args()[0]]
+    if 'DISPLAY' not in os.environ and find_executable('xvfb-run') is not None:
+        command = ['xvfb-run','-a'] + command
+    logger.info('Starting the plot consumer.')
+    out_file = open(plot_spool_dir+'consumer.out','a')
+    subprocess.Popen(command,stdout=out_file,stderr=subprocess.STDOUT,preexec_fn=os.setsid)
+    out_file.close()
+
+def render_spool_request(request_file,config,config_raw,logger):
+    """
+    Renders the plots of one request from the plot spool and removes it with its copies of the data.
+    The flag plots are made from the saved flag version (see flag_plots). Other plots with a flag version are grouped so that each copy of an MS with those flags is made once.
+    
+    Input:
+    request_file = Path to the request. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    request = plain_strings(json.load(open(request_file,'r')))
+    plots = []
+    for plot in request['plots']:
+        if 'flag_plots' not in plot:
+            plots.append(plot)
+            continue
+        job = plot['flag_plots']
+        if not flag_plots(job,config,logger,flag_version=job['flag_version']):
+            for kwargs in flag_plot_calls(job,ms_metadata(job['vis'],logger)):
+                plots.append({'kwargs': kwargs, 'flag_version': job['flag_version'], 'vis': job['vis']})
+    groups = collections.OrderedDict()
+    for plot in plots:
+        key = None
+        if plot['flag_version'] is not None:
+            key = (plot['vis'],plot['flag_version'],snapshot_where(ms_metadata(plot['vis'],logger),plot['kwargs']))
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(plot['kwargs'])
+    for key in groups.keys():
+        snapshot = None
+        if key is not None:
+            vis, flag_version, where = key
+            snapshot = os.path.splitext(request_file)[0]+'.flags.ms'
+            rmdir(snapshot,logger)
+            logger.info('Copying the data of {0} where {1} with the {2} flags to {3}.'.format(vis,where,flag_version,snapshot))
+            try:
+                snapshot_ms(vis,snapshot,where,flag_version=flag_version)
+            except Exception as e:
+                logger.warning('Could not copy the data for the {0} flag plots: {1}'.format(flag_version,e))
+                rmdir(snapshot,logger)
+                continue
+        for kwargs in groups[key]:
+            if snapshot is not None:
+                kwargs['vis'] = snapshot
+            queue_plot(logger,**kwargs)
+        render_plots(config,config_raw,logger,defer=False)
+        if snapshot is not None:
+            rmdir(snapshot,logger)
+    for path in request['copies']:
+        rmdir(path,logger)
+    os.remove(request_file)
+
+def consume_plot_spool(config,config_raw,logger,idle_timeout=60.):
+    """
+    Renders the requests in the plot spool in the order they were made, until there have been none for 'idle_timeout' seconds.
+    Only one consumer runs at a time. If another is running this waits for it to finish, so with 'idle_timeout' set to 0 this is the barrier
+    that waits for all the outstanding plots (used by cleanup).
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    idle_timeout = Seconds to wait for new requests before returning. (Float)
+    """
+    if not os.path.isdir(plot_spool_dir):
+        return
+    while True:
+        lock = open(plot_spool_dir+'consumer.lock','a')
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        idle_start = time.time()
+        while True:
+            requests = sorted(glob.glob(plot_spool_dir+'*.json'))
+            if len(requests) > 0:
+                logger.info('Rendering deferred plots: {}'.format(requests[0]))
+                render_spool_request(requests[0],config,config_raw,logger)
+                idle_start = time.time()
+            elif time.time()-idle_start >= idle_timeout:
+                break
+            else:
+                time.sleep(5)
+        fcntl.flock(lock,fcntl.LOCK_UN)
+        lock.close()
+        #A request written while the lock was being released would otherwise be left for cleanup
+        if len(glob.glob(plot_spool_dir+'*.json')) == 0:
+            break
+        idle_timeout = 0.
+
+def join_plot_consumer(config,config_raw,logger,reason='before the MS is changed'):
+    """
+    Waits until the deferred QA plots have all been rendered (see consume_plot_spool), so that the background consumer is not reading an MS
+    (or copying it with a flag version) while a step changes its structure, e.g. removes or adds a column, or deletes it.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    reason = Why the plots are waited for, for the log. (String)
+    """
+    if not os.path.isdir(plot_spool_dir):
+        return
+    logger.info('Waiting for the deferred plots to be rendered {}.'.format(reason))
+    consume_plot_spool(config,config_raw,logger,idle_timeout=0.)
+
+# Native flag plots
+def queue_flag_plots(msfile,fields,plot_name,logger,flag_version=None):
+    """
+    Adds the flag plots of an MS (amplitude vs frequency and vs time, unflagged and flagged, for each field, observation and SPW)
+    to the queue of QA plots. They are all made from one pass through the MS by flag_plots.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    fields = Names of the fields to plot. (List of Strings)
+    plot_name = Root of the plot file names. (String)
+    flag_version = Flag version holding the flags to plot, if the plots are deferred. (String)
+    """
+    logger.info('Queueing flag plots: {}_*.png'.format(plot_name))
+    plot_queue.append({'flag_plots': {'vis': msfile, 'fields': fields, 'plot_name': plot_name, 'flag_version': flag_version}})
+
+def flag_plot_calls(job,meta):
+    """
+    Returns the plotms calls equivalent to a set of flag plots (used if matplotlib is not available).
+    
+    Input:
+    job = The flag plots, see queue_flag_plots. (Dictionary)
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    """
+    calls = []
+    for field in job['fields']:
+        for i in range(meta['nobservations']):
+            for spw in meta['field_spws'][field]:
+                plot_file = job['plot_name']+'_'+field
+                calls.append({'vis': job['vis'], 'xaxis': 'freq', 'yaxis': 'amp', 'field': field, 'plotfile': plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw),
+                              'customflaggedsymbol': True, 'spw': str(spw), 'observation': str(i), 'averagedata': True, 'avgtime': '60',
+                              'expformat': 'png', 'overwrite': True, 'showgui': False})
+                calls.append({'vis': job['vis'], 'xaxis': 'time', 'yaxis': 'amp', 'field': field, 'plotfile': plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw),
+                              'customflaggedsymbol': True, 'spw': str(spw), 'observation': str(i), 'averagedata': True, 'avgchannel': '5',
+                              'expformat': 'png', 'overwrite': True, 'showgui': False})
+    return calls
+
+def flag_plot_grids(msfile,fields,meta,flag_version=None,time_bin=60.,chunk_bytes=2.5e8):
+    """
+    Reads the DATA and FLAG columns of an MS once, in blocks of rows of at most about 'chunk_bytes', and bins the amplitudes of the unflagged
+    and flagged data by channel and by time (averaged over baselines and correlations) for each field, observation and SPW.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    fields = Names of the fields to include. (List of Strings)
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    flag_version = Read the flags from this flag version instead of the MS. (String)
+    time_bin = Width of the time bins in s. (Float)
+    chunk_bytes = Approximate memory used by each block of rows. (Float)
+    
+    Output:
+    grids = For each (field, observation, SPW): the sums and counts of the unflagged ('good') and flagged ('bad') amplitudes and the maximum
+            unflagged amplitude by channel ('chan_') and by time bin ('time_'), and the start time of the observation. (Dictionary)
+    """
+    field_ids = [i for i in range(len(meta['fields'])) if meta['fields'][i] in fields]
+    grids = {}
+    if len(field_ids) == 0:
+        return grids
+    tb_tool = get_tool('tb')
+    tb_tool.open(msfile+'/DATA_DESCRIPTION')
+    dd_spws = tb_tool.getcol('SPECTRAL_WINDOW_ID')
+    tb_tool.close()
+    cache = {}
+    tb_tool.open(msfile)
+    for ddid in range(len(dd_spws)):
+        spw = int(dd_spws[ddid])
+        nchan = meta['spws'][spw]['nchan']
+        selection = tb_tool.query('DATA_DESC_ID=={0} AND FIELD_ID IN [{1}]'.format(ddid,','.join([str(i) for i in field_ids])))
+        nrows = selection.nrows()
+        if nrows == 0:
+            selection.close()
+            continue
+        npol = selection.getcell('DATA',0).shape[0]
+        if flag_version is not None:
+            ms_rows = numpy.array(selection.rownumbers())
+        chunk = max(1,int(chunk_bytes/(npol*nchan*10)))
+        for start in range(0,nrows,chunk):
+            nrow = min(chunk,nrows-start)
+            amp = numpy.abs(selection.getcol('DATA',start,nrow))
+            if flag_version is None:
+                flags = selection.getcol('FLAG',start,nrow)
+            else:
+                flags = version_flags(msfile,flag_version,ddid,ms_rows[start:start+nrow],cache)
+            row_fields = selection.getcol('FIELD_ID',start,nrow)
+            row_obs = selection.getcol('OBSERVATION_ID',start,nrow)
+            row_times = selection.getcol('TIME',start,nrow)
+            good_amp = numpy.where(flags,0.,amp)
+            bad_amp = numpy.where(flags,amp,0.)
+            for field_id, obs in set(zip(row_fields.tolist(),row_obs.tolist())):
+                rows = numpy.where((row_fields == field_id) & (row_obs == obs))[0]
+                key = (meta['fields'][field_id],obs,spw)
+                t_start = meta['obs_time_ranges'][obs][0]
+                if key not in grids:
+                    ntime = int(numpy.ceil((meta['obs_time_ranges'][obs][1]-t_start)/time_bin))+1
+                    grids[key] = {'t_start': t_start, 'time_bin': time_bin}
+                    for axis, nbin in [('chan',nchan),('time',ntime)]:
+                        for name in ['good_sum','good_n','bad_sum','bad_n','good_max']:
+                            grids[key][axis+'_'+name] = numpy.zeros(nbin)
+                grid = grids[key]
+                good = good_amp[:,:,rows]
+                bad = bad_amp[:,:,rows]
+                nbad = numpy.sum(flags[:,:,rows],axis=0)
+                grid['chan_good_sum'] += numpy.sum(good,axis=(0,2))
+                grid['chan_bad_sum'] += numpy.sum(bad,axis=(0,2))
+                grid['chan_bad_n'] += numpy.sum(nbad,axis=1)
+                grid['chan_good_n'] += npol*len(rows)-numpy.sum(nbad,axis=1)
+                grid['chan_good_max'] = numpy.maximum(grid['chan_good_max'],numpy.max(good,axis=(0,2)))
+                bins = numpy.clip(((row_times[rows]-t_start)/time_bin).astype(int),0,len(grid['time_good_n'])-1)
+                ntime = len(grid['time_good_n'])
+                row_bad = numpy.sum(nbad,axis=0)
+                grid['time_good_sum'] += numpy.bincount(bins,weights=numpy.sum(good,axis=(0,1)),minlength=ntime)
+                grid['time_bad_sum'] += numpy.bincount(bins,weights=numpy.sum(bad,axis=(0,1)),minlength=ntime)
+                grid['time_bad_n'] += numpy.bincount(bins,weights=row_bad,minlength=ntime)
+                grid['time_good_n'] += numpy.bincount(bins,weights=npol*nchan-row_bad,minlength=ntime)
+                numpy.maximum.at(grid['time_good_max'],bins,numpy.max(good,axis=(0,1)))
+        selection.close()
+    tb_tool.close()
+    return grids
+
+def write_flag_plot(plot_file,x,xlabel,grid,axis,title):
+    """
+    Writes a flag plot: the mean unflagged and flagged amplitudes (and the maximum unflagged amplitude) and the flagged fraction along one axis.
+    
+    Input:
+    plot_file = Path of the PNG. (String)
+    x = Values of the bins along the axis. (Array)
+    xlabel = Label of the axis. (String)
+    grid = The binned amplitudes, from flag_plot_grids. (Dictionary)
+    axis = 'chan' or 'time'. (String)
+    title = Title of the plot. (String)
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    good_n = grid[axis+'_good_n']
+    bad_n = grid[axis+'_bad_n']
+    with numpy.errstate(invalid='ignore',divide='ignore'):
+        good_mean = numpy.where(good_n > 0,grid[axis+'_good_sum']/good_n,numpy.nan)
+        bad_mean = numpy.where(bad_n > 0,grid[axis+'_bad_sum']/bad_n,numpy.nan)
+        bad_frac = numpy.where(good_n+bad_n > 0,100.*bad_n/(good_n+bad_n),numpy.nan)
+    good_max = numpy.where(good_n > 0,grid[axis+'_good_max'],numpy.nan)
+    fig, (ax_amp, ax_frac) = plt.subplots(2,1,sharex=True,figsize=(10,7),gridspec_kw={'height_ratios': [3,1]})
+    ax_amp.plot(x,good_max,color='0.7',lw=0.8,label='Unflagged (max)')
+    ax_amp.plot(x,bad_mean,'.',color='red',ms=3,label='Flagged (mean)')
+    ax_amp.plot(x,good_mean,'.',color='blue',ms=3,label='Unflagged (mean)')
+    ax_amp.set_ylabel('Amplitude')
+    ax_amp.set_title(title)
+    ax_amp.legend(loc='upper right',fontsize='small')
+    ax_frac.plot(x,bad_frac,color='black',lw=0.8)
+    ax_frac.set_ylim(-2,102)
+    ax_frac.set_ylabel('Flagged (%)')
+    ax_frac.set_xlabel(xlabel)
+    fig.tight_layout()
+    fig.savefig(plot_file,dpi=100)
+    plt.close(fig)
+
+def flag_plots(job,config,logger,flag_version=None):
+    """
+    Makes the flag plots queued by queue_flag_plots with matplotlib, from one pass through the MS (see flag_plot_grids).
+    There is a plot against frequency and one against time for each field, observation and SPW.
+    
+    Input:
+    job = The flag plots, see queue_flag_plots. (Dictionary)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    flag_version = Read the flags from this flag version instead of the MS. (String)
+    
+    Output:
+    done = False if matplotlib is not available (nothing is plotted). (Boolean)
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        logger.warning('matplotlib is not available. The flag plots will be made with plotms.')
+        return False
+    meta = ms_metadata(job['vis'],logger)
+    if flag_version is not None and not has_flag_version(job['vis'],flag_version):
+        logger.warning('Flag version {} not found. The current flags will be plotted.'.format(flag_version))
+        flag_version = None
+    logger.info('Reading the data and flags of {} for the flag plots.'.format(job['vis']))
+    with task_profile('flag_plots(vis={!r})'.format(job['vis']),config,logger):
+        grids = flag_plot_grids(job['vis'],job['fields'],meta,flag_version=flag_version)
+        for field, obs, spw in sorted(grids.keys()):
+            grid = grids[(field,obs,spw)]
+            plot_file = job['plot_name']+'_'+field
+            title = '{0}, observation {1}, SPW {2}'.format(field,obs,spw)
+            logger.info('Plotting amplitude vs frequency to {}'.format(plot_file+'_freq_ob{0}_spw{1}.png'.format(obs,spw)))
+            write_flag_plot(plot_file+'_freq_ob{0}_spw{1}.png'.format(obs,spw),numpy.array(meta['spws'][spw]['chan_freqs'])/1e9,
+                            'Frequency (GHz)',grid,'chan',title)
+            logger.info('Plotting amplitude vs time to {}'.format(plot_file+'_time_ob{0}_spw{1}.png'.format(obs,spw)))
+            hours = grid['time_bin']*numpy.arange(len(grid['time_good_n']))/3600.
+            write_flag_plot(plot_file+'_time_ob{0}_spw{1}.png'.format(obs,spw),hours,
+                            'Time since {} (h)'.format(time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(grid['t_start']-3506716800.))),grid,'time',title)
+    return True
+
+# Flag statistics
+def flag_stats(msfile,meta,time_bin=60.,chunk_bytes=2.5e8):
+    """
+    Counts the flagged and total visibilities of an MS by SPW, field, antenna, scan and time bin (separately and jointly), reading only
+    the FLAG column (and the row indices) in blocks of rows of at most about 'chunk_bytes'.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    time_bin = Width of the time bins in s. (Float)
+    chunk_bytes = Approximate memory used by each block of rows. (Float)
+    
+    Output:
+    stats = 'flagged' and 'total' counts, and [flagged, total] for each 'spw', 'field', 'antenna' and 'scan' (by name or number)
+            and for each time bin ('time': start time, bin width and counts). The joint counts are in 'cells', as
+            [field, spw, antenna, scan, time bin, flagged, total] (each row counts for both of its antennas). (Dictionary)
+    """
+    nfield = len(meta['fields'])
+    nant = len(meta['antennas'])
+    t_start = min([time_range[0] for time_range in meta['obs_time_ranges']])
+    t_end = max([time_range[1] for time_range in meta['obs_time_ranges']])
+    ntime = int(numpy.ceil((t_end-t_start)/time_bin))+1
+    nscan = max([scan['scan'] for scan in meta['scans']])+1
+    counts = {}
+    for axis, nbin in [('field',nfield),('antenna',nant),('scan',nscan),('time',ntime)]:
+        counts[axis] = numpy.zeros((2,nbin))
+    counts['spw'] = numpy.zeros((2,len(meta['spws'])))
+    cells = []
+    tb_tool = get_tool('tb')
+    tb_tool.open(msfile+'/DATA_DESCRIPTION')
+    dd_spws = tb_tool.getcol('SPECTRAL_WINDOW_ID')
+    tb_tool.close()
+    tb_tool.open(msfile)
+    for ddid in range(len(dd_spws)):
+        spw = int(dd_spws[ddid])
+        selection = tb_tool.query('DATA_DESC_ID=={}'.format(ddid))
+        nrows = selection.nrows()
+        if nrows == 0:
+            selection.close()
+            continue
+        shape = selection.getcell('FLAG',0).shape
+        chunk = max(1,int(chunk_bytes/(shape[0]*shape[1])))
+        cell_keys, cell_flagged, cell_total = [], [], []
+        for start in range(0,nrows,chunk):
+            nrow = min(chunk,nrows-start)
+            flagged = numpy.sum(selection.getcol('FLAG',start,nrow),axis=(0,1)).astype(float)
+            total = numpy.ones(nrow)*shape[0]*shape[1]
+            bins = {'field': selection.getcol('FIELD_ID',start,nrow),
+                    'scan': selection.getcol('SCAN_NUMBER',start,nrow),
+                    'time': numpy.clip(((selection.getcol('TIME',start,nrow)-t_start)/time_bin).astype(int),0,ntime-1)}
+            for axis in bins.keys():
+                nbin = counts[axis].shape[1]
+                counts[axis][0] += numpy.bincount(bins[axis],weights=flagged,minlength=nbin)[:nbin]
+                counts[axis][1] += numpy.bincount(bins[axis],weights=total,minlength=nbin)[:nbin]
+            for column in ['ANTENNA1','ANTENNA2']:
+                antennas = selection.getcol(column,start,nrow)
+                counts['antenna'][0] += numpy.bincount(antennas,weights=flagged,minlength=nant)[:nant]
+                counts['antenna'][1] += numpy.bincount(antennas,weights=total,minlength=nant)[:nant]
+                keys = ((bins['field'].astype(numpy.int64)*nscan+bins['scan'])*ntime+bins['time'])*nant+antennas
+                keys, inverse = numpy.unique(keys,return_inverse=True)
+                cell_keys.append(keys)
+                cell_flagged.append(numpy.bincount(inverse,weights=flagged))
+                cell_total.append(numpy.bincount(inverse,weights=total))
+            counts['spw'][0][spw] += numpy.sum(flagged)
+            counts['spw'][1][spw] += numpy.sum(total)
+        selection.close()
+        keys, inverse = numpy.unique(numpy.concatenate(cell_keys),return_inverse=True)
+        cell_flagged = numpy.bincount(inverse,weights=numpy.concatenate(cell_flagged))
+        cell_total = numpy.bincount(inverse,weights=numpy.concatenate(cell_total))
+        for key, nflag, ntotal in zip(keys.tolist(),cell_flagged.tolist(),cell_total.tolist()):
+            key, ant = divmod(key,nant)
+            key, tbin = divmod(key,ntime)
+            field, scan = divmod(key,nscan)
+            cells.append([meta['fields'][field],spw,meta['antennas'][ant],scan,tbin,nflag,ntotal])
+    tb_tool.close()
+    stats = {'flagged': float(numpy.sum(counts['spw'][0])), 'total': float(numpy.sum(counts['spw'][1]))}
+    names = {'spw': [str(spw) for spw in range(len(meta['spws']))], 'field': meta['fields'], 'antenna': meta['antennas'],
+             'scan': [str(scan) for scan in range(nscan)]}
+    for axis in names.keys():
+        stats[axis] = collections.OrderedDict()
+        for i in range(len(names[axis])):
+            if counts[axis][1][i] > 0:
+                if names[axis][i] in stats[axis]:
+                    stats[axis][names[axis][i]][0] += float(counts[axis][0][i])
+                    stats[axis][names[axis][i]][1] += float(counts[axis][1][i])
+                else:
+                    stats[axis][names[axis][i]] = [float(counts[axis][0][i]),float(counts[axis][1][i])]
+    stats['time'] = {'start': t_start, 'bin': time_bin, 'counts': counts['time'].T.tolist()}
+    stats['cells'] = cells
+    return stats
+
+def flag_stats_diff(old,new):
+    """
+    Returns the change in the flagged fraction between two sets of flag statistics (of the same MS), overall and for each SPW, field,
+    antenna, scan and time bin. Nothing is read from the MS.
+    
+    Input:
+    old = Earlier statistics, from flag_stats. (Dictionary)
+    new = Later statistics, from flag_stats. (Dictionary)
+    
+    Output:
+    diff = Change in the flagged fraction ('total' and for each entry of each axis). (Dictionary)
+    """
+    def fraction(counts):
+        return counts[0]/counts[1] if counts[1] > 0 else 0.
+    diff = {'total': fraction([new['flagged'],new['total']])-fraction([old['flagged'],old['total']])}
+    for axis in ['spw','field','antenna','scan']:
+        diff[axis] = collections.OrderedDict()
+        for key in new[axis].keys():
+            diff[axis][key] = fraction(new[axis][key])-fraction(old[axis].get(key,[0.,0.]))
+    diff['time'] = [fraction(new_counts)-fraction(old_counts) for new_counts, old_counts in zip(new['time']['counts'],old['time']['counts'])]
+    return diff
+
+def flag_db_path(config,config_raw):
+    """
+    Returns the path of the flag statistics database: 'flag_db' in the global section of the parameters file, or the environment variable
+    FLAG_STATS_DB (set by batch_pipeline.py so that all the projects of a batch share one database), or summary/flagstats.sqlite.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    if config_raw.has_option('global','flag_db'):
+        return config['global']['flag_db']
+    return os.environ.get('FLAG_STATS_DB','./summary/flagstats.sqlite')
+
+def open_flag_db(db_file):
+    """
+    Opens (creating it if needed) the flag statistics database. The 'versions' table has one row per project, MS and flag version, and the
+    'counts' table the flagged and total visibilities of that version by field, SPW, antenna, scan and time bin (see flag_stats).
+    
+    Input:
+    db_file = Path of the database. (String)
+    
+    Output:
+    db = Connection to the database. (sqlite3.Connection)
+    """
+    if os.path.dirname(db_file) != '' and not os.path.isdir(os.path.dirname(db_file)):
+        os.makedirs(os.path.dirname(db_file))
+    db = sqlite3.connect(db_file,timeout=300.)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, project TEXT, ms TEXT, version TEXT, created TEXT,
+                                             time_start REAL, time_bin REAL, ntime INTEGER, flagged REAL, total REAL,
+                                             UNIQUE (project, ms, version));
+        CREATE TABLE IF NOT EXISTS counts (version_id INTEGER REFERENCES versions(id), field TEXT, spw INTEGER, antenna TEXT,
+                                           scan INTEGER, time_bin INTEGER, flagged REAL, total REAL);
+        CREATE INDEX IF NOT EXISTS counts_version ON counts (version_id);
+        CREATE INDEX IF NOT EXISTS counts_antenna ON counts (antenna, version_id);
+        CREATE INDEX IF NOT EXISTS counts_field ON counts (field, version_id);
+        """)
+    return db
+
+def store_flag_stats(db_file,project,msfile,version,stats):
+    """
+    Writes the statistics of a flag version (from flag_stats) to the flag statistics database, replacing any earlier ones of the same
+    project, MS and version.
+    
+    Input:
+    db_file = Path of the database. (String)
+    project = Project name. (String)
+    msfile = Name of the MS. (String)
+    version = Name of the flag version. (String)
+    stats = The statistics, from flag_stats. (Dictionary)
+    """
+    db = open_flag_db(db_file)
+    with db:
+        for row in db.execute('SELECT id FROM versions WHERE project=? AND ms=? AND version=?',(project,msfile,version)).fetchall():
+            db.execute('DELETE FROM counts WHERE version_id=?',row)
+            db.execute('DELETE FROM versions WHERE id=?',row)
+        cursor = db.execute('INSERT INTO versions (project, ms, version, created, time_start, time_bin, ntime, flagged, total) VALUES (?,?,?,?,?,?,?,?,?)',
+                            (project,msfile,version,time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime()),stats['time']['start'],stats['time']['bin'],
+                             len(stats['time']['counts']),stats['flagged'],stats['total']))
+        db.executemany('INSERT INTO counts (version_id, field, spw, antenna, scan, time_bin, flagged, total) VALUES (?,?,?,?,?,?,?,?)',
+                       [[cursor.lastrowid]+cell for cell in stats['cells']])
+    db.close()
+
+def load_flag_stats(db_file,project,msfile,version):
+    """
+    Reads the statistics of a flag version from the flag statistics database, in the form returned by flag_stats (without the joint counts).
+    Returns None if the version is not in the database.
+    
+    Input:
+    db_file = Path of the database. (String)
+    project = Project name. (String)
+    msfile = Name of the MS. (String)
+    version = Name of the flag version. (String)
+    """
+    if not os.path.isfile(db_file):
+        return None
+    db = open_flag_db(db_file)
+    row = db.execute('SELECT id, time_start, time_bin, ntime, flagged, total FROM versions WHERE project=? AND ms=? AND version=?',
+                     (project,msfile,version)).fetchone()
+    if row is None:
+        db.close()
+        return None
+    version_id, t_start, time_bin, ntime, flagged, total = row
+    stats = {'flagged': flagged, 'total': total}
+    #Every row is counted once for each of its two antennas, so the counts by any other axis are halved
+    for axis, column, scale in [('spw','spw',0.5),('field','field',0.5),('antenna','antenna',1.),('scan','scan',0.5)]:
+        stats[axis] = collections.OrderedDict()
+        query = 'SELECT {0}, SUM(flagged), SUM(total) FROM counts WHERE version_id=? GROUP BY {0} ORDER BY {0}'.format(column)
+        for key, nflag, ntotal in db.execute(query,(version_id,)):
+            stats[axis][plain_strings(key) if isinstance(key,unicode) else str(key)] = [scale*nflag,scale*ntotal]
+    time_counts = [[0.,0.] for i in range(ntime)]
+    for tbin, nflag, ntotal in db.execute('SELECT time_bin, SUM(flagged), SUM(total) FROM counts WHERE version_id=? GROUP BY time_bin',(version_id,)):
+        time_counts[tbin] = [0.5*nflag,0.5*ntotal]
+    stats['time'] = {'start': t_start, 'bin': time_bin, 'counts': time_counts}
+    db.close()
+    return stats
+
+# Flag version store
+def flag_store(msfile):
+    """
+    Returns the directory holding the flag versions of an MS (<msfile>.flagdeltas).
+    """
+    return msfile.rstrip('/')+'.flagdeltas/'
+
+def read_flag_store(msfile):
+    """
+    Returns the index of the flag version store of an MS (see save_flag_version), or None if there is no store.
+    """
+    index_file = flag_store(msfile)+'versions.json'
+    if not os.path.isfile(index_file):
+        return None
+    f = open(index_file,'r')
+    store = plain_strings(json.load(f))
+    f.close()
+    return store
+
+def write_flag_store(msfile,store):
+    """
+    Writes the index of the flag version store of an MS.
+    """
+    index_file = flag_store(msfile)+'versions.json'
+    f = open(index_file+'.tmp','w')
+    json.dump(store,f)
+    f.close()
+    os.rename(index_file+'.tmp',index_file)
+
+def flag_table_stamp(msfile):
+    """
+    Returns the sizes and modification times of the files of the main table of an MS (and of its sub-MSs), which change whenever a column
+    such as FLAG is written. It tells whether the flags are still those last saved or restored.
+    """
+    msfile = msfile.rstrip('/')
+    dirs = [msfile]
+    subms_dir = os.path.join(msfile,'SUBMSS')
+    if os.path.isdir(subms_dir):
+        dirs.extend([os.path.join(subms_dir,name) for name in sorted(os.listdir(subms_dir))])
+    stamp = []
+    for table in dirs:
+        for name in sorted(os.listdir(table)):
+            path = os.path.join(table,name)
+            if os.path.isfile(path) and name != 'table.lock':
+                stat = os.stat(path)
+                stamp.append([os.path.relpath(path,msfile),stat.st_size,round(stat.st_mtime,6)])
+    return stamp
+
+def flag_runs(rows):
+    """
+    Run-length encodes an increasing array of indices as the starts and lengths of its runs of consecutive values.
+    """
+    if len(rows) == 0:
+        return numpy.zeros(0,dtype=int), numpy.zeros(0,dtype=int)
+    breaks = numpy.where(numpy.diff(rows) != 1)[0]+1
+    starts = numpy.concatenate([[0],breaks])
+    ends = numpy.concatenate([breaks,[len(rows)]])
+    return rows[starts], ends-starts
+
+def expand_runs(starts,lengths):
+    """
+    Returns the indices encoded by flag_runs.
+    """
+    if len(starts) == 0:
+        return numpy.zeros(0,dtype=int)
+    return numpy.concatenate([numpy.arange(start,start+length) for start, length in zip(starts,lengths)])
+
+def stored_flags(msfile,store,name,ddid,k):
+    """
+    Returns the flags of one block of rows of a data description in a saved flag version: the base flags with the changes of the version applied.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    store = Index of the flag version store, from read_flag_store. (Dictionary)
+    name = Name of the flag version. (String)
+    ddid = Data description ID. (Integer)
+    k = Number of the block of rows. (Integer)
+    
+    Output:
+    flags = Flags of the block (correlation x channel x row). (Boolean array)
+    """
+    info = store['ddids'][str(ddid)]
+    nrow = min(info['chunk'],info['nrows']-k*info['chunk'])
+    shape = (info['shape'][0],info['shape'][1],nrow)
+    base = numpy.load(flag_store(msfile)+'{0}.d{1}.c{2}.npz'.format(store['base'],ddid,k))
+    flags = numpy.unpackbits(base['bits'])[:numpy.prod(shape)].reshape(shape).astype(bool)
+    delta_file = flag_store(msfile)+'{0}.d{1}.c{2}.npz'.format(name,ddid,k)
+    if name != store['base'] and os.path.isfile(delta_file):
+        delta = numpy.load(delta_file)
+        rows = expand_runs(delta['starts'],delta['lengths'])
+        delta_shape = (shape[0],shape[1],len(rows))
+        flags[:,:,rows] ^= numpy.unpackbits(delta['bits'])[:numpy.prod(delta_shape)].reshape(delta_shape).astype(bool)
+    return flags
+
+def save_flag_version(msfile,name,logger,chunk_bytes=2.5e8):
+    """
+    Saves the current flags of an MS as a flag version (in place of flagmanager). The first version saved is the base and is stored in full
+    (bit-packed and compressed). Every later version only stores the rows whose flags differ from the base, as run-length encoded row numbers
+    and the bit-packed differences of their flags. The FLAG column is read once, in blocks of rows of each data description.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    chunk_bytes = Approximate memory used by each block of rows. (Float)
+    """
+    store = read_flag_store(msfile)
+    if store is not None and name in store['versions']:
+        delete_flag_version(msfile,name,logger)
+        store = read_flag_store(msfile)
+    tb_tool = get_tool('tb')
+    tb_tool.open(msfile+'/DATA_DESCRIPTION')
+    nddid = tb_tool.nrows()
+    tb_tool.close()
+    if store is None:
+        makedir(flag_store(msfile),logger)
+        store = {'base': name, 'versions': [], 'ddids': {}}
+    nbytes = 0
+    nchanged = 0
+    tb_tool.open(msfile)
+    for ddid in range(nddid):
+        selection = tb_tool.query('DATA_DESC_ID=={}'.format(ddid))
+        nrows = selection.nrows()
+        if str(ddid) not in store['ddids']:
+            if nrows > 0:
+                shape = list(selection.getcell('FLAG',0).shape)
+                store['ddids'][str(ddid)] = {'nrows': nrows, 'shape': shape, 'chunk': max(1,int(chunk_bytes/(shape[0]*shape[1])))}
+                numpy.save(flag_store(msfile)+'rows.d{}.npy'.format(ddid),numpy.array(selection.rownumbers()))
+        elif store['ddids'][str(ddid)]['nrows'] != nrows:
+            selection.close()
+            tb_tool.close()
+            raise RuntimeError('{0} has changed since its flag versions were saved. Remove {1} to start again.'.format(msfile,flag_store(msfile)))
+        if nrows == 0:
+            selection.close()
+            continue
+        info = store['ddids'][str(ddid)]
+        for k in range(int(numpy.ceil(float(nrows)/info['chunk']))):
+            flags = selection.getcol('FLAG',k*info['chunk'],min(info['chunk'],nrows-k*info['chunk']))
+            out_file = flag_store(msfile)+'{0}.d{1}.c{2}.npz'.format(name,ddid,k)
+            if name == store['base']:
+                numpy.savez_compressed(out_file,bits=numpy.packbits(flags.ravel()))
+            else:
+                diff = flags != stored_flags(msfile,store,store['base'],ddid,k)
+                rows = numpy.where(diff.any(axis=(0,1)))[0]
+                if len(rows) == 0:
+                    continue
+                starts, lengths = flag_runs(rows)
+                numpy.savez_compressed(out_file,starts=starts,lengths=lengths,bits=numpy.packbits(diff[:,:,rows].ravel()))
+                nchanged += len(rows)
+            nbytes += os.path.getsize(out_file)
+        selection.close()
+    tb_tool.close()
+    store['versions'].append(name)
+    store['head'] = {'version': name, 'stamp': flag_table_stamp(msfile)}
+    write_flag_store(msfile,store)
+    if name == store['base']:
+        logger.info('Saved flag version {0} as the base of {1} ({2:.1f} MB).'.format(name,flag_store(msfile),nbytes/1e6))
+    else:
+        logger.info('Saved flag version {0}: {1} rows differ from {2} ({3:.1f} MB).'.format(name,nchanged,store['base'],nbytes/1e6))
+
+def restore_flag_version(msfile,name,logger):
+    """
+    Restores a flag version saved by save_flag_version, writing only the (runs of) rows whose flags differ from the current ones.
+    If the MS has not been written since a version was last saved or restored, the current flags are known from the store and the FLAG column
+    is not read at all.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    """
+    store = read_flag_store(msfile)
+    if store is None or name not in store['versions']:
+        raise RuntimeError('Flag version {0} of {1} not found.'.format(name,msfile))
+    head = store.get('head')
+    if head is not None and (head['version'] not in store['versions'] or head['stamp'] != flag_table_stamp(msfile)):
+        head = None
+    if head is not None and head['version'] == name:
+        logger.info('The flags of {0} are already those of version {1}.'.format(msfile,name))
+        return
+    nchanged = 0
+    tb_tool = get_tool('tb')
+    tb_tool.open(msfile,nomodify=False)
+    for ddid in sorted(store['ddids'].keys(),key=int):
+        info = store['ddids'][ddid]
+        selection = tb_tool.query('DATA_DESC_ID=={}'.format(ddid))
+        if selection.nrows() != info['nrows']:
+            selection.close()
+            tb_tool.close()
+            raise RuntimeError('{0} has changed since its flag versions were saved. Remove {1} to start again.'.format(msfile,flag_store(msfile)))
+        for k in range(int(numpy.ceil(float(info['nrows'])/info['chunk']))):
+            start = k*info['chunk']
+            flags = stored_flags(msfile,store,name,int(ddid),k)
+            if head is None:
+                current = selection.getcol('FLAG',start,flags.shape[2])
+            else:
+                current = stored_flags(msfile,store,head['version'],int(ddid),k)
+            rows = numpy.where((flags != current).any(axis=(0,1)))[0]
+            starts, lengths = flag_runs(rows)
+            for run_start, length in zip(starts,lengths):
+                selection.putcol('FLAG',flags[:,:,run_start:run_start+length],start+int(run_start),int(length))
+                selection.putcol('FLAG_ROW',flags[:,:,run_start:run_start+length].all(axis=(0,1)),start+int(run_start),int(length))
+            nchanged += len(rows)
+        selection.close()
+    tb_tool.close()
+    store['head'] = {'version': name, 'stamp': flag_table_stamp(msfile)}
+    write_flag_store(msfile,store)
+    logger.info('Restored flag version {0}: rewrote the flags of {1} rows.'.format(name,nchanged))
+
+def delete_flag_version(msfile,name,logger):
+    """
+    Deletes a flag version saved by save_flag_version. Deleting the base version deletes the whole store.
+    """
+    store = read_flag_store(msfile)
+    if store is None or name not in store['versions']:
+        return
+    if name == store['base']:
+        rmdir(flag_store(msfile).rstrip('/'),logger)
+        return
+    for path in glob.glob(flag_store(msfile)+'{}.d*.npz'.format(name)):
+        os.remove(path)
+    store['versions'].remove(name)
+    if store.get('head') is not None and store['head']['version'] == name:
+        store['head'] = None
+    write_flag_store(msfile,store)
+
+def has_flag_version(msfile,name):
+    """
+    Returns whether a flag version has been saved by save_flag_version.
+    """
+    store = read_flag_store(msfile)
+    return store is not None and name in store['versions']
+
+def version_flags(msfile,name,ddid,rows,cache):
+    """
+    Returns the flags of some rows of an MS (all of one data description) in a saved flag version.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    ddid = Data description ID of the rows. (Integer)
+    rows = Row numbers in the MS. (List/Array of Integers)
+    cache = Dictionary kept by the caller between calls, so that each block of the store is only decoded once when reading in order. (Dictionary)
+    
+    Output:
+    flags = Flags of the rows (correlation x channel x row). (Boolean array)
+    """
+    if 'store' not in cache:
+        cache['store'] = read_flag_store(msfile)
+    store = cache['store']
+    info = store['ddids'][str(ddid)]
+    if ('rows',ddid) not in cache:
+        cache[('rows',ddid)] = numpy.load(flag_store(msfile)+'rows.d{}.npy'.format(ddid))
+    positions = numpy.searchsorted(cache[('rows',ddid)],numpy.array(rows))
+    blocks = positions//info['chunk']
+    flags = numpy.zeros((info['shape'][0],info['shape'][1],len(positions)),dtype=bool)
+    for k in numpy.unique(blocks):
+        if cache.get('block') != (ddid,k):
+            cache['flags'] = stored_flags(msfile,store,name,ddid,k)
+            cache['block'] = (ddid,k)
+        inx = numpy.where(blocks == k)[0]
+        flags[:,:,inx] = cache['flags'][:,:,positions[inx]-k*info['chunk']]
+    return flags
+
+# Manual flag lists
+mjd_unix_offset = 3506716800. # Seconds from the MJD epoch (1858/11/17) to the Unix epoch
+flag_pair = re.compile(r"""(\w+)\s*=\s*('[^']*'|"[^"]*"|[^\s'"]+)""") # A parameter of a command in list format (key=value)
+flag_list_keys = ['antenna','scan','spw','field','correlation'] # Selections a manual flag is split over before its time ranges are merged
+
+def parse_flag_command(line):
+    """
+    Parses a flagdata command in list format (e.g. "mode='manual' antenna='ea01' timerange='...'") into a dictionary of its parameters.
+    Returns None if the line cannot be parsed.
+    """
+    command = collections.OrderedDict()
+    pairs = flag_pair.findall(line)
+    if len(pairs) == 0 or flag_pair.sub('',line).strip() != '':
+        return None
+    for key, value in pairs:
+        try:
+            command[key] = literal_eval(value)
+        except (ValueError,SyntaxError):
+            command[key] = value
+    return command
+
+def flag_time(text,day=None):
+    """
+    Converts a time of a flagdata timerange ('YYYY/MM/DD/hh:mm:ss' or, if the day is given, 'hh:mm:ss') to MJD seconds.
+    Returns None for any other form.
+    
+    Input:
+    text = The time. (String)
+    day = Date of a time without one, as 'YYYY/MM/DD'. (String)
+    
+    Output:
+    time = MJD seconds. (Float)
+    day = Date of the time. (String)
+    """
+    match = re.match(r'^(\d{4}/\d{1,2}/\d{1,2})/(\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?$',text.strip())
+    if match is None and day is not None:
+        match = re.match(r'^()(\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?$',text.strip())
+    if match is None:
+        return None, None
+    date = match.group(1) if match.group(1) != '' else day
+    year, month, mday = [int(value) for value in date.split('/')]
+    seconds = float(match.group(4)) if match.group(4) is not None else 0.
+    unix = calendar.timegm((year,month,mday,int(match.group(2)),int(match.group(3)),0,0,0,0))+seconds
+    return unix+mjd_unix_offset, date
+
+def flag_time_text(mjd):
+    """
+    Returns an MJD time in seconds in the format of a flagdata timerange ('YYYY/MM/DD/hh:mm:ss.s').
+    """
+    mjd = round(mjd,3)
+    stamp = datetime.datetime.utcfromtimestamp(int(numpy.floor(mjd))-mjd_unix_offset)
+    seconds = ('{:06.3f}'.format(stamp.second+mjd-numpy.floor(mjd))).rstrip('0').rstrip('.')
+    return stamp.strftime('%Y/%m/%d/%H:%M:')+seconds
+
+def flag_selection(key,value,meta):
+    """
+    Splits the selection of a manual flag (antenna, scan, spw, field or correlation) into its items, validated against the MS metadata.
+    Returns None if the selection uses syntax the compiler does not handle (e.g. baselines, negation, channels or wildcards), in which case
+    the command is passed on unchanged.
+    
+    Output:
+    items = Valid items (antenna and field names, scan and SPW numbers as strings, correlations). (List of Strings)
+    invalid = Items not found in the MS. (List of Strings)
+    """
+    items = [item.strip() for item in str(value).split(',') if item.strip() != '']
+    if len(items) == 0 or any([char in item for item in items for char in '&!*<>:^ ']):
+        return None
+    valid = []
+    invalid = []
+    for item in items:
+        if key == 'antenna':
+            if item in meta['antennas']:
+                valid.append(item)
+            elif item.isdigit() and int(item) < len(meta['antennas']):
+                valid.append(meta['antennas'][int(item)])
+            else:
+                invalid.append(item)
+        elif key == 'field':
+            if item in meta['fields']:
+                valid.append(item)
+            elif item.isdigit() and int(item) < len(meta['fields']):
+                valid.append(meta['fields'][int(item)])
+            else:
+                invalid.append(item)
+        elif key in ['scan','spw']:
+            bounds = item.split('~')
+            if not all([bound.isdigit() for bound in bounds]) or len(bounds) > 2:
+                return None
+            known = [str(scan['scan']) for scan in meta['scans']] if key == 'scan' else [str(spw) for spw in range(len(meta['spws']))]
+            for number in range(int(bounds[0]),int(bounds[-1])+1):
+                if str(number) in known:
+                    valid.append(str(number))
+                elif len(bounds) == 1:
+                    invalid.append(item)
+        else:
+            valid.append(item.upper())
+    return sorted(set(valid)), invalid
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping or adjacent time intervals. Returns the sorted, disjoint intervals.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1],end)
+        else:
+            merged.append([start,end])
+    return merged
+
+def compile_flag_list(lines,meta,logger):
+    """
+    Compiles a hand-written list of flagdata commands into a minimal equivalent list. The manual flags are validated against the MS metadata
+    (unknown antennas, fields, scans and SPWs are dropped, as are time ranges outside the observations) and split into one entry per antenna,
+    scan, SPW, field and correlation. The time ranges of each entry are merged where they overlap or touch, ranges covered by a wider entry
+    (e.g. one for all antennas) are dropped, and the entries are regrouped into as few commands as possible, sorted by time. Each command
+    keeps the reasons of the commands merged into it, so they are recorded in the flag command history.
+    Commands in any other mode, with other parameters or with selection syntax the compiler does not handle are kept as they are (once each).
+    
+    Input:
+    lines = Flagging commands in list format. (List of Strings)
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    
+    Output:
+    commands = The compiled commands, the passed on commands first. (List of Strings)
+    """
+    t_start = min([time_range[0] for time_range in meta['obs_time_ranges']])
+    t_end = max([time_range[1] for time_range in meta['obs_time_ranges']])
+    passed = []
+    entries = collections.defaultdict(list)
+    reasons = collections.defaultdict(list)
+    for line in lines:
+        command = parse_flag_command(line)
+        if command is None or command.get('mode','manual') != 'manual' or any([key not in flag_list_keys+['mode','timerange','reason'] for key in command]):
+            if line not in passed:
+                passed.append(line)
+            continue
+        selections = []
+        for key in flag_list_keys:
+            if key not in command or str(command[key]).strip() == '':
+                selections.append(['*'])
+                continue
+            selection = flag_selection(key,command[key],meta)
+            if selection is None:
+                break
+            items, invalid = selection
+            if len(invalid) > 0:
+                logger.warning('Manual flag "{0}": {1} {2} not found in the MS.'.format(line,key,','.join(invalid)))
+            selections.append(items)
+        if len(selections) < len(flag_list_keys):
+            if line not in passed:
+                passed.append(line)
+            continue
+        if any([len(items) == 0 for items in selections]):
+            logger.warning('Manual flag "{}" selects no data and is dropped.'.format(line))
+            continue
+        interval = [t_start,t_end]
+        if str(command.get('timerange','')).strip() != '':
+            bounds = str(command['timerange']).split('~')
+            start, day = flag_time(bounds[0])
+            end = flag_time(bounds[-1],day)[0] if len(bounds) == 2 else None
+            if start is None or end is None:
+                if line not in passed:
+                    passed.append(line)
+                continue
+            if end < t_start or start > t_end:
+                logger.warning('Manual flag "{}" is outside the observations and is dropped.'.format(line))
+                continue
+            interval = [start,end]
+        for antenna in selections[0]:
+            for scan in selections[1]:
+                for spw in selections[2]:
+                    for field in selections[3]:
+                        for corr in selections[4]:
+                            entries[(antenna,scan,spw,field,corr)].append(interval)
+                            reasons[(antenna,scan,spw,field,corr)].append((interval,str(command.get('reason','')).strip()))
+    for key in entries:
+        entries[key] = merge_intervals(entries[key])
+    def reason(key,interval):
+        #The reasons of all the commands merged into an interval
+        merged = []
+        for (start, end), text in reasons[key]:
+            if text != '' and text not in merged and start <= interval[1] and end >= interval[0]:
+                merged.append(text)
+        return '; '.join(merged)
+    #Drop the intervals covered by an entry that is wider in at least one selection (all antennas, all scans, etc.)
+    wider = {}
+    for key in entries:
+        covering = []
+        for other in entries:
+            if other != key and all([other[i] == '*' or other[i] == key[i] for i in range(len(key))]):
+                covering.extend(entries[other])
+        covering = merge_intervals(covering)
+        wider[key] = [interval for interval in entries[key] if not any([cover[0] <= interval[0] and interval[1] <= cover[1] for cover in covering])]
+    #Regroup: first the antennas with the same interval, reason and other selections, then the scans
+    groups = collections.defaultdict(set)
+    for key in wider:
+        for interval in wider[key]:
+            groups[(key[1],key[2],key[3],key[4],tuple(interval),reason(key,interval))].add(key[0])
+    regrouped = collections.defaultdict(set)
+    for (scan, spw, field, corr, interval, text), antennas in groups.items():
+        regrouped[(tuple(sorted(antennas)),spw,field,corr,interval,text)].add(scan)
+    compiled = []
+    for (antennas, spw, field, corr, interval, text), scans in regrouped.items():
+        command = "mode='manual'"
+        if interval[0] > t_start or interval[1] < t_end:
+            command += " timerange='{0}~{1}'".format(flag_time_text(interval[0]),flag_time_text(interval[1]))
+        for key, items in [('antenna',list(antennas)),('scan',sorted(scans,key=lambda scan: int(scan) if scan != '*' else -1)),
+                           ('spw',[spw]),('field',[field]),('correlation',[corr])]:
+            if '*' not in items:
+                command += " {0}='{1}'".format(key,','.join(items))
+        if text != '':
+            command += " reason='{}'".format(text)
+        compiled.append((interval,command))
+    compiled = [command for interval, command in sorted(compiled)]
+    logger.info('Compiled {0} manual flagging commands into {1} ({2} passed on unchanged).'.format(len(lines),len(compiled)+len(passed),len(passed)))
+    return passed+compiled
@@ -2,6 +2,7 @@ import imp, glob, shutil, numpy
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
 
+@cf.profile_step
 def contsub(msfile,config,config_raw,config_file,logger):
     """
     Subtracts the continuum from each of the science target MSs.
@@ -97,6 +98,8 @@ def contsub(msfile,config,config_raw,config_file,logger):
     for i in range(len(targets)):
         target = targets[i]
         field = fields[i]
+        if target_sel is not None and target != target_sel:
+            continue
         if calib['mosaic']:
             for target_name in targets:
                 inx = [j for j in range(len(calib['target_names'])) if target_name in calib['target_names'][j]]
@@ -114,20 +117,20 @@ def contsub(msfile,config,config_raw,config_file,logger):
             order = int(contsub['fitorder'])
         else:
             order = int(contsub['fitorder'][i])
-        command = "uvcontsub(vis='{0}{1}'+'.split', field='{2}', fitspw='{3}', spw='{4}', excludechans=False, combine='spw', solint='int', fitorder={5}, want_cont={6})".format(src_dir,target,field,chans,','.join(spws),order,contsub['save_cont'])
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        cf.run_task('uvcontsub',config,config_raw,logger,vis=src_dir+target+'.split',field=field,fitspw=chans,spw=','.join(spws),excludechans=False,
+                    combine='spw',solint='int',fitorder=order,want_cont=contsub['save_cont'])
     logger.info('Completed continuum subtraction.')
     
 
 
-def plot_spec(config,logger,contsub=False):
+def plot_spec(config,config_raw,logger,contsub=False):
     """
     For each SPW and each science target amplitude vs channel and amplitude vs velocity are plotted.
     
     Input:
     config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    contsub = Plot the continuum subtracted data. (Boolean)
     """
     logger.info('Starting plotting amplitude spectrum.')
     plots_obs_dir = './plots/'
@@ -138,6 +141,8 @@ def plot_spec(config,logger,contsub=False):
         targets = list(set(calib['target_names']))
     src_dir = config['global']['src_dir']+'/'
     for target in targets:
+        if target_sel is not None and target != target_sel:
+            continue
         if contsub:
             MS_list = glob.glob('{0}{1}.split.contsub'.format(src_dir,target))
         else:
@@ -148,18 +153,20 @@ def plot_spec(config,logger,contsub=False):
             else:
                 plot_file = plots_obs_dir+'{0}_amp_chn.png'.format(target)
             logger.info('Plotting amplitude vs channel to {}'.format(plot_file))
-            plotms(vis=MS, xaxis='chan', yaxis='amp',
-                   ydatacolumn='corrected', plotfile=plot_file,
-                   expformat='png', overwrite=True, showgui=False)
+            cf.queue_plot(logger,vis=MS, xaxis='chan', yaxis='amp',
+                                 ydatacolumn='corrected', plotfile=plot_file,
+                                 expformat='png', overwrite=True, showgui=False)
             if not contsub:
                 plot_file = plots_obs_dir+'{0}_amp_vel.png'.format(target)
                 logger.info('Plotting amplitude vs velocity to {}'.format(plot_file))
-                plotms(vis=MS, xaxis='velocity', yaxis='amp',
-                       ydatacolumn='corrected', plotfile=plot_file,
-                       expformat='png', overwrite=True, showgui=False,
-                       freqframe='BARY', restfreq=str(config['global']['rest_freq']), veldef='OPTICAL')
+                cf.queue_plot(logger,vis=MS, xaxis='velocity', yaxis='amp',
+                                     ydatacolumn='corrected', plotfile=plot_file,
+                                     expformat='png', overwrite=True, showgui=False,
+                                     freqframe='BARY', restfreq=str(config['global']['rest_freq']), veldef='OPTICAL')
+    cf.render_plots(config,config_raw,logger)
     logger.info('Completed plotting amplitude spectrum.')
             
+@cf.profile_step
 def dirty_image(config,config_raw,config_file,logger):
     """
     Generates a dirty (continuum subtracted) image of each science target.
@@ -191,6 +198,8 @@ def dirty_image(config,config_raw,config_file,logger):
     cf.makedir('./'+img_dir,logger)
     logger.info('Removing any existing dirty images.')
     for target in targets:
+        if target_sel is not None and target != target_sel:
+            continue
         del_list = glob.glob(img_dir+'{}.dirty*'.format(target))
         for file_path in del_list:
             logger.info('Deleting: '+file_path)
@@ -309,6 +318,8 @@ def dirty_image(config,config_raw,config_file,logger):
     for i in range(len(targets)):
         target = targets[i]
         field = fields[i]
+        if target_sel is not None and target != target_sel:
+            continue
         gridder = 'wproject'
         if calib['mosaic']:
             for target_name in targets:
@@ -317,18 +328,23 @@ def dirty_image(config,config_raw,config_file,logger):
             field = ','.join(fields)
             gridder = 'mosaic'
         logger.info('Making dirty image of {} (line only).'.format(target))
-        command = "tclean(vis='{0}{1}'+'.split.contsub', field='{2}', imagename='{3}{1}'+'.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, restoringbeam='common', niter=0, phasecenter='{9}', interactive=False)".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'])
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        im_size = int(cln_param['im_size'][i])
+        cf.run_task('tclean',config,config_raw,logger,vis=src_dir+target+'.split.contsub',field=field,imagename=img_dir+target+'.dirty',
+                    cell=cln_param['pix_size'][i],imsize=[im_size,im_size],specmode='cube',outframe='bary',veltype='radio',restfreq=rest_freq,
+                    gridder=gridder,wprojplanes=-1,pblimit=0.1,normtype='flatnoise',deconvolver='hogbom',weighting='briggs',
+                    robust=cln_param['robust'],restoringbeam='common',niter=0,phasecenter=cln_param['phasecenter'],interactive=False)
                 
     logger.info('Completed making dirty image.')
     
     
-# Read configuration file with parameters
-config_file = sys.argv[-1]
+# Read configuration file with parameters (and optionally the single target to image)
+script_args = cf.get_script_args()
+config_file = script_args[0]
 config,config_raw = cf.read_config(config_file)
 interactive = config['global']['interactive']
+target_sel = None
+if len(script_args) > 1:
+    target_sel = script_args[1]
 
 # Set up your logger
 logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['project_name']),
@@ -339,12 +355,14 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 #Contsub
 cf.check_casaversion(logger)
-plot_spec(config,logger)
+plot_spec(config,config_raw,logger)
 contsub(msfile,config,config_raw,config_file,logger)
-plot_spec(config,logger,contsub=True)
+plot_spec(config,config_raw,logger,contsub=True)
 
 #Remove previous dirty images
 targets = config['calibration']['target_names']
+if target_sel is not None:
+    targets = [target_sel]
 for target in targets:
     del_list = glob.glob(config['global']['img_dir']+'/'+'{}.dirty.*'.format(target))
     if len(del_list) > 0:
@@ -355,6 +373,10 @@ for target in targets:
 #Make dirty image
 dirty_image(config,config_raw,config_file,logger)
 
-#Review and backup parameters file
-cf.diff_pipeline_params(config_file,logger)
-cf.backup_pipeline_params(config_file,logger)
\ No newline at end of file
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
+
+#Review and backup parameters file (the runs for single targets run at once, so the pipeline backs up the file after all of them)
+if target_sel is None:
+    cf.diff_pipeline_params(config_file,logger)
+    cf.backup_pipeline_params(config_file,logger)
\ No newline at end of file
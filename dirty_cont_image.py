@@ -2,6 +2,7 @@ import imp, glob, numpy
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
 
+@cf.profile_step
 def dirty_cont_image(config,config_raw,config_file,logger):
     """
     Generates a dirty image of each science target including the continuum emission.
@@ -31,7 +32,10 @@ def dirty_cont_image(config,config_raw,config_file,logger):
     img_dir = config['global']['img_dir']+'/'
     cf.makedir('/.'+img_dir,logger)
     logger.info('Removing any existing dirty continuum images.')
-    del_list = glob.glob(img_dir+'*cont.dirty*')
+    if target_sel is None:
+        del_list = glob.glob(img_dir+'*cont.dirty*')
+    else:
+        del_list = glob.glob(img_dir+'{}.cont.dirty*'.format(target_sel))
     for file_path in del_list:
         logger.info('Deleting: '+file_path)
         shutil.rmtree(file_path)
@@ -112,6 +116,8 @@ def dirty_cont_image(config,config_raw,config_file,logger):
     for i in range(len(targets)):
         target = targets[i]
         field = fields[i]
+        if target_sel is not None and target != target_sel:
+            continue
         gridder = 'wproject'
         if calib['mosaic']:
             for target_name in targets:
@@ -120,17 +126,22 @@ def dirty_cont_image(config,config_raw,config_file,logger):
             field = ','.join(fields)
             gridder = 'mosaic'
         logger.info('Making dirty image of {} (inc. continuum).'.format(target))
-        command = "tclean(vis='{0}{1}.split', field='{2}', imagename='{3}{1}.cont.dirty', cell='{4}', imsize=[{5},{5}], specmode='cube', outframe='bary', veltype='radio', restfreq='{6}', gridder='{7}', wprojplanes=-1, pblimit=0.1, normtype='flatnoise', deconvolver='hogbom', weighting='briggs', robust={8}, niter=0, phasecenter='{9}', interactive=False)".format(src_dir,target,field,img_dir,cln_param['pix_size'][i],cln_param['im_size'][i],rest_freq,gridder,cln_param['robust'],cln_param['phasecenter'])
-        logger.info('Executing command: '+command)
-        exec(command)  
-        cf.check_casalog(config,config_raw,logger,casalog)
+        im_size = int(cln_param['im_size'][i])
+        cf.run_task('tclean',config,config_raw,logger,vis=src_dir+target+'.split',field=field,imagename=img_dir+target+'.cont.dirty',
+                    cell=cln_param['pix_size'][i],imsize=[im_size,im_size],specmode='cube',outframe='bary',veltype='radio',restfreq=rest_freq,
+                    gridder=gridder,wprojplanes=-1,pblimit=0.1,normtype='flatnoise',deconvolver='hogbom',weighting='briggs',
+                    robust=cln_param['robust'],niter=0,phasecenter=cln_param['phasecenter'],interactive=False)
     logger.info('Completed making dirty continuum image.')
 
     
-# Read configuration file with parameters
-config_file = sys.argv[-1]
+# Read configuration file with parameters (and optionally the single target to image)
+script_args = cf.get_script_args()
+config_file = script_args[0]
 config,config_raw = cf.read_config(config_file)
 interactive = config['global']['interactive']
+target_sel = None
+if len(script_args) > 1:
+    target_sel = script_args[1]
 
 # Set up your logger
 logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['project_name']),
@@ -141,9 +152,16 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 #Make dirty continuum image
 cf.check_casaversion(logger)
-cf.rmdir(config['global']['img_dir'],logger)
+if target_sel is None:
+    cf.rmdir(config['global']['img_dir'],logger)
+else:
+    logger.info('Only imaging target: {}'.format(target_sel))
 dirty_cont_image(config,config_raw,config_file,logger)
 
-#Review and backup parameters file
-cf.diff_pipeline_params(config_file,logger)
-cf.backup_pipeline_params(config_file,logger)
\ No newline at end of file
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
+
+#Review and backup parameters file (the runs for single targets run at once, so the pipeline backs up the file after all of them)
+if target_sel is None:
+    cf.diff_pipeline_params(config_file,logger)
+    cf.backup_pipeline_params(config_file,logger)
\ No newline at end of file
@@ -1,144 +1,256 @@
-import imp, numpy, os
+import imp, numpy, os, json, hashlib, collections, glob
 imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
 
 
-def manual_flags(config, config_raw, logger):
+def flag_command(mode, **kwargs):
     """
-    Apply manual flags from the file 'manual_flags.list'.
+    Returns a flagdata command in list format, e.g. "mode='quack' quackinterval=10.0".
+    
+    Input:
+    mode = Flagging mode. (String)
+    kwargs = Parameters of the mode.
+    """
+    return ' '.join(['mode={!r}'.format(mode)] + ['{0}={1!r}'.format(key,kwargs[key]) for key in sorted(kwargs.keys())])
+
+def manual_flags(msfile, config, config_raw, logger):
+    """
+    Returns the manual flags from the file 'manual_flags.list', compiled into a minimal equivalent list (see compile_flag_list).
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
     """
-    logger.info('Starting manual flagging.')
     if interactive:
         print("\nManual flags from 'manual_flags.list' are about to be applied.")
         print("It is strongly recommended that you inspect the data and modify (and save) 'manual_flags.list' appropriately before proceeding.\n")
         resp = str(raw_input('Do you want to proceed (y/n): '))
         while resp.lower() not in ['yes','ye','y']:
             resp = str(raw_input('Do you want to proceed (y/n): '))
-    logger.info('Applying flags from manual_flags.list')
+    logger.info('Reading flags from manual_flags.list')
+    commands = []
     try:
         flag_file = open('manual_flags.list', 'r')
-        lines = flag_file.readlines()
-        if lines == []:
+        commands = [line.strip() for line in flag_file.readlines() if line.strip() != '' and not line.strip().startswith('#')]
+        flag_file.close()
+        if commands == []:
             logger.warning("The file is empty. Continuing without manual flagging.")
         else:
-            command = "flagdata(vis='{}', mode='list', action='apply', inpfile={})".format(msfile,lines)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            logger.info('Completed manual flagging.')
-        flag_file.close()
+            commands = cf.compile_flag_list(commands,cf.ms_metadata(msfile,logger),logger)
     except IOError:
         logger.warning("'manual_flags.list' does not exist. Continuing without manual flagging.")        
+    return commands
 
-def base_flags(msfile, config, config_raw, logger):
+def base_flags(config):
     """ 
-    Sets basic initial data flags.
+    Returns the commands for the basic initial data flags: shadowed antennae, zero amplitude data and the start of every scan.
     
     Input:
-    msfile = Path to the MS. (String)
     config = The parameters read from the configuration file. (Ordered dictionary)
     """
-    logger.info('Starting basic flagging.')
     flag = config['flagging']
-    tol = flag['shadow_tol'] 
-    quack_int = flag['quack_int']
-    logger.info('Flagging antennae with more than {} m of shadowing.'.format(tol))
-    command = "flagdata(vis='{0}', mode='shadow', tolerance={1}, flagbackup=False)".format(msfile,tol)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Flagging zero amplitude data.')
-    command = "flagdata(vis='{}', mode='clip', clipzeros=True, flagbackup=False)".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Flagging first {} s of every scan.'.format(quack_int))
-    command = "flagdata(vis='{0}', mode='quack', quackinterval={1}, quackmode='beg', flagbackup=False)".format(msfile,quack_int)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed basic flagging.')
+    return [flag_command('shadow',tolerance=flag['shadow_tol']),
+            flag_command('clip',clipzeros=True),
+            flag_command('quack',quackinterval=flag['quack_int'],quackmode='beg')]
 
-def tfcrop(msfile, config, config_raw, logger):
+def tfcrop(config):
     """
-    Runs CASA's TFcrop flagging algorithm.
+    Returns the command for CASA's TFcrop flagging algorithm.
     
     Input:
-    msfile = Path to the MS. (String)
     config = The parameters read from the configuration file. (Ordered dictionary)
     """
     flag = config['flagging']
-    logger.info('Starting running TFCrop.')
-    command = "flagdata(vis='{0}', mode='tfcrop', action='apply', display='', timecutoff={1}, freqcutoff={2}, flagbackup=False)".format(msfile,flag['timecutoff'],flag['freqcutoff'])
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed running TFCrop.')
+    return [flag_command('tfcrop',timecutoff=flag['timecutoff'],freqcutoff=flag['freqcutoff'])]
+
+def rflag(config, datacolumn='corrected'):
+    """
+    Returns the command for CASA's rflag flagging algorithm (run on the corrected data).
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    datacolumn = Column holding the corrected data ('data' in an MS split with the calibration applied). (String)
+    """
+    thresh = config['flagging']['rthresh']
+    return [flag_command('rflag',datacolumn=datacolumn,freqdevscale=thresh,timedevscale=thresh)]
+
+def extend_flags():
+    """
+    Returns the commands that extend the existing flags, first to all polarizations and then in time and frequency.
+    """
+    return [flag_command('extend',extendpols=True),
+            flag_command('extend',growtime=75.0,growfreq=90.0)]
+
+def rfi_engine(config, config_raw, logger):
+    """
+    Returns the engine used for the automatic RFI flagging: 'casa' (tfcrop and rflag) or 'numpy' (the built-in flagger in rfi_flagger.py),
+    set by 'rfi_engine' in the flagging section of the parameters file.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    engine = 'casa'
+    if config_raw.has_option('flagging','rfi_engine'):
+        engine = config['flagging']['rfi_engine']
+    if engine not in ['casa','numpy']:
+        logger.warning("Unknown rfi_engine '{}'. CASA's tfcrop and rflag will be used.".format(engine))
+        engine = 'casa'
+    return engine
 
-def rflag(msfile, config, config_raw, logger):
+@cf.profile_step
+def rfi_flags(msfile, column, time_thresh, freq_thresh, config, config_raw, logger):
     """
-    Runs CASA's rflag flagging algorithm.
+    Flags RFI with the built-in flagger (see rfi_flagger.py) in place of tfcrop (on the data) or rflag (on the corrected data).
     
     Input:
     msfile = Path to the MS. (String)
+    column = Data column to flag. (String)
+    time_thresh = Threshold along time, in robust standard deviations. (Float)
+    freq_thresh = Threshold along frequency, in robust standard deviations. (Float)
     config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
     """
-    flag = config['flagging']
-    thresh = flag['rthresh']
-    logger.info('Starting running rflag with a threshold of {}.'.format(thresh))
-    command = "flagdata(vis='{0}', mode='rflag', action='apply', datacolumn='corrected', freqdevscale={1}, timedevscale={1}, display='', flagbackup=False)".format(msfile,thresh)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed running rflag.')
+    #Only loaded when the built-in flagger is selected, so the CASA modes do not need rfi_flagger.py
+    imp.load_source('rfi_flagger','rfi_flagger.py')
+    import rfi_flagger
+    rfi_flagger.flag_ms(msfile,column,time_thresh,freq_thresh,config,config_raw,logger)
+    logger.info('Completed RFI flagging.')
+
+def corrected_flags(msfile, config, config_raw, logger, datacolumn='corrected'):
+    """
+    Flags RFI in the corrected data (with rflag or the built-in flagger) and then extends the flags.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    datacolumn = Column holding the corrected data ('data' in an MS split with the calibration applied). (String)
+    """
+    if rfi_engine(config,config_raw,logger) == 'numpy':
+        rthresh = config['flagging']['rthresh']
+        rfi_flags(msfile,{'corrected': 'CORRECTED_DATA', 'data': 'DATA'}[datacolumn],rthresh,rthresh,config,config_raw,logger)
+        apply_flags(msfile,extend_flags(),config,config_raw,logger)
+    else:
+        apply_flags(msfile,rflag(config,datacolumn)+extend_flags(),config,config_raw,logger)
+
+def rflag_calibrators(msfile, config, config_raw, logger):
+    """
+    Flags the corrected data of the calibrators when the calibration is applied on the fly (see otf_calibration): they are copied with the
+    calibration applied (see calibrated_view), flagged with corrected_flags and their flags written back to the MS.
+    The targets are flagged after they are split (see split_fields), as their split data are already calibrated.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    calib = config['calibration']
+    calfields = []
+    for field in calib['fluxcal']+calib['bandcal']+calib['phasecal']:
+        if field not in calfields:
+            calfields.append(field)
+    view = './cal_tabs/rflag_view.ms'
+    rows = calibrated_view(msfile,calfields,view,config,config_raw,logger)
+    corrected_flags(view,config,config_raw,logger)
+    logger.info('Writing the flags of {} back to the MS.'.format(', '.join(calfields)))
+    cf.merge_snapshot_flags(view,msfile,rows)
+    remove_view(view,logger)
 
-def extend_flags(msfile, config, config_raw,  logger):
+@cf.profile_step
+def apply_flags(msfile, commands, config, config_raw, logger):
     """
-    Extends existing flags.
+    Applies a list of flagging commands with a single flagdata call in list mode. The commands are applied in order to each chunk of data
+    (so e.g. tfcrop sees the flags of the shadow, clip and quack commands before it, and extend sees those of rflag) but the MS is only read once.
     
     Input:
     msfile = Path to the MS. (String)
+    commands = Flagging commands in list format, in the order they should be applied. (List of Strings)
+    config = The parameters read from the configuration file. (Ordered dictionary)
     """
-    flag_version = 'extended'
-    logger.info('Starting extending existing flags.')
-    command = "flagdata(vis='{}', mode='extend', spw='', extendpols=True, action='apply', display='', flagbackup=False)".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    command = "flagdata(vis='{}', mode='extend', spw='', growtime=75.0, growfreq=90.0, action='apply', display='', flagbackup=False)".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed extending existing flags.')
+    if len(commands) == 0:
+        return
+    logger.info('Applying {} flagging commands in one pass:'.format(len(commands)))
+    for command in commands:
+        logger.info('> {}'.format(command))
+    cf.run_task('flagdata',config,config_raw,logger,vis=msfile,mode='list',inpfile=commands,action='apply',display='',flagbackup=False)
+    logger.info('Completed flagging.')
 
-def flag_sum(msfile,name,logger):
+def flag_sum(msfile,name,config,config_raw,logger,previous=None):
     """
-    Writes a summary of the current flags to file.
+    Writes a summary of the current flags to file, with the change since a previous flag version.
+    The statistics (by SPW, field, antenna, scan and time) come from one scan of the FLAG column and are stored in the flag statistics
+    database (see flag_db_path). The summary, and the comparison with the previous version, are made from the database.
     
     Input:
     msfile = Path to the MS. (String)
     name = Root of filename where flags summary will be saved. (String) 
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    previous = Name of the previous flag version summarised. (String)
     """
     sum_dir = './summary/'
     cf.makedir(sum_dir,logger)
-    out_file = sum_dir+'{0}.{1}flags.summary'.format(msfile,name)
+    out_file = sum_dir+'{0}.{1}flags.summary'.format(os.path.basename(msfile),name)
     logger.info('Starting writing flag summary to: {}.'.format(out_file))
-    flag_info = flagdata(vis=msfile, mode='summary')
+    db_file = cf.flag_db_path(config,config_raw)
+    project = config['global']['project_name']
+    with cf.task_profile('flag_stats(vis={!r})'.format(msfile),config,logger):
+        cf.store_flag_stats(db_file,project,msfile,name,cf.flag_stats(msfile,cf.ms_metadata(msfile,logger)))
+    logger.info('Flag statistics of version {0} stored in {1}.'.format(name,db_file))
+    flag_info = cf.load_flag_stats(db_file,project,msfile,name)
+    diff = None
+    if previous is not None:
+        previous_info = cf.load_flag_stats(db_file,project,msfile,previous)
+        if previous_info is not None:
+            diff = cf.flag_stats_diff(previous_info,flag_info)
+    def change(axis,key=None):
+        if diff is None:
+            return ''
+        if key is None:
+            return ' ({0:+.2%} since {1})'.format(diff[axis],previous)
+        return ' ({:+.2%})'.format(diff[axis][key])
     out_file = open(out_file, 'w')
-    out_file.write('Total flagged data: {:.2%}\n\n'.format(flag_info['flagged']/flag_info['total']))
-    logger.info('Total flagged data: {:.2%}'.format(flag_info['flagged']/flag_info['total']))
-    out_file.write('Flagging per spectral window\n')
-    for spw in flag_info['spw'].keys():
-        out_file.write('SPW {0}: {1:.2%}\n'.format(spw,flag_info['spw'][spw]['flagged']/flag_info['spw'][spw]['total']))
-    out_file.write('\nFlagging per field\n')
-    for field in flag_info['field'].keys():
-        out_file.write('{0}: {1:.2%}\n'.format(field,flag_info['field'][field]['flagged']/flag_info['field'][field]['total']))
-    out_file.write('\nFlagging per antenna\n')
-    for ant in flag_info['antenna'].keys():
-        out_file.write('{0}: {1:.2%}\n'.format(ant,flag_info['antenna'][ant]['flagged']/flag_info['antenna'][ant]['total']))
+    out_file.write('Total flagged data: {0:.2%}{1}\n\n'.format(flag_info['flagged']/flag_info['total'],change('total')))
+    logger.info('Total flagged data: {0:.2%}{1}'.format(flag_info['flagged']/flag_info['total'],change('total')))
+    for axis, title in [('spw','spectral window'),('field','field'),('antenna','antenna'),('scan','scan')]:
+        out_file.write('Flagging per {}\n'.format(title))
+        for key in flag_info[axis].keys():
+            label = 'SPW {}'.format(key) if axis == 'spw' else key
+            if axis == 'scan':
+                label = 'Scan {}'.format(key)
+            out_file.write('{0}: {1:.2%}{2}\n'.format(label,flag_info[axis][key][0]/flag_info[axis][key][1],change(axis,key)))
+        out_file.write('\n')
     out_file.close()
     logger.info('Completed writing flag summary.')
     
+def resume_flag_sum(msfile,name,config,config_raw,logger,previous=None,final=False,plots=False):
+    """
+    Writes the flag summary of a flag version kept from a valid checkpoint if its statistics are not in the flag statistics database
+    (e.g. 'flag_db' now points to a new database) or the summary file is missing, and queues its flag plots if there are none.
+    Unless it is the final version (the current flags) it is restored first, so the MS must be restored to its checkpoint afterwards.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    name = Name of the flag version. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    previous = Name of the previous flag version summarised. (String)
+    final = The version holds the current flags. (Boolean)
+    plots = Also check the flag plots of the version. (Boolean)
+    """
+    if plots and len(glob.glob('./plots/flag_plot_{}_*.png'.format(name))) == 0:
+        logger.info('The flag plots of flag version {} are missing.'.format(name))
+        plot_flags(msfile,name,logger,final=final)
+    summary_file = './summary/{0}.{1}flags.summary'.format(os.path.basename(msfile),name)
+    if cf.load_flag_stats(cf.flag_db_path(config,config_raw),config['global']['project_name'],msfile,name) is not None and os.path.isfile(summary_file):
+        return
+    logger.info('The flag summary of flag version {} is missing.'.format(name))
+    if not final:
+        restore_flags(msfile,name,logger)
+    flag_sum(msfile,name,config,config_raw,logger,previous=previous)
+
 def restore_flags(msfile,name,logger):
     """
     Restored the flag version corresponding to the named file.
@@ -148,9 +260,8 @@ def restore_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Restoring flag version from: {}.'.format(name))
-    command = "flagmanager(vis='{0}', mode='restore', versionname='{1}')".format(msfile,name)
-    logger.info('Executing command: '+command)
-    exec(command)
+    with cf.task_profile('restore_flag_version(vis={0!r},versionname={1!r})'.format(msfile,name),config,logger):
+        cf.restore_flag_version(msfile,name,logger)
     logger.info('Completed restoring flag version.')
     
 def save_flags(msfile,name,logger):
@@ -162,9 +273,8 @@ def save_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Saving flag version as: {}.'.format(name))
-    command = "flagmanager(vis='{0}', mode='save', versionname='{1}')".format(msfile,name)
-    logger.info('Executing command: '+command)
-    exec(command)
+    with cf.task_profile('save_flag_version(vis={0!r},versionname={1!r})'.format(msfile,name),config,logger):
+        cf.save_flag_version(msfile,name,logger)
     logger.info('Completed saving flag version.')
     
 def rm_flags(msfile,name,logger):
@@ -176,18 +286,19 @@ def rm_flags(msfile,name,logger):
     name = Root of filename for the flag version. (String) 
     """
     logger.info('Removing flag version: {}.'.format(name))
-    command = "flagmanager(vis='{0}', mode='delete', versionname='{1}')".format(msfile,name)
-    logger.info('Executing command: '+command)
-    exec(command)
+    with cf.task_profile('delete_flag_version(vis={0!r},versionname={1!r})'.format(msfile,name),config,logger):
+        cf.delete_flag_version(msfile,name,logger)
     logger.info('Completed removing flag version.')
     
-def plot_flags(msfile,name,logger):
+def plot_flags(msfile,name,logger,final=False):
     """
-    Make a plot with flagged and unflagged points coloured differently.
+    Make plots of the flagged and unflagged amplitudes against frequency and time for each field, observation and SPW.
+    The plots are queued and made with the next batch of QA plots (before the flags are next changed) from a single pass through the MS.
     
     Input:
     msfile = Path to the MS. (String)
     name = Root of filename for the flag version. (String)
+    final = The flags will not change again, so deferred plots can read the MS itself rather than the saved flag version. (Boolean)
     """
     logger.info('Making flags plots for flag version: {}'.format(name))
     plots_obs_dir = './plots/'
@@ -201,24 +312,8 @@ def plot_flags(msfile,name,logger):
     fields.extend(calib['phasecal'])
     fields = list(set(fields))
     
-    msmd.open(msfile)
-    nobs = msmd.nobservations()
-    
-    for field in fields:
-        for i in range(nobs):
-            spw_IDs = list(msmd.spwsforfield(field))
-            for spw in spw_IDs:
-                logger.info('Making flags plots for {}.'.format(field))
-                plot_file = plot_name+'_'+field
-                logger.info('Plotting amplitude vs frequency to {}'.format(plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw)))
-                plotms(vis=msfile, xaxis='freq', yaxis='amp', field=field, plotfile=plot_file+'_freq_ob{0}_spw{1}.png'.format(i,spw),
-                       customflaggedsymbol=True, spw=str(spw), observation=str(i),
-                       averagedata=True, avgtime='60', expformat='png', overwrite=True, showgui=False)
-                logger.info('Plotting amplitude vs time to {}'.format(plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw)))
-                plotms(vis=msfile, xaxis='time', yaxis='amp', field=field, plotfile=plot_file+'_time_ob{0}_spw{1}.png'.format(i,spw),
-                       customflaggedsymbol=True, spw=str(spw), observation=str(i),
-                       averagedata=True, avgchannel='5', expformat='png', overwrite=True, showgui=False)
-    msmd.close()
+    flag_version = None if final else name
+    cf.queue_flag_plots(msfile,fields,plot_name,logger,flag_version=flag_version)
     logger.info('Completed flags plots ')
 
 def select_refant(msfile,config,config_raw,config_file,logger):
@@ -233,9 +328,7 @@ def select_refant(msfile,config,config_raw,config_file,logger):
     """
     logger.info('Starting reference antenna selection.')
     calib = config['calibration']
-    tb.open(msfile+'/ANTENNA')
-    ant_names = tb.getcol('NAME')
-    tb.close()
+    ant_names = cf.ms_metadata(msfile,logger)['antennas']
     if calib['refant'] not in ant_names:
         logger.warning('No valid reference antenna set. Requesting user input.')
         first = True
@@ -267,17 +360,14 @@ def set_fields(msfile,config,config_raw,config_file,logger):
     """
     logger.info('Starting set field purposes.')
     calib = config['calibration']
-    tb.open(msfile+'/FIELD')
-    field_names = tb.getcol('NAME')
-    tb.close()
-    tb.open('{}/SPECTRAL_WINDOW'.format(msfile))
-    spw_names = tb.getcol('NAME')
+    meta = cf.ms_metadata(msfile,logger)
+    field_names = numpy.array(meta['fields'])
+    spw_names = numpy.array([spw['name'] for spw in meta['spws']])
     if not config['importdata']['jvla']:
-        spw_IDs = tb.getcol('DOPPLER_ID')
+        spw_IDs = numpy.array(meta['spw_doppler_ids'])
     else:
-        spw_IDs = tb.getcol('FREQ_GROUP')
+        spw_IDs = numpy.array(meta['spw_freq_groups'])
     nspw = len(spw_IDs)
-    tb.close()
     std_flux_mods = ['3C48_L.im', '3C138_L.im', '3C286_L.im', '3C147_L.im']
     std_flux_names = {'0134+329': '3C48_L.im', '0137+331': '3C48_L.im', '3C48': '3C48_L.im', 'J0137+3309': '3C48_L.im',
                       '0518+165': '3C138_L.im', '0521+166': '3C138_L.im', '3C138': '3C138_L.im', 'J0521+1638': '3C138_L.im',
@@ -390,14 +480,9 @@ def set_fields(msfile,config,config_raw,config_file,logger):
     
                 
     if len(calib['targets']) != nspw:
-        msmd.open(msfile)
-        spw_IDs = []
-        for target in calib['targets']:
-            spw_IDs.extend(list(msmd.spwsforfield(target)))
-        spw_IDs = list(set(list(spw_IDs)))
-        spw_names = msmd.namesforspws(spw_IDs)
+        spw_IDs = cf.spws_for_fields(meta,calib['targets'])
+        spw_names = [meta['spws'][spw]['name'] for spw in spw_IDs]
         nspw = len(spw_IDs)
-        msmd.close()
         
     flux_cal_names_bad = False
     for i in range(len(calib['fluxcal'])):
@@ -695,6 +780,7 @@ def set_fields(msfile,config,config_raw,config_file,logger):
 
    
     
+@cf.profile_step
 def calibration(msfile, config, config_raw, logger):
     """
     Runs the basic calibration steps on each SPW based on the intents described in the configuration file.
@@ -714,20 +800,14 @@ def calibration(msfile, config, config_raw, logger):
     calib = config['calibration']
     std_flux_mods = ['3C48_L.im', '3C138_L.im', '3C286_L.im', '3C147_L.im']
     
-    msmd.open(msfile)
-    nobs = msmd.nobservations()
-    spw_IDs = []
-    for target in calib['targets']:
-        spw_IDs.extend(list(msmd.spwsforfield(target)))
-    spw_IDs = list(set(list(spw_IDs)))
-    spw_names = msmd.namesforspws(spw_IDs)
+    meta = cf.ms_metadata(msfile,logger)
+    nobs = meta['nobservations']
+    spw_IDs = cf.spws_for_fields(meta,calib['targets'])
+    spw_names = [meta['spws'][spw]['name'] for spw in spw_IDs]
     nspw = len(spw_IDs)
-    msmd.close()
     
     for i in range(nspw):
-        msmd.open(msfile)
-        spw_fields = msmd.fieldsforspw(spw_IDs[i], asnames=True)
-        msmd.close()
+        spw_fields = meta['spw_fields'][spw_IDs[i]]
         cals_in_spw = list(set(spw_fields).intersection(calib['phasecal']))
         targets_in_spw = list(set(spw_fields).intersection(calib['targets']))
         if len(cals_in_spw) == 0:
@@ -739,10 +819,7 @@ def calibration(msfile, config, config_raw, logger):
     if config['importdata']['jvla']:
         aptab = cal_tabs+'antpos.cal'
         logger.info('Looking up antenna position offsets ({}).'.format(aptab))
-        command = "gencal(vis='{0}', caltable='{1}', caltype='antpos', antenna='')".format(msfile,aptab)
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        cf.run_task('gencal',config,config_raw,logger,vis=msfile,caltable=aptab,caltype='antpos',antenna='')
         if cf.search_casalog('No offsets found for this MS',config,config_raw,logger,casalog):
             aptab = None
             logger.info('No antenna position offsets were found.')
@@ -750,10 +827,7 @@ def calibration(msfile, config, config_raw, logger):
     
     gctab = cal_tabs+'gaincurve.cal'
     logger.info('Calibrating gain vs elevation ({}).'.format(gctab))
-    command = "gencal(vis='{0}', caltable='{1}', caltype='gceff')".format(msfile,gctab)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('gencal',config,config_raw,logger,vis=msfile,caltable=gctab,caltype='gceff')
     
     prev_set = {}
     for i in range(len(calib['fluxcal'])):
@@ -765,15 +839,10 @@ def calibration(msfile, config, config_raw, logger):
                 #Add loop to go over every SPW the flux calibrator is used for.
                 #This way a different flux can be specified in each if necessary.
                 #In practice for the HI line this is unlikely to be an issue.
-                command = "setjy(vis='{0}', field='{1}', scalebychan=True, fluxdensity=[{2},0,0,0], standard='manual')".format(msfile,calib['fluxcal'][i],calib['fluxmod'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
+                cf.run_task('setjy',config,config_raw,logger,vis=msfile,field=calib['fluxcal'][i],scalebychan=True,
+                            fluxdensity=[float(calib['fluxmod'][i]),0,0,0],standard='manual')
             elif calib['fluxmod'][i] in std_flux_mods:
-                command = "setjy(vis='{0}', field='{1}', scalebychan=True, model='{2}')".format(msfile,calib['fluxcal'][i],calib['fluxmod'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
+                cf.run_task('setjy',config,config_raw,logger,vis=msfile,field=calib['fluxcal'][i],scalebychan=True,model=calib['fluxmod'][i])
             else:
                 logger.warning('The flux model cannot be recognised. The setjy task will not be run. Fluxes will be incorrect.')
         elif calib['fluxmod'][i] != calib['fluxmod'][prev_set[calib['fluxcal'][i]]]:
@@ -782,52 +851,40 @@ def calibration(msfile, config, config_raw, logger):
             
     plot_file = plots_obs_dir+'bpphaseint.png'
     logger.info('Plotting bandpass phase vs. time for reference antenna to: {}'.format(plot_file))
-    plotms(vis=msfile, plotfile=plot_file, xaxis='channel', yaxis='phase', field=calib['bandcal'][i], spw = ','.join(numpy.array(spw_IDs,dtype='str')),
-           correlation='RR,LL', avgtime='1E10', antenna=calib['refant'], coloraxis='antenna2', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False, iteraxis='spw')
+    cf.queue_plot(logger,snapshot=True,vis=msfile, plotfile=plot_file, xaxis='channel', yaxis='phase', field=calib['bandcal'][i], spw = ','.join(numpy.array(spw_IDs,dtype='str')),
+                         correlation='RR,LL', avgtime='1E10', antenna=calib['refant'], coloraxis='antenna2', expformat='png', 
+                         overwrite=True, showlegend=False, showgui=False, iteraxis='spw')
     
     dltab = cal_tabs+'delays.cal'
     logger.info('Calibrating delays for bandpass calibrators {0} ({1}).'.format(calib['bandcal'],dltab))
+    pretabs = [gctab]
     if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', gaintype='K', gaintable=['{4}','{5}'], spw='{6}')".format(msfile,','.join(calib['bandcal']),dltab,calib['refant'],aptab,gctab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', gaintype='K', gaintable=['{4}'], spw='{5}')".format(msfile,','.join(calib['bandcal']),dltab,calib['refant'],gctab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+        pretabs = [aptab,gctab]
+    cf.partitioned_solve('gaincal',msfile,dltab,calib['bandcal'],spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         gaintype='K',gaintable=pretabs)
     
     bptab = cal_tabs+'bpphase.gcal'
     logger.info('Make bandpass calibrator phase solutions for {0} ({1}).'.format(calib['bandcal'],bptab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}',  caltable='{2}', refant='{3}', calmode='p', solint='int', combine='', minsnr=2.0, gaintable=['{4}','{5}','{6}'], spw='{7}')".format(msfile,','.join(calib['bandcal']),bptab,calib['refant'],aptab,gctab,dltab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}',  caltable='{2}', refant='{3}', calmode='p', solint='int', combine='', minsnr=2.0, gaintable=['{4}','{5}'], spw='{6}')".format(msfile,','.join(calib['bandcal']),bptab,calib['refant'],gctab,dltab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.partitioned_solve('gaincal',msfile,bptab,calib['bandcal'],spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         calmode='p',solint='int',combine='',minsnr=2.0,gaintable=pretabs+[dltab])
     
     for i in range(nobs):
         plot_file = plots_obs_dir+'bpphasesol_ob{}.png'.format(i)
         logger.info('Plotting bandpass phase solutions to: {}'.format(plot_file))
-        plotms(vis=bptab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
-               plotrange=[0,0,-180,180], expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
+        cf.queue_plot(logger,vis=bptab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
+                             plotrange=[0,0,-180,180], expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                             iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
     
     bstab = cal_tabs+'bandpass.bcal'
     logger.info('Determining bandpass solution(s) ({}).'.format(bstab))
-    if aptab is not None:
-        command = "bandpass(vis='{0}', caltable='{1}', field='{2}', refant='{3}', solint='inf', solnorm=True, gaintable=['{4}', '{5}', '{6}', '{7}'], spw='{8}')".format(msfile,bstab,','.join(calib['bandcal']),calib['refant'],aptab,gctab, dltab, bptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "bandpass(vis='{0}', caltable='{1}', field='{2}', refant='{3}', solint='inf', solnorm=True, gaintable=['{4}', '{5}', '{6}'], spw='{7}')".format(msfile,bstab,','.join(calib['bandcal']),calib['refant'],gctab, dltab, bptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.partitioned_solve('bandpass',msfile,bstab,calib['bandcal'],spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         solint='inf',solnorm=True,gaintable=pretabs+[dltab,bptab])
     
     plot_file = plots_obs_dir+'bandpasssol_.png'
     logger.info('Plotting bandpass amplitude solutions to: {}'.format(plot_file))
-    plotms(vis=bstab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='chan', yaxis='amp',
-           expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-           iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')))
+    cf.queue_plot(logger,vis=bstab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='chan', yaxis='amp',
+                         expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                         iteraxis='antenna', coloraxis='spw', spw=','.join(numpy.array(spw_IDs,dtype='str')))
     
     calfields = []
     calfields.extend(calib['fluxcal'])
@@ -838,54 +895,38 @@ def calibration(msfile, config, config_raw, logger):
     
     iptab = cal_tabs+'intphase.gcal'
     logger.info('Determining integration phase solutions ({}).'.format(iptab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='int', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,iptab,calib['refant'],aptab,gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='int', minsnr=2.0, gaintable=['{4}', '{5}', '{6}'],spw='{7}')".format(msfile,calfields,iptab,calib['refant'],gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.partitioned_solve('gaincal',msfile,iptab,calfields.split(','),spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         calmode='p',solint='int',minsnr=2.0,gaintable=pretabs+[dltab,bstab])
     
     sptab = cal_tabs+'scanphase.gcal'
     logger.info('Determining scan phase solutions ({}).'.format(sptab))
-    if aptab is not None:
-        command = command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,sptab,calib['refant'],aptab,gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='p', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}'],spw='{7}')".format(msfile,calfields,sptab,calib['refant'],gctab, dltab, bstab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.partitioned_solve('gaincal',msfile,sptab,calfields.split(','),spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         calmode='p',solint='inf',minsnr=2.0,gaintable=pretabs+[dltab,bstab])
     
     amtab = cal_tabs+'amp.gcal'
     logger.info('Determining amplitude solutions ({}).'.format(amtab))
-    if aptab is not None:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='ap', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}', '{8}'],spw='{9}')".format(msfile,calfields,amtab,calib['refant'],aptab,gctab, dltab, bstab, iptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    else:
-        command = "gaincal(vis='{0}', field='{1}', caltable='{2}', refant='{3}', calmode='ap', solint='inf', minsnr=2.0, gaintable=['{4}', '{5}', '{6}', '{7}'],spw='{8}')".format(msfile,calfields,amtab,calib['refant'],gctab, dltab, bstab, iptab,','.join(numpy.array(spw_IDs,dtype='str')))
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.partitioned_solve('gaincal',msfile,amtab,calfields.split(','),spw_IDs,config,config_raw,logger,refant=calib['refant'],
+                         calmode='ap',solint='inf',minsnr=2.0,gaintable=pretabs+[dltab,bstab,iptab])
     
     for i in range(nobs):
         plot_file = plots_obs_dir+'phasesol_ob{}.png'.format(i)
         logger.info('Plotting phase solutions to: {}'.format(plot_file))
-        plotms(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
-               expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,-20,20], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
+        cf.queue_plot(logger,vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='phase',
+                             expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                             iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,-20,20], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
 
         plot_file = plots_obs_dir+'ampsol_ob{}.png'.format(i)
         logger.info('Plotting amplitude solutions to: {}'.format(plot_file))
-        plotms(vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='amp',
-               expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
-               iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,0,2], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
+        cf.queue_plot(logger,vis=amtab, plotfile=plot_file, gridrows=3, gridcols=3, xaxis='time', yaxis='amp',
+                             expformat='png', overwrite=True, showlegend=False, showgui=False, exprange='all',
+                             iteraxis='antenna', coloraxis='spw', plotrange=[-1,-1,0,2], spw=','.join(numpy.array(spw_IDs,dtype='str')), observation=str(i))
     
     if len(calfields.split(',')) > len(list(set(calib['fluxcal']))):
         fxtab = cal_tabs+'fluxsol.cal'
         cf.rmdir(fxtab,logger)
         logger.info('Applying flux scale to calibrators ({}).'.format(fxtab))
-        command = "fluxscale(vis='{0}', caltable='{1}', fluxtable='{2}', reference='{3}', incremental=True)".format(msfile,amtab,fxtab,','.join(calib['fluxcal']))
-        logger.info('Executing command: flux_info = '+command)
-        exec('flux_info = '+command)
+        flux_info = cf.run_task('fluxscale',config,config_raw,logger,check=False,vis=msfile,caltable=amtab,fluxtable=fxtab,
+                                reference=','.join(calib['fluxcal']),incremental=True)
 
         out_filename = sum_dir+'{0}.flux.summary'.format(msfile)
         logger.info('Writing calibrator fluxes summary to: {}.'.format(out_filename))
@@ -901,90 +942,323 @@ def calibration(msfile, config, config_raw, logger):
                     out_file.write('\n')
             out_file.close()
     
-    logger.info('Apply all calibrations to bandpass and flux calibrators.')
+    #Render the calibration plots (and any queued flag plots) before applycal changes the flags
+    cf.render_plots(config,config_raw,logger)
+    
+    tables = {'pretabs': pretabs, 'dltab': dltab, 'bstab': bstab, 'iptab': iptab, 'amtab': amtab, 'fxtab': None}
+    if len(calfields.split(',')) > len(list(set(calib['fluxcal']))):
+        tables['fxtab'] = fxtab
+    tables = collapse_tables(msfile,tables,config,config_raw,logger)
+    apply_calibration(msfile,tables,config,config_raw,logger)
+    logger.info('Completed calibration.')
+    return tables
+
+def calibration_map(meta, tables, calib, spw_IDs):
+    """
+    Returns the calibration tables (and the fields of their solutions) to apply to each field and SPW, following the intents in the
+    configuration file. Any collapsed tables in 'tables' replace the tables they were made from. When a field is given more than one mapping (e.g. a phase calibrator that is also a bandpass calibrator)
+    the last one is used, as when the calibration was applied by a sequence of applycal calls.
+    
+    Input:
+    meta = The metadata of the MS, from ms_metadata. (Dictionary)
+    tables = Calibration tables, as returned by calibration(). (Dictionary)
+    calib = The calibration section of the configuration file. (Ordered dictionary)
+    spw_IDs = The SPWs calibrated. (List of Integers)
+    
+    Output:
+    apply_map = [(table, gainfield), ...] for each (field, SPW). (Ordered dictionary)
+    """
+    pretabs = [(table,'') for table in tables['pretabs']]
+    dltab = tables['dltab']
+    bstab = tables['bstab']
+    iptab = tables['iptab']
+    amtab = tables['amtab']
+    fxtab = tables['fxtab']
+    #Collapsed tables (see collapse_tables) replace the tables they were made from
+    collapsed = {}
+    if tables.get('kbtab') is not None:
+        collapsed.update({dltab: tables['kbtab'], bstab: tables['kbtab']})
+    if tables.get('gtab') is not None:
+        collapsed.update({iptab: tables['gtab'], amtab: tables['gtab'], fxtab: tables['gtab']})
+    apply_map = collections.OrderedDict()
+    def assign(field, spws, gaintables):
+        entries = list(pretabs)
+        for table, gainfield in gaintables:
+            entry = (collapsed.get(table,table),gainfield)
+            if table is not None and entry not in entries:
+                entries.append(entry)
+        for spw in spws:
+            apply_map.pop((field,spw),None)
+            apply_map[(field,spw)] = entries
+    def field_spws(field):
+        return [spw for spw in meta['field_spws'].get(field,[]) if spw in spw_IDs]
     for i in range(len(calib['bandcal'])):
-        logger.info('Applying calibration to: {}'.format(calib['bandcal'][i]))
+        field = calib['bandcal'][i]
         if calib['bandcal'][i] == calib['fluxcal'][i]:
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],aptab, gctab, dltab, bstab, iptab, amtab)
-            else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}'], gainfield=['', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],gctab, dltab, bstab, iptab, amtab)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
+            assign(field,field_spws(field),[(dltab,field),(bstab,field),(iptab,field),(amtab,field)])
         else:
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{1}', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab)
-            else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{1}', '{1}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['bandcal'][i],gctab, dltab, bstab, iptab, amtab, fxtab)
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            
-            logger.info('Applying calibration to: {}'.format(calib['fluxcal'][i]))
-            if aptab is not None:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['fluxcal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, calib['bandcal'][i])
+            assign(field,field_spws(field),[(dltab,field),(bstab,field),(iptab,field),(amtab,field),(fxtab,field)])
+            bandcal = field
+            field = calib['fluxcal'][i]
+            assign(field,field_spws(field),[(dltab,bandcal),(bstab,bandcal),(iptab,field),(amtab,field),(fxtab,field)])
+    for i in range(len(calib['targets'])):
+        target = calib['targets'][i]
+        phasecal = calib['phasecal'][i]
+        spws = field_spws(target)
+        bandcals = [calib['bandcal'][spw_IDs.index(spw)] for spw in spws]
+        for bandcal in sorted(set(bandcals)):
+            bandcal_spws = [spw for spw, field in zip(spws,bandcals) if field == bandcal]
+            if not phasecal in calib['fluxcal']:
+                assign(phasecal,[spw for spw in field_spws(phasecal) if spw in bandcal_spws],
+                       [(dltab,bandcal),(bstab,bandcal),(iptab,phasecal),(amtab,phasecal),(fxtab,phasecal)])
+                assign(target,bandcal_spws,[(dltab,bandcal),(bstab,bandcal),(iptab,phasecal),(amtab,phasecal),(fxtab,phasecal)])
             else:
-                command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['fluxcal'][i],gctab, dltab, bstab, iptab, amtab, fxtab, calib['bandcal'][i])
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
-            
+                assign(target,bandcal_spws,[(dltab,bandcal),(bstab,bandcal),(iptab,phasecal),(amtab,phasecal)])
+    return apply_map
+
+def collapse_tables(msfile, tables, config, config_raw, logger, sample_rows=20000):
+    """
+    Collapses the calibration tables that are applied together with the same solution field into fewer tables, so that applycal
+    interpolates fewer tables for every row: the delays are folded into the bandpass (if they are constant over each bandpass solution)
+    and the integration phase, amplitude and flux scale solutions are accumulated into one gain table. The antenna position and gain
+    curve corrections are left as they are. The corrected data of a sample of rows are compared with those of the stacked tables and a
+    collapsed table is only used if they agree (see collapse_tolerance). Only done if 'collapse_tables' is set in the calibration section.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    tables = Calibration tables, as made by calibration(). (Dictionary)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    sample_rows = Approximate number of rows compared. (Integer)
+    
+    Output:
+    tables = The tables, with the collapsed ones ('kbtab' and 'gtab') or None. (Dictionary)
+    """
+    tables['kbtab'] = None
+    tables['gtab'] = None
+    if not config_raw.has_option('calibration','collapse_tables') or not config['calibration']['collapse_tables']:
+        return tables
+    cal_tabs = './cal_tabs/'
+    calib = config['calibration']
+    meta = cf.ms_metadata(msfile,logger)
+    spw_IDs = cf.spws_for_fields(meta,calib['targets'])
+    candidates = collections.OrderedDict()
+    candidates['gtab'] = cal_tabs+'gains.gcal'
+    cf.accumulate_gains(tables['iptab'],tables['amtab'],tables['fxtab'],candidates['gtab'],logger)
+    if cf.fold_delays(tables['dltab'],tables['bstab'],cal_tabs+'delays_bandpass.bcal',logger):
+        candidates['kbtab'] = cal_tabs+'delays_bandpass.bcal'
+    
+    stacked_map = calibration_map(meta,tables,calib,spw_IDs)
+    fields = sorted(set([field for field, spw in stacked_map.keys()]))
+    spws = sorted(set([spw for field, spw in stacked_map.keys()]))
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile+'/DATA_DESCRIPTION')
+    ddids = [str(ddid) for ddid, spw in enumerate(tb_tool.getcol('SPECTRAL_WINDOW_ID')) if spw in spws]
+    tb_tool.close()
+    where = 'FIELD_ID IN [{0}] AND DATA_DESC_ID IN [{1}]'.format(','.join([str(meta['fields'].index(field)) for field in fields]),','.join(ddids))
+    tb_tool.open(msfile)
+    selection = tb_tool.query(where)
+    nrows = selection.nrows()
+    selection.close()
+    tb_tool.close()
+    snapshot = cal_tabs+'collapse_check.ms'
+    cf.rmdir(snapshot,logger)
+    logger.info('Copying a sample of the calibrated data to {} to check the collapsed tables.'.format(snapshot))
+    cf.snapshot_ms(msfile,snapshot,'{0} AND ROWNUMBER()%{1}==0'.format(where,max(1,nrows//sample_rows)))
+    write_callib(stacked_map,cal_tabs+'stacked.callib',logger)
+    #Try all the collapsed tables, then only the delays folded into the bandpass (which is exact)
+    trials = [list(candidates.keys())]
+    if 'kbtab' in candidates:
+        trials.append(['kbtab'])
+    accepted = []
+    for trial in trials:
+        trial_tables = dict(tables)
+        trial_tables.update(dict([(key,candidates[key]) for key in trial]))
+        write_callib(calibration_map(meta,trial_tables,calib,spw_IDs),cal_tabs+'collapsed.callib',logger)
+        diff, flag_diff = cf.compare_corrected(snapshot,[cal_tabs+'stacked.callib',cal_tabs+'collapsed.callib'],','.join(fields),
+                                               ','.join([str(spw) for spw in spws]),config,config_raw,logger)
+        logger.info('Collapsed tables {0}: median difference {1:.2e} and {2:.2%} of flags differ from the stacked tables.'.format(
+            ', '.join([candidates[key] for key in trial]),diff,flag_diff))
+        if diff <= cf.collapse_tolerance and flag_diff <= cf.collapse_tolerance:
+            accepted = trial
+            break
+    for key in candidates.keys():
+        if key in accepted:
+            tables[key] = candidates[key]
+        else:
+            logger.warning('The collapsed table {} does not reproduce the stacked tables and will not be used.'.format(candidates[key]))
+            cf.rmdir(candidates[key],logger)
+    cf.rmdir(snapshot,logger)
+    for callib in ['stacked.callib','collapsed.callib']:
+        cf.rmfile(cal_tabs+callib,logger)
+    return tables
+
+def write_callib(apply_map, callib_file, logger):
+    """
+    Writes a calibration map (from calibration_map) as a CASA cal library file, with as few lines as possible: the fields and SPWs
+    that use the same table with the same gainfield share a line.
+    
+    Input:
+    apply_map = [(table, gainfield), ...] for each (field, SPW). (Ordered dictionary)
+    callib_file = Path of the cal library file. (String)
+    """
+    selections = collections.OrderedDict()
+    for (field, spw), gaintables in apply_map.items():
+        for table, gainfield in gaintables:
+            selections.setdefault((table,gainfield),collections.OrderedDict()).setdefault(field,[]).append(spw)
+    lines = []
+    for (table, gainfield), field_spws in selections.items():
+        #Fields with the same SPWs share a line
+        spw_fields = collections.OrderedDict()
+        for field, spws in field_spws.items():
+            spw_fields.setdefault(tuple(sorted(spws)),[]).append(field)
+        for spws, fields in spw_fields.items():
+            line = "caltable='{0}' field='{1}' spw='{2}' tinterp='linear' calwt=False".format(table,','.join(fields),','.join([str(spw) for spw in spws]))
+            if gainfield != '':
+                line += " fldmap='{}'".format(gainfield)
+            lines.append(line)
+    out_file = open(callib_file,'w')
+    out_file.write('\n'.join(lines)+'\n')
+    out_file.close()
+    logger.info('Wrote cal library {0} ({1} lines):'.format(callib_file,len(lines)))
+    for line in lines:
+        logger.info('> {}'.format(line))
+
+def otf_calibration(config, config_raw):
+    """
+    Returns whether the calibration is applied on the fly as the targets are split, rather than written to the corrected data column of the MS
+    ('otf_calibration' in the calibration section of the parameters file).
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    if config_raw.has_option('calibration','otf_calibration'):
+        return config['calibration']['otf_calibration']
+    return False
+
+def has_corrected(msfile):
+    """
+    Checks whether the MS has a corrected data column.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    """
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile)
+    corrected = 'CORRECTED_DATA' in tb_tool.colnames()
+    tb_tool.close()
+    return corrected
+
+def remove_corrected(msfile, config, config_raw, logger):
+    """
+    Removes the corrected data column of the MS (left by an earlier run), as it is not kept up to date when the calibration is applied on the fly.
+    The deferred plots are waited for first, as the plot consumer may have the MS open.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    if not has_corrected(msfile):
+        return
+    cf.join_plot_consumer(config,config_raw,logger,reason='before the corrected data column is removed')
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile,nomodify=False)
+    logger.info('Removing the corrected data column of {}.'.format(msfile))
+    tb_tool.removecols('CORRECTED_DATA')
+    tb_tool.close()
+
+def calibrated_view(msfile, fields, view, config, config_raw, logger):
+    """
+    Copies the rows of some fields of the MS (see cf.snapshot_ms) and applies the cal library to the copy, so that their corrected data
+    can be plotted or flagged without writing a corrected data column into the whole MS.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    fields = Fields to copy. (List of Strings)
+    view = Path of the copy. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    
+    Output:
+    rows = Rows of the MS that were copied (to write flags back with cf.merge_snapshot_flags). (Array)
+    """
+    meta = cf.ms_metadata(msfile,logger)
+    remove_view(view,logger)
+    logger.info('Copying {0} to {1} and applying the calibration to the copy.'.format(', '.join(fields),view))
+    with cf.task_profile('snapshot_ms(vis={!r})'.format(msfile),config,logger):
+        rows = cf.snapshot_ms(msfile,view,'FIELD_ID IN [{}]'.format(','.join([str(meta['fields'].index(field)) for field in fields])))
+    cf.run_task('applycal',config,config_raw,logger,vis=view,field=','.join(fields),docallib=True,callib=callib_file,flagbackup=False)
+    return rows
+
+def remove_view(view, logger):
+    """
+    Deletes a copy made by calibrated_view (and its metadata cache).
+    """
+    cf.rmdir(view,logger)
+    cf.rmfile(view+'.metadata.json',logger)
+
+def apply_calibration(msfile, tables, config, config_raw, logger):
+    """
+    Applies the calibration tables from a run of the calibration to the calibrators and all science target fields.
+    The tables (and solution fields) for every field and SPW are written to a cal library, so that the corrected data of all the fields
+    are written by a single applycal call. With on-the-fly calibration (see otf_calibration) the corrected data are not written to the MS:
+    the cal library is applied to a copy of the calibrators and to the targets when they are split.
+    
+    Input:
+    msfile = Path to the MS. (String)
+    tables = Calibration tables to apply, as returned by calibration(). (Dictionary)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    plots_obs_dir = './plots/'
+    calib = config['calibration']
+    meta = cf.ms_metadata(msfile,logger)
+    spw_IDs = cf.spws_for_fields(meta,calib['targets'])
+    
+    apply_map = calibration_map(meta,tables,calib,spw_IDs)
+    write_callib(apply_map,callib_file,logger)
+    fields = []
+    for field, spw in apply_map.keys():
+        if field not in fields:
+            fields.append(field)
+    spws = sorted(set([spw for field, spw in apply_map.keys()]))
+    plot_vis = msfile
+    if otf_calibration(config,config_raw):
+        #Only the calibrators are corrected (in a copy of their rows), for their plots and the flags of their bad solutions
+        remove_corrected(msfile,config,config_raw,logger)
+        plot_vis = './cal_tabs/calibrators.ms'
+        calfields = [field for field in fields if field not in calib['targets']]
+        rows = calibrated_view(msfile,calfields,plot_vis,config,config_raw,logger)
+        cf.merge_snapshot_flags(plot_vis,msfile,rows)
+    else:
+        if not has_corrected(msfile):
+            #applycal adds the corrected data column
+            cf.join_plot_consumer(config,config_raw,logger,reason='before the corrected data column is added')
+        logger.info('Applying calibration to: {}'.format(', '.join(fields)))
+        cf.run_task('applycal',config,config_raw,logger,vis=msfile,field=','.join(fields),spw=','.join([str(spw) for spw in spws]),
+                    docallib=True,callib=callib_file)
+    
     plot_file = plots_obs_dir+'corr_phase.png'
     logger.info('Plotting corrected phases for {0} to: {1}'.format(calib['bandcal'],plot_file))
-    plotms(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='phase', ydatacolumn='corrected', correlation='RR,LL', 
-           avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False)
+    cf.queue_plot(logger,snapshot=True,vis=plot_vis, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='phase', ydatacolumn='corrected', correlation='RR,LL', 
+                         avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
+                         overwrite=True, showlegend=False, showgui=False)
 
     plot_file = plots_obs_dir+'corr_amp.png'
     logger.info('Plotting corrected amplitudes for {0} to: {1}'.format(calib['bandcal'],plot_file))
-    plotms(vis=msfile, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='amp', ydatacolumn='corrected', correlation='RR,LL', 
-           avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
-           overwrite=True, showlegend=False, showgui=False)
+    cf.queue_plot(logger,snapshot=True,vis=plot_vis, plotfile=plot_file, field=','.join(calib['bandcal']), xaxis='channel', yaxis='amp', ydatacolumn='corrected', correlation='RR,LL', 
+                         avgtime='1E10', antenna=calib['refant'], spw=','.join(numpy.array(spw_IDs,dtype='str')), coloraxis='antenna2', iteraxis='spw', expformat='png', 
+                         overwrite=True, showlegend=False, showgui=False)
     
-    logger.info('Apply all calibrations to phase calibrators and targets.')
-    for i in range(len(calib['targets'])):
-        msmd.open(msfile)
-        spws = msmd.spwsforfield(calib['targets'][i])
-        msmd.close()
-        inx = []
-        for spw in spws:
-            inx.append(spw_IDs.index(spw))
-        bandcals = list(numpy.array(calib['bandcal'],dtype='str')[inx])
-        spws = list(numpy.array(spw_IDs,dtype='str')[inx])
-        unique_bandcals = list(set(bandcals))
-        for bandcal in unique_bandcals:
-            inx = [j for j,x in enumerate(bandcals) if x == bandcal]
-            if not calib['phasecal'][i] in calib['fluxcal']:
-                logger.info('Applying calibration to: {}'.format(calib['phasecal'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['phasecal'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, bandcal)
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{1}', '{1}', '{1}'], calwt=False)".format(msfile,calib['phasecal'][i],gctab, dltab, bstab, iptab, amtab, fxtab, bandcal)
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
-                logger.info('Applying calibration to: {}'.format(calib['targets'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}'], gainfield=['', '', '{9}', '{9}', '{10}', '{10}', '{10}'], calwt=False)".format(msfile,calib['targets'][i],aptab, gctab, dltab, bstab, iptab, amtab, fxtab, bandcal, calib['phasecal'][i])
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '{8}', '{8}', '{9}', '{9}', '{9}'], calwt=False)".format(msfile,calib['targets'][i],gctab, dltab, bstab, iptab, amtab, fxtab, bandcal, calib['phasecal'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
-            else:
-                logger.info('Applying calibration to: {}'.format(calib['targets'][i]))
-                if aptab is not None:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}', '{7}'], gainfield=['', '', '{8}', '{8}', '{9}', '{9}'], calwt=False)".format(msfile,calib['targets'][i],aptab, gctab, dltab, bstab, iptab, amtab, bandcal, calib['phasecal'][i])
-                else:
-                    command = "applycal(vis='{0}', field='{1}', gaintable=['{2}', '{3}', '{4}', '{5}', '{6}'], gainfield=['', '{7}', '{7}', '{8}', '{8}'], calwt=False)".format(msfile,calib['targets'][i],gctab, dltab, bstab, iptab, amtab, bandcal, calib['phasecal'][i])
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
-    logger.info('Completed calibration.')
+    cf.render_plots(config,config_raw,logger)
+    if plot_vis != msfile:
+        remove_view(plot_vis,logger)
+    logger.info('Completed applying calibration.')
 
 
 
+@cf.profile_step
 def split_fields(msfile,config,config_raw,config_file,logger):
     """
     Splits the MS into separate MS for each science target.
@@ -1001,6 +1275,11 @@ def split_fields(msfile,config,config_raw,config_file,logger):
     sum_dir = './summary/'
     cf.makedir(sum_dir,logger)
     cf.makedir('./'+src_dir,logger)
+    #With on-the-fly calibration the cal library is applied as each target is written, as there is no corrected data column
+    calibrate = {}
+    if otf_calibration(config,config_raw):
+        logger.info('The calibration in {} will be applied as the targets are split.'.format(callib_file))
+        calibrate = {'datacolumn': 'corrected', 'docallib': True, 'callib': callib_file}
     if not config_raw.has_option('calibration','mosaic'):
         calib['mosaic'] = False
         config_raw.set('calibration','mosaic',False)
@@ -1014,39 +1293,31 @@ def split_fields(msfile,config,config_raw,config_file,logger):
             logger.info('All observations of {} will now be split off into a separate MS.'.format(target_name))
             inx = [i for i in range(len(calib['target_names'])) if target_name in calib['target_names'][i]]
             fields = numpy.array(calib['targets'],dtype='str')[inx]
-            msmd.open(msfile)
-            spws = []
-            for field in fields:
-                spws.extend(msmd.spwsforfield(field))
-            msmd.close()
-            spws = list(set(spws))
-            command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,','.join(numpy.array(fields,dtype='str')),','.join(numpy.array(spws,dtype='str')))
-            logger.info('Executing command: '+command)
-            exec(command)
-            cf.check_casalog(config,config_raw,logger,casalog)
+            spws = cf.spws_for_fields(cf.ms_metadata(msfile,logger),fields)
+            cf.run_task('mstransform',config,config_raw,logger,vis=msfile,outputvis=src_dir+target_name+'.split',
+                        field=','.join(numpy.array(fields,dtype='str')),spw=','.join(numpy.array(spws,dtype='str')),combinespws=True,**calibrate)
             listobs_file = sum_dir+target_name+'.listobs.summary'
             cf.rmfile(listobs_file,logger)
             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-            listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+            cf.run_task('listobs',config,config_raw,logger,check=False,vis=src_dir+target_name+'.split',listfile=listobs_file)
     else:
         new_target_names = calib['target_names'][:]
         for i in range(len(calib['targets'])):
             field = calib['targets'][i]
             target_name = calib['target_names'][i]
-            msmd.open(msfile)
-            spws = msmd.spwsforfield(field)
+            meta = cf.ms_metadata(msfile,logger)
+            spws = meta['field_spws'][field]
             nchans = []
             maxfreqs = []
             minfreqs = []
             chan_wids = []
             for spw in spws:
-                nchans.append(msmd.nchan(spw))
-                freqs = msmd.chanfreqs(spw)
-                wids = msmd.chanwidths(spw)
+                nchans.append(meta['spws'][spw]['nchan'])
+                freqs = meta['spws'][spw]['chan_freqs']
+                wids = meta['spws'][spw]['chan_widths']
                 maxfreqs.append(numpy.round(max(freqs)/1.E6,4))
                 minfreqs.append(numpy.round(min(freqs)/1.E6,4))
                 chan_wids.append(numpy.round(numpy.mean(wids)/1.E3,3))
-            msmd.close()
             if len(spws) > 1:
                 if config_raw.has_option('calibration','man_comb_spws'):
                     combine_spws = dict(calib['man_comb_spws'])[field]
@@ -1110,14 +1381,12 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                         combine_list = [key]
                         combine_list.extend(combine_spws[key])
                         logger.info('SPWs {0} will now be combined for {1}.'.format(combine_list,target_name))
-                        command = "mstransform(vis='{0}', outputvis='{2}{1}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')))
-                        logger.info('Executing command: '+command)
-                        exec(command)
-                        cf.check_casalog(config,config_raw,logger,casalog)
+                        cf.run_task('mstransform',config,config_raw,logger,vis=msfile,outputvis=src_dir+target_name+'.split',field=field,
+                                    spw=','.join(numpy.array(list(set(combine_list)),dtype='str')),combinespws=True,**calibrate)
                         listobs_file = sum_dir+target_name+'.listobs.summary'
                         cf.rmfile(listobs_file,logger)
                         logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                        listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+                        cf.run_task('listobs',config,config_raw,logger,check=False,vis=src_dir+target_name+'.split',listfile=listobs_file)
                     else:
                         for key in combine_spws.keys():
                             combine_list = [key]
@@ -1125,14 +1394,13 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                             logger.info('SPWs {0} will now be combined for {1}.'.format(combine_list,target_name))
                             inx = new_target_names.index(target_name)
                             new_target_names.remove(target_name)
-                            command = "mstransform(vis='{0}', outputvis='{2}{1}.spw{5}.split', field='{3}', spw='{4}', combinespws=True)".format(msfile,target_name,src_dir,field,','.join(numpy.array(list(set(combine_list)),dtype='str')),'+'.join(numpy.array(list(set(combine_list)),dtype='str')))
-                            logger.info('Executing command: '+command)
-                            exec(command)
-                            cf.check_casalog(config,config_raw,logger,casalog)
+                            cf.run_task('mstransform',config,config_raw,logger,vis=msfile,
+                                        outputvis=src_dir+target_name+'.spw{}.split'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))),
+                                        field=field,spw=','.join(numpy.array(list(set(combine_list)),dtype='str')),combinespws=True,**calibrate)
                             listobs_file = sum_dir+target_name+'.spw{}.listobs.summary'.format('+'.join(numpy.array(set(combine_list),dtype='str')))
                             cf.rmfile(listobs_file,logger)
                             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                            listobs(vis=src_dir+target_name+'.spw{}.split'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))), listfile=listobs_file)
+                            cf.run_task('listobs',config,config_raw,logger,check=False,vis=src_dir+target_name+'.spw{}.split'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))),listfile=listobs_file)
                             new_target_names.insert(inx,target_name+'.spw{}'.format('+'.join(numpy.array(list(set(combine_list)),dtype='str'))))
                             inx += 1
                 if separate:
@@ -1150,25 +1418,22 @@ def split_fields(msfile,config,config_raw,config_file,logger):
                                 inx += -1
                         for j in range(len(split_spws)):
                             spw = split_spws[j]
-                            command = "mstransform(vis='{0}', outputvis='{2}{1}.spw{4}.split', field='{3}', spw='{4}')".format(msfile,target_name,src_dir,field,spw)
-                            logger.info('Executing command: '+command)
-                            exec(command)
-                            cf.check_casalog(config,config_raw,logger,casalog)
+                            cf.run_task('mstransform',config,config_raw,logger,vis=msfile,outputvis=src_dir+target_name+'.spw{}.split'.format(spw),
+                                        field=field,spw=str(spw),**calibrate)
                             listobs_file = sum_dir+target_name+'.spw{}.listobs.summary'.format(spw)
                             cf.rmfile(listobs_file,logger)
                             logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                            listobs(vis=src_dir+target_name+'.spw{}.split'.format(spw), listfile=listobs_file)
+                            cf.run_task('listobs',config,config_raw,logger,check=False,vis=src_dir+target_name+'.spw{}.split'.format(spw),listfile=listobs_file)
                             new_target_names.insert(inx+j,target_name+'.spw{}'.format(spw))
             else:
                 logger.info('Splitting {0} into separate file: {1}.'.format(field, target_name+'.split'))
-                command = "split(vis='{0}', outputvis='{1}{2}.split', field='{3}')".format(msfile,src_dir,target_name,field)
-                logger.info('Executing command: '+command)
-                exec(command)
-                cf.check_casalog(config,config_raw,logger,casalog)
+                #split cannot apply a cal library, but mstransform makes the same MS
+                split_task = 'mstransform' if calibrate else 'split'
+                cf.run_task(split_task,config,config_raw,logger,vis=msfile,outputvis=src_dir+target_name+'.split',field=field,**calibrate)
                 listobs_file = sum_dir+target_name+'.listobs.summary'
                 cf.rmfile(listobs_file,logger)
                 logger.info('Writing listobs summary for split data set to: {}'.format(listobs_file))
-                listobs(vis=src_dir+target_name+'.split', listfile=listobs_file)
+                cf.run_task('listobs',config,config_raw,logger,check=False,vis=src_dir+target_name+'.split',listfile=listobs_file)
         if new_target_names != calib['target_names']:
             logger.info('Updating config file to set target names with separate SPWs.')
             logger.info('Replacing old target names ({})'.format(calib['target_names']))
@@ -1177,8 +1442,156 @@ def split_fields(msfile,config,config_raw,config_file,logger):
             configfile = open(config_file,'w')
             config_raw.write(configfile)
             configfile.close()
+    if calibrate and not (config_raw.has_option('flagging','no_rflag') and config['flagging']['no_rflag']):
+        #The split targets hold the calibrated data, so they are flagged there rather than in a calibrated copy of the MS
+        #Their flags are saved, summarised and plotted as their own 'final' flag version, as they are not in the MS
+        for split_ms in sorted(glob.glob(src_dir+'*.split')):
+            logger.info('Flagging the calibrated data of {}.'.format(split_ms))
+            corrected_flags(split_ms,config,config_raw,logger,datacolumn='data')
+            save_flags(split_ms,'final',logger)
+            flag_sum(split_ms,'final',config,config_raw,logger)
+            cf.queue_flag_plots(split_ms,cf.ms_metadata(split_ms,logger)['fields'],'./plots/flag_plot_{}.final'.format(os.path.basename(split_ms)),logger)
+        cf.render_plots(config,config_raw,logger)
     logger.info('Completed split fields.')
 
+def checkpoint_values(stage, config):
+    """
+    Returns the parameters (and inputs) that a sub-stage of this step depends on.
+    
+    Input:
+    stage = Name of the sub-stage. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    if stage == 'initial_flags':
+        values = {key: config['flagging'].get(key) for key in ['shadow_tol','quack_int','timecutoff','freqcutoff','no_tfcrop','rfi_engine']}
+        values['manual_flags'] = None
+        if os.path.isfile('manual_flags.list'):
+            values['manual_flags'] = hashlib.md5(open('manual_flags.list','rb').read()).hexdigest()
+        return values
+    if stage in ['calibration_1','calibration_2']:
+        values = {key: config['calibration'].get(key) for key in ['refant','fluxcal','fluxmod','man_mod','bandcal','phasecal','targets','collapse_tables']}
+        values['jvla'] = config['importdata']['jvla']
+        return values
+    if stage == 'rflag_flags':
+        values = {key: config['flagging'].get(key) for key in ['rthresh','rfi_engine']}
+        values['otf_calibration'] = config['calibration'].get('otf_calibration')
+        return values
+    return {}
+
+def checkpoint_fingerprint(stage, previous, config):
+    """
+    Returns the fingerprint of a sub-stage. It is chained to the fingerprint of the previous sub-stage,
+    so a change to any earlier sub-stage also invalidates all of those after it.
+    
+    Input:
+    stage = Name of the sub-stage. (String)
+    previous = Fingerprint of the previous sub-stage. (String)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    return hashlib.md5(json.dumps([stage,previous,checkpoint_values(stage,config)],sort_keys=True)).hexdigest()
+
+def read_checkpoint(stage, fingerprint, msfile, logger):
+    """
+    Returns the checkpoint of a sub-stage if it is still valid, i.e. its fingerprint matches and its flag version and calibration tables exist.
+    
+    Input:
+    stage = Name of the sub-stage. (String)
+    fingerprint = Current fingerprint of the sub-stage. (String)
+    msfile = Path to the MS. (String)
+    """
+    marker_file = checkpoint_dir+stage+'.json'
+    if not os.path.isfile(marker_file):
+        return None
+    marker = json.load(open(marker_file,'r'))
+    if marker['fingerprint'] != fingerprint:
+        logger.info('The inputs of {} have changed since its checkpoint was made.'.format(stage))
+        return None
+    if not cf.has_flag_version(msfile,marker['flag_version']):
+        logger.info('The flag version of the {0} checkpoint ({1}) is missing.'.format(stage,marker['flag_version']))
+        return None
+    if marker['tables'] is not None:
+        for table in marker['copies']:
+            if not os.path.isdir(table):
+                logger.info('The calibration table {0} of the {1} checkpoint is missing.'.format(table,stage))
+                return None
+    logger.info('Resuming from the {} checkpoint.'.format(stage))
+    return marker
+
+def write_checkpoint(stage, fingerprint, flag_version, logger, tables=None):
+    """
+    Records that a sub-stage has completed: its fingerprint, the flag version it left the MS with and a copy of the calibration tables it made.
+    
+    Input:
+    stage = Name of the sub-stage. (String)
+    fingerprint = Fingerprint of the sub-stage. (String)
+    flag_version = Name of the flag version saved at the end of the sub-stage. (String)
+    tables = Calibration tables made by the sub-stage, as returned by calibration(). (Dictionary)
+    
+    Output:
+    marker = The checkpoint. (Dictionary)
+    """
+    cf.makedir(checkpoint_dir,logger)
+    marker = {'stage': stage, 'fingerprint': fingerprint, 'flag_version': flag_version, 'tables': tables, 'copies': []}
+    if tables is not None:
+        copy_dir = checkpoint_dir+stage+'/'
+        cf.rmdir(copy_dir,logger)
+        cf.makedir(copy_dir,logger)
+        for table in checkpoint_tables(tables):
+            cf.cpdir(table,copy_dir+os.path.basename(table),logger)
+            marker['copies'].append(copy_dir+os.path.basename(table))
+    json.dump(marker,open(checkpoint_dir+stage+'.json','w'),indent=1)
+    logger.info('Checkpoint written for {}.'.format(stage))
+    return marker
+
+def checkpoint_tables(tables):
+    """
+    Returns the paths of all the calibration tables made by a run of the calibration.
+    """
+    return [table for table in tables['pretabs']+[tables.get(key) for key in ['dltab','bstab','iptab','amtab','fxtab','kbtab','gtab']] if table is not None]
+
+def set_corrected(fingerprint):
+    """
+    Records which calibration checkpoint the corrected data column of the MS (or the cal library, with on-the-fly calibration) holds
+    (None while it is being overwritten).
+    """
+    if not os.path.isdir(checkpoint_dir):
+        os.mkdir(checkpoint_dir)
+    json.dump({'fingerprint': fingerprint, 'otf': otf_calibration(config,config_raw)},open(checkpoint_dir+'corrected.json','w'))
+
+def get_corrected():
+    """
+    Returns the fingerprint of the calibration checkpoint the corrected data column of the MS holds.
+    """
+    if not os.path.isfile(checkpoint_dir+'corrected.json'):
+        return None
+    corrected = json.load(open(checkpoint_dir+'corrected.json','r'))
+    if corrected.get('otf',False) != otf_calibration(config,config_raw):
+        return None
+    return corrected['fingerprint']
+
+def restore_checkpoint(msfile, marker, cal_marker, config, config_raw, logger):
+    """
+    Returns the MS to the state at a checkpoint before the next sub-stage is run: restores its flag version and, if the corrected data
+    does not hold the last calibration, copies back and re-applies its tables (the solutions are not repeated).
+    
+    Input:
+    msfile = Path to the MS. (String)
+    marker = Checkpoint to restore. (Dictionary)
+    cal_marker = Checkpoint of the last calibration before it (or None). (Dictionary)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    """
+    logger.info('Restoring the MS to the {} checkpoint.'.format(marker['stage']))
+    restore_flags(msfile,marker['flag_version'],logger)
+    if cal_marker is not None and get_corrected() != cal_marker['fingerprint']:
+        logger.info('Re-applying the calibration tables from the {} checkpoint.'.format(cal_marker['stage']))
+        for table in checkpoint_tables(cal_marker['tables']):
+            cf.rmdir(table,logger)
+            cf.cpdir(checkpoint_dir+cal_marker['stage']+'/'+os.path.basename(table),table,logger)
+        set_corrected(None)
+        apply_calibration(msfile,cal_marker['tables'],config,config_raw,logger)
+        set_corrected(cal_marker['fingerprint'])
+        restore_flags(msfile,marker['flag_version'],logger)
+
 
 # Read configuration file with parameters
 config_file = sys.argv[-1]
@@ -1193,51 +1606,129 @@ logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['projec
 msfile = '{0}.ms'.format(config['global']['project_name'])
 
 #Flag, set intents, calibrate, flag more, calibrate again, then split fields
+#Each sub-stage leaves a checkpoint (flag version, calibration tables and a marker in checkpoint_dir) and a rerun resumes from the first invalidated one
+checkpoint_dir = './checkpoints/'
+callib_file = './cal_tabs/apply.callib'
 cf.check_casaversion(logger)
-flag_version = 'Original'
-if  os.path.isdir(msfile+'.flagversions/flags.Original'):
-    restore_flags(msfile,flag_version,logger)
-else:
+if not cf.has_flag_version(msfile,'Original'):
+    save_flags(msfile,'Original',logger)
+resume_marker = None
+cal_marker = None
+
+stage = 'initial_flags'
+fingerprint = checkpoint_fingerprint(stage,None,config)
+marker = read_checkpoint(stage,fingerprint,msfile,logger)
+if marker is None:
+    restore_flags(msfile,'Original',logger)
+    commands = manual_flags(msfile,config,config_raw,logger)
+    commands.extend(base_flags(config))
+    skip_tfcrop = False
+    if config_raw.has_option('flagging','no_tfcrop'):
+        skip_tfcrop = config['flagging']['no_tfcrop']
+    if not skip_tfcrop and rfi_engine(config,config_raw,logger) == 'casa':
+        commands.extend(tfcrop(config))
+    apply_flags(msfile,commands,config,config_raw,logger)
+    if not skip_tfcrop and rfi_engine(config,config_raw,logger) == 'numpy':
+        rfi_flags(msfile,'DATA',config['flagging']['timecutoff'],config['flagging']['freqcutoff'],config,config_raw,logger)
+    flag_version = 'initial'
+    rm_flags(msfile,flag_version,logger)
     save_flags(msfile,flag_version,logger)
-manual_flags(config,config_raw,logger)
-base_flags(msfile,config,config_raw,logger)
-if config_raw.has_option('flagging','no_tfcrop'):
-    if not config['flagging']['no_tfcrop']:
-        tfcrop(msfile,config,config_raw,logger)
+    flag_sum(msfile,flag_version,config,config_raw,logger)
+    fingerprint = checkpoint_fingerprint(stage,None,config)
+    write_checkpoint(stage,fingerprint,flag_version,logger)
 else:
-    tfcrop(msfile,config,config_raw,logger)
-flag_version = 'initial'
-rm_flags(msfile,flag_version,logger)
-save_flags(msfile,flag_version,logger)
-flag_sum(msfile,flag_version,logger)
+    resume_marker = marker
 select_refant(msfile,config,config_raw,config_file,logger)
 set_fields(msfile,config,config_raw,config_file,logger)
-plot_flags(msfile,flag_version,logger)
-calibration(msfile,config,config_raw,logger)
+if resume_marker is None:
+    plot_flags(msfile,'initial',logger)
+else:
+    resume_flag_sum(msfile,'initial',config,config_raw,logger,plots=True)
+
+stage = 'calibration_1'
+fingerprint = checkpoint_fingerprint(stage,fingerprint,config)
+marker = None
+if resume_marker is not None:
+    marker = read_checkpoint(stage,fingerprint,msfile,logger)
+if marker is None:
+    if resume_marker is not None:
+        restore_checkpoint(msfile,resume_marker,cal_marker,config,config_raw,logger)
+        resume_marker = None
+    set_corrected(None)
+    tables = calibration(msfile,config,config_raw,logger)
+    flag_version = stage
+    rm_flags(msfile,flag_version,logger)
+    save_flags(msfile,flag_version,logger)
+    cal_marker = write_checkpoint(stage,fingerprint,flag_version,logger,tables=tables)
+    set_corrected(fingerprint)
+else:
+    resume_marker = marker
+    cal_marker = marker
+
 skip_rflag = False
 if config_raw.has_option('flagging','no_rflag'):
     if config['flagging']['no_rflag']:
         skip_rflag = True
 if not skip_rflag:
-    rflag(msfile,config,config_raw,logger)
-    flag_version = 'rflag'
-    rm_flags(msfile,flag_version,logger)
-    save_flags(msfile,flag_version,logger)
-    flag_sum(msfile,flag_version,logger)
-    extend_flags(msfile,config,config_raw,logger)
-    flag_version = 'extended'
-    rm_flags(msfile,flag_version,logger)
-    save_flags(msfile,flag_version,logger)
-    flag_sum(msfile,flag_version,logger)
-    calibration(msfile,config,config_raw,logger)
+    stage = 'rflag_flags'
+    fingerprint = checkpoint_fingerprint(stage,fingerprint,config)
+    marker = None
+    if resume_marker is not None:
+        marker = read_checkpoint(stage,fingerprint,msfile,logger)
+    if marker is None:
+        if resume_marker is not None:
+            restore_checkpoint(msfile,resume_marker,cal_marker,config,config_raw,logger)
+            resume_marker = None
+        if otf_calibration(config,config_raw):
+            rflag_calibrators(msfile,config,config_raw,logger)
+        else:
+            corrected_flags(msfile,config,config_raw,logger)
+        flag_version = 'extended'
+        rm_flags(msfile,flag_version,logger)
+        save_flags(msfile,flag_version,logger)
+        flag_sum(msfile,flag_version,config,config_raw,logger,previous='initial')
+        write_checkpoint(stage,fingerprint,flag_version,logger)
+    else:
+        resume_marker = marker
+        resume_flag_sum(msfile,'extended',config,config_raw,logger,previous='initial')
+        
+    stage = 'calibration_2'
+    fingerprint = checkpoint_fingerprint(stage,fingerprint,config)
+    marker = None
+    if resume_marker is not None:
+        marker = read_checkpoint(stage,fingerprint,msfile,logger)
+    if marker is None:
+        if resume_marker is not None:
+            restore_checkpoint(msfile,resume_marker,cal_marker,config,config_raw,logger)
+            resume_marker = None
+        set_corrected(None)
+        tables = calibration(msfile,config,config_raw,logger)
+        flag_version = stage
+        rm_flags(msfile,flag_version,logger)
+        save_flags(msfile,flag_version,logger)
+        cal_marker = write_checkpoint(stage,fingerprint,flag_version,logger,tables=tables)
+        set_corrected(fingerprint)
+    else:
+        resume_marker = marker
+        cal_marker = marker
+
+if resume_marker is not None:
+    restore_checkpoint(msfile,resume_marker,cal_marker,config,config_raw,logger)
 flag_version = 'final'
 rm_flags(msfile,flag_version,logger)
 save_flags(msfile,flag_version,logger)
-flag_sum(msfile,flag_version,logger)
-plot_flags(msfile,flag_version,logger)
+if resume_marker is None:
+    flag_sum(msfile,flag_version,config,config_raw,logger,previous='initial' if skip_rflag else 'extended')
+    plot_flags(msfile,flag_version,logger,final=True)
+else:
+    resume_flag_sum(msfile,flag_version,config,config_raw,logger,previous='initial' if skip_rflag else 'extended',final=True,plots=True)
+cf.render_plots(config,config_raw,logger)
 cf.rmdir(config['global']['src_dir'],logger)
 split_fields(msfile,config,config_raw,config_file,logger)
 
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
+
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
 cf.backup_pipeline_params(config_file,logger)
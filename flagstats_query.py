@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import sys
+import sqlite3
+import argparse
+
+
+# Every row of the MS is counted once for each of its two antennas, so the counts by any other axis are halved
+axis_scale = {'project': 0.5, 'version': 0.5, 'field': 0.5, 'spw': 0.5, 'antenna': 1., 'scan': 0.5}
+
+
+def version_filter(args):
+    """
+    Returns the SQL condition (and its parameters) selecting the flag versions given on the command line.
+    """
+    conditions = ['versions.version = ?']
+    params = [args.version]
+    if args.projects:
+        conditions.append('versions.project IN ({})'.format(','.join(['?']*len(args.projects))))
+        params.extend(args.projects)
+    if args.field:
+        conditions.append('counts.field LIKE ?')
+        params.append(args.field)
+    return ' AND '.join(conditions), params
+
+
+def list_versions(db, args):
+    """
+    Prints the flag versions in the database with their total flagged fraction.
+    """
+    query = 'SELECT project, ms, version, created, flagged, total FROM versions'
+    params = []
+    if args.projects:
+        query += ' WHERE project IN ({})'.format(','.join(['?']*len(args.projects)))
+        params.extend(args.projects)
+    print('{0:<20} {1:<24} {2:<16} {3:<20} {4:>8}'.format('project', 'ms', 'version', 'created', 'flagged'))
+    for project, ms, version, created, flagged, total in db.execute(query+' ORDER BY project, id', params):
+        print('{0:<20} {1:<24} {2:<16} {3:<20} {4:>8.2%}'.format(project, ms, version, created, flagged/total if total > 0 else 0.))
+
+
+def group_by(db, args):
+    """
+    Prints the flagged visibilities of the selected flag versions grouped by one axis (e.g. the antennas that lost the most data across
+    all the projects that feed one group), with the number of projects each entry appears in.
+    """
+    column = 'versions.'+args.axis if args.axis in ['project', 'version'] else 'counts.'+args.axis
+    where, params = version_filter(args)
+    query = ('SELECT {0}, SUM(counts.flagged), SUM(counts.total), COUNT(DISTINCT versions.project) FROM counts '
+             'JOIN versions ON counts.version_id = versions.id WHERE {1} GROUP BY {0}').format(column, where)
+    rows = []
+    for key, flagged, total, nproj in db.execute(query, params):
+        scale = axis_scale[args.axis]
+        rows.append((key, scale*flagged, scale*total, nproj))
+    order = {'flagged': lambda row: row[1], 'fraction': lambda row: row[1]/row[2] if row[2] > 0 else 0.}
+    if args.sort in order:
+        rows.sort(key=order[args.sort], reverse=True)
+    else:
+        rows.sort()
+    if args.top:
+        rows = rows[:args.top]
+    print('{0:<20} {1:>14} {2:>14} {3:>8} {4:>9}'.format(args.axis, 'flagged', 'total', 'fraction', 'projects'))
+    for key, flagged, total, nproj in rows:
+        print('{0:<20} {1:>14.0f} {2:>14.0f} {3:>8.2%} {4:>9}'.format(str(key), flagged, total, flagged/total if total > 0 else 0., nproj))
+
+
+def run_sql(db, args):
+    """
+    Runs an arbitrary SQL query on the database and prints the rows.
+    """
+    cursor = db.execute(args.query)
+    if cursor.description is not None:
+        print('\t'.join([col[0] for col in cursor.description]))
+    for row in cursor:
+        print('\t'.join([str(value) for value in row]))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Query the flag statistics database written by the flag_calib_split step.')
+    parser.add_argument('db', help='Flag statistics database (summary/flagstats.sqlite, or the "flag_db" of the projects).')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    versions = commands.add_parser('versions', help='List the flag versions in the database.')
+    versions.add_argument('-p', '--projects', nargs='+', help='Only these projects.')
+    versions.set_defaults(func=list_versions)
+    by = commands.add_parser('by', help='Flagged data of a flag version grouped by one axis, across projects.')
+    by.add_argument('axis', choices=sorted(axis_scale.keys()), help='Axis to group by.')
+    by.add_argument('-v', '--version', default='final', help='Flag version (default: final).')
+    by.add_argument('-p', '--projects', nargs='+', help='Only these projects.')
+    by.add_argument('-f', '--field', help='Only fields matching this SQL LIKE pattern (e.g. "HCG16%%").')
+    by.add_argument('-s', '--sort', choices=['flagged', 'fraction', 'name'], default='flagged', help='Sort order (default: flagged).')
+    by.add_argument('-n', '--top', type=int, help='Only show the first N entries.')
+    by.set_defaults(func=group_by)
+    sql = commands.add_parser('sql', help='Run an SQL query (tables: versions, counts).')
+    sql.add_argument('query', help='The query.')
+    sql.set_defaults(func=run_sql)
+    args = parser.parse_args(argv)
+    db = sqlite3.connect(args.db)
+    try:
+        args.func(db, args)
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,11 @@ import configparser
 from ast import literal_eval
 import glob
 import collections
+import json
+import socket
+import fcntl
+import subprocess
+import shlex
 
 from ruffus import *
 import cgatcore.experiment as E
@@ -48,97 +53,203 @@ def backup_pipeline_params():
     shutil.copyfile(cgatcore_params['configfile'],backup_file)
 
         
-def check_pipeline_params():
+ALL_TARGETS = 'all_targets'
+
+
+def target_list(config_raw=None):
     """
-    Checks if any pipeline parameters have been modified since the previous run.
+    Returns the names of the imaging targets, i.e. the jobs that the imaging steps are split into.
+    This is read after 'flag_calib_split' as that step may split targets into separate SPWs.
+    In interactive mode a single job covers all targets, as each step prompts the user about every target.
     """
-    configfile = cgatcore_params['configfile']
-    backup_file = 'backup.'+configfile
-    if os.access(backup_file, os.R_OK):
-        if not filecmp.cmp(backup_file,configfile):
-            print('Parameters in {} have been modified since the last execution.'.format(configfile))
-            bash_command = 'diff {0} {1} > diff_params.txt'.format(backup_file,configfile)
-            os.system(bash_command)
-            f = open('diff_params.txt','r')
-            diff = f.read()
-            f.close()
-            os.remove('diff_params.txt')
-            
-            import_data_kwds = ['project_name','data_path','jvla','mstransform','keep_','hanning', 'chanavg']
-            flag_calib_split_kwds = ['src_dir','shadow_tol','quack_int','timecutoff','freqcutoff','rthresh','refant','no_rflag','no_tfcrop',
-                                     'fluxcal','fluxmod','man_mod','bandcal','phasecal','targets','target_names','mosaic','man_comb_spws']
-            dirty_cont_image_kwds = ['rest_freq','img_dir']
-            contsub_dirty_image_kwds = ['linefree_ch','fitorder','save_cont','line_ch']
-            clean_image_kwds = ['automask','multiscale','beam_scales','sefd','corr_eff','robust','thresh','pix_size','im_size','noise','phasecenter']
-            moment_kwds = ['mom_thresh','mom_chans']
-            cleanup_kwds = ['cleanup_level']
-            
-            if any(keyword in diff for keyword in import_data_kwds):
-                for keyword in import_data_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('import_data'))
-                try:
-                    os.remove('import_data.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in flag_calib_split_kwds):
-                for keyword in flag_calib_split_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('flag_calib_split'))
-                try:
-                    os.remove('flag_calib_split.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in dirty_cont_image_kwds):
-                for keyword in dirty_cont_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('dirty_cont_image'))
-                try:
-                    os.remove('dirty_cont_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in contsub_dirty_image_kwds):
-                for keyword in contsub_dirty_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('contsub_dirty_image'))
-                try:
-                    os.remove('contsub_dirty_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in clean_image_kwds):
-                for keyword in clean_image_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('clean_image'))
-                try:
-                    os.remove('clean_image.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in moment_kwds):
-                for keyword in moment_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('moment_zero'))
+    if config_raw is None:
+        config_raw = configparser.RawConfigParser()
+        config_raw.read(cgatcore_params['configfile'])
+    interactive = literal_eval(config_raw.get('global','interactive'))
+    if interactive:
+        return [ALL_TARGETS]
+    targets = literal_eval(config_raw.get('calibration','target_names'))
+    mosaic = False
+    if config_raw.has_option('calibration','mosaic'):
+        mosaic = literal_eval(config_raw.get('calibration','mosaic'))
+    if mosaic:
+        unique_targets = []
+        for target in targets:
+            if target not in unique_targets:
+                unique_targets.append(target)
+        targets = unique_targets
+    return targets
+
+
+# Parameters read by each step. If any of them change the step (and those after it) will be repeated.
+# Parameters in per_target_kwds hold one value per imaging target, so only that target is repeated.
+step_kwds = collections.OrderedDict([
+    ('import_data', ['project_name','data_path','jvla','mstransform','keep_obs','keep_spws','keep_fields','hanning','chanavg']),
+    ('flag_calib_split', ['src_dir','shadow_tol','quack_int','timecutoff','freqcutoff','rthresh','no_rflag','no_tfcrop',
+                          'refant','fluxcal','fluxmod','man_mod','bandcal','phasecal','targets','target_names','mosaic','man_comb_spws',
+                          'rfi_engine','collapse_tables','flag_db','otf_calibration']),
+    ('dirty_cont_image', ['rest_freq','src_dir','img_dir','pix_size','im_size','robust','phasecenter']),
+    ('contsub_dirty_image', ['rest_freq','src_dir','img_dir','linefree_ch','fitorder','save_cont','line_ch','pix_size','im_size','robust','phasecenter']),
+    ('clean_image', ['rest_freq','src_dir','img_dir','line_ch','pix_size','im_size','automask','multiscale','beam_scales','phasecenter',
+                     'sefd','corr_eff','robust','thresh','noise','automask_sl','automask_ns','automask_mbf','automask_lns','automask_neg',
+                     'hanning','mstransform','chanavg']),
+    ('moment_zero', ['src_dir','img_dir','mom_dir','mom_thresh','mom_chans','noise','sefd','corr_eff','hanning','mstransform','chanavg']),
+    ('cleanup', ['src_dir','img_dir','mom_dir','cleanup_level'])
+    ])
+per_target_kwds = ['linefree_ch','fitorder','line_ch','pix_size','im_size','multiscale','noise','mom_chans']
+target_steps = ['dirty_cont_image','contsub_dirty_image','clean_image','moment_zero']
+fingerprint_dir = '.fingerprints'
+
+
+def step_artifacts(step, config_raw, target=None):
+    """
+    Returns the input files/tables (other than the parameters) read by a step.
+    """
+    def get(option, default=''):
+        for section in config_raw.sections():
+            if config_raw.has_option(section, option):
                 try:
-                    os.remove('moment_zero.done')
-                except FileNotFoundError:
-                    pass
-            elif any(keyword in diff for keyword in cleanup_kwds):
-                for keyword in cleanup_kwds:
-                    if keyword in diff:
-                        print('The {} keyword value has changed in the parameters file since the previous run.'.format(keyword))
-                print('Steps from {} onwards will be marked as incomplete.'.format('cleanup'))
+                    return literal_eval(config_raw.get(section, option))
+                except (ValueError, SyntaxError):
+                    return config_raw.get(section, option)
+        return default
+    src_dir = str(get('src_dir'))+'/'
+    img_dir = str(get('img_dir'))+'/'
+    if step == 'import_data':
+        if get('jvla', False):
+            return [str(get('data_path'))+str(get('project_name'))+'.ms']
+        return sorted(glob.glob(os.path.join(str(get('data_path')), '*')))
+    if step == 'flag_calib_split':
+        return ['manual_flags.list']
+    if target is None or target == ALL_TARGETS:
+        return []
+    if step == 'dirty_cont_image':
+        return [src_dir+target+'.split']
+    if step == 'contsub_dirty_image':
+        return [src_dir+target+'.split']
+    if step == 'clean_image':
+        return [src_dir+target+'.split.contsub', img_dir+target+'.dirty.image']
+    if step == 'moment_zero':
+        return glob.glob(img_dir+target+'.image*')
+    return []
+
+
+def artifact_stamp(path):
+    """
+    Returns a cheap stamp (names, sizes and modification times) of a file or of the top level of a CASA table.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, int(stat.st_mtime)]
+    if os.path.isdir(path):
+        stamp = []
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path) and name != 'table.lock':
+                stat = os.stat(file_path)
+                stamp.append([name, stat.st_size, int(stat.st_mtime)])
+        return stamp
+    return None
+
+
+def step_fingerprint(step, config_raw, target=None, artifacts=True):
+    """
+    Returns the parameter values (and input artifact stamps) that a step (for one target) depends on.
+    """
+    targets = target_list(config_raw)
+    inx = None
+    if target is not None and target in targets and target != ALL_TARGETS:
+        mosaic = False
+        if config_raw.has_option('calibration','mosaic'):
+            mosaic = literal_eval(config_raw.get('calibration','mosaic'))
+        if not mosaic:
+            inx = targets.index(target)
+    values = collections.OrderedDict()
+    for keyword in step_kwds[step]:
+        value = None
+        for section in config_raw.sections():
+            if config_raw.has_option(section, keyword):
+                value = config_raw.get(section, keyword)
                 try:
-                    os.remove('cleanup.done')
-                except FileNotFoundError:
+                    value = literal_eval(value)
+                except (ValueError, SyntaxError):
                     pass
+        if keyword in per_target_kwds and inx is not None and isinstance(value, list):
+            value = value[inx] if inx < len(value) else None
+        values[keyword] = repr(value)
+    fingerprint = {'kwds': values}
+    if artifacts:
+        fingerprint['artifacts'] = collections.OrderedDict((path, artifact_stamp(path)) for path in step_artifacts(step, config_raw, target))
+    return fingerprint
+
+
+def fingerprint_file(step, target=None):
+    if target is None:
+        return os.path.join(fingerprint_dir, step+'.json')
+    return os.path.join(fingerprint_dir, '{0}.{1}.json'.format(target, step))
+
+
+def record_fingerprint(step, target=None):
+    """
+    Records what a step (for one target) depended on when it last completed.
+    """
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(cgatcore_params['configfile'])
+    if not os.path.isdir(fingerprint_dir):
+        os.makedirs(fingerprint_dir, exist_ok=True)
+    with open(fingerprint_file(step, target), 'w') as f:
+        json.dump(step_fingerprint(step, config_raw, target), f, indent=1)
+
+
+def remove_done(step, target=None):
+    """
+    Removes the .done file(s) of a step. The imaging steps have one .done file per target.
+    """
+    if target is not None:
+        done_files = glob.glob('targets/{0}.{1}.done'.format(target, step))
     else:
-        print('No parameters backup file found.')
-        print('Skipping parameters change check.')
+        done_files = glob.glob(step+'.done')+glob.glob('targets/*.{}.done'.format(step))
+    for done_file in done_files:
+        os.remove(done_file)
+
+
+def check_pipeline_params():
+    """
+    Checks if the parameters or inputs of any step (or of any target in the imaging steps) have changed since it last completed.
+    Only those steps are marked as incomplete; the workflow then repeats them and anything that depends on them.
+    Steps without a recorded fingerprint are compared against the parameters backup from the previous run.
+    """
+    configfile = cgatcore_params['configfile']
+    backup_file = 'backup.'+configfile
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(configfile)
+    backup_raw = None
+    if os.access(backup_file, os.R_OK):
+        backup_raw = configparser.RawConfigParser()
+        backup_raw.read(backup_file)
+    jobs = [(step, None) for step in step_kwds.keys() if step not in target_steps]
+    for target in target_list(config_raw):
+        jobs.extend([(step, target) for step in target_steps])
+    for step, target in jobs:
+        if os.access(fingerprint_file(step, target), os.R_OK):
+            with open(fingerprint_file(step, target), 'r') as f:
+                previous = json.load(f)
+            current = step_fingerprint(step, config_raw, target, artifacts='artifacts' in previous)
+        elif backup_raw is not None:
+            previous = step_fingerprint(step, backup_raw, target, artifacts=False)
+            current = step_fingerprint(step, config_raw, target, artifacts=False)
+        else:
+            continue
+        changed = [keyword for keyword in current['kwds'] if previous['kwds'].get(keyword) != current['kwds'][keyword]]
+        if 'artifacts' in current:
+            changed.extend([path for path in current['artifacts'] if previous['artifacts'].get(path) != current['artifacts'][path]])
+            changed.extend([path for path in previous['artifacts'] if path not in current['artifacts']])
+        if len(changed) > 0:
+            label = step if target is None or target == ALL_TARGETS else '{0} ({1})'.format(step, target)
+            for keyword in changed:
+                print('The {0} value has changed since {1} last completed.'.format(keyword, label))
+            print('Step {} will be marked as incomplete.'.format(label))
+            remove_done(step, target)
         
 
 # Read cgat-core configuration
@@ -147,9 +258,13 @@ cgatcore_params = P.get_parameters("hi_segmented_pipeline.yml")
 # Sanity checks on input parameters
 input_validation()
 
+# Plan mode only reads the data and parameters, so nothing is marked as incomplete
+plan_mode = len(sys.argv) > 1 and sys.argv[1] == 'plan'
+
 #Review and backup pipeline parameters
-check_pipeline_params()
-backup_pipeline_params()
+if not plan_mode:
+    check_pipeline_params()
+    backup_pipeline_params()
 
 # Add CASA to the PATH
 os.environ["PATH"] += os.pathsep + cgatcore_params['casa']
@@ -172,7 +287,7 @@ def dependency_check(outfile):
         if shutil.which(cmd) is None:
             raise EnvironmentError("Required dependency \"{}\" not found".format(cmd))
     
-    scripts = ['import_data','flag_calib_split','dirty_cont_image','contsub_dirty_image','clean_image','cleanup','common_functions','moment_zero']
+    scripts = ['import_data','flag_calib_split','dirty_cont_image','contsub_dirty_image','clean_image','cleanup','common_functions','moment_zero','casa_worker','plan_pipeline','rfi_flagger','plot_spool']
     for script in scripts:
         if not os.access(script+'.py', os.R_OK):
             os.symlink(cgatcore_params['scripts']+script+'.py',script+'.py')
@@ -184,46 +299,239 @@ def dependency_check(outfile):
     
     
 
+def use_worker():
+    """
+    Decides whether stage scripts should run in the persistent CASA worker(s).
+    Interactive runs always use a fresh CASA process as the worker has no terminal attached.
+    """
+    if not cgatcore_params.get('worker', False):
+        return False
+    config_raw = configparser.RawConfigParser()
+    config_raw.read(cgatcore_params['configfile'])
+    try:
+        interactive = literal_eval(config_raw.get('global','interactive'))
+    except (configparser.Error, ValueError, SyntaxError):
+        interactive = True
+    if interactive:
+        print('Interactive mode is set. Stage scripts will not be run in the CASA worker.')
+        return False
+    return True
+
+
+def worker_pool():
+    """
+    Returns the number of CASA workers that may be started. This is 'worker_pool' in the yml file if set, otherwise one per imaging
+    target (as the per-target jobs of the imaging steps run concurrently) up to the number of CPUs.
+    """
+    if 'worker_pool' in cgatcore_params:
+        return max(int(cgatcore_params['worker_pool']), 1)
+    try:
+        ntargets = len(target_list())
+    except (configparser.Error, ValueError, SyntaxError):
+        ntargets = 1
+    return max(min(ntargets, os.cpu_count() or 1), 1)
+
+
+def worker_files(i):
+    """
+    Returns the socket, lock and output file paths for CASA worker number i.
+    """
+    worker_dir = '.casa_worker'
+    if not os.path.isdir(worker_dir):
+        os.makedirs(worker_dir, exist_ok=True)
+    # Relative paths keep the socket name within the length limit for Unix sockets
+    root = os.path.join(worker_dir, 'worker{}'.format(i))
+    return root+'.sock', root+'.lock', root+'.out'
+
+
+def connect_worker(i):
+    """
+    Connects to CASA worker number i, starting it first if it is not running.
+    """
+    sock_path, lock_path, out_path = worker_files(i)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(sock_path)
+        return client
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+    if os.path.exists(sock_path):
+        os.remove(sock_path)
+    print('Starting CASA worker {0} ({1}).'.format(i,sock_path))
+    out_file = open(out_path, 'a')
+    subprocess.Popen(['casa', '--nologger', '--nogui', '-c', 'casa_worker.py', 'serve', sock_path,
+                      str(cgatcore_params.get('worker_timeout', 900))],
+                     stdout=out_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    out_file.close()
+    start = time.time()
+    while time.time()-start < 600:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(sock_path)
+            return client
+        except (FileNotFoundError, ConnectionRefusedError):
+            client.close()
+            time.sleep(1)
+    raise RuntimeError(' CASA worker {0} did not start. Check {1}. '.format(i,out_path))
+
+
+def worker_request(request):
+    """
+    Sends a request (stage script or single task call) to a free CASA worker and waits for the response.
+    The number of workers is set by worker_pool. If all are busy this blocks until one is free.
+    """
+    pool = worker_pool()
+    lock = None
+    for i in range(pool):
+        lock = open(worker_files(i)[1], 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            lock.close()
+            lock = None
+    if lock is None:
+        i = os.getpid() % pool
+        lock = open(worker_files(i)[1], 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        client = connect_worker(i)
+        client.sendall((json.dumps(request)+'\n').encode())
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    if len(data) == 0:
+        raise RuntimeError(' CASA worker {0} exited while running: {1} '.format(i,request))
+    return json.loads(data.decode())
+
+
+def shutdown_workers():
+    """
+    Asks any running CASA workers to exit.
+    """
+    for sock_path in glob.glob(os.path.join('.casa_worker', 'worker*.sock')):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(sock_path)
+            client.sendall((json.dumps({'shutdown': True})+'\n').encode())
+            client.recv(65536)
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+
+def run_stage(script, outfile, *args):
+    """
+    Runs a CASA stage script (in the CASA worker if enabled) and touches the .done file when it succeeds.
+    The fingerprint of the parameters and inputs the step used is then recorded.
+    """
+    script_args = [cgatcore_params['configfile']]+list(args)
+    if use_worker():
+        response = worker_request({'script': script+'.py', 'args': script_args, 'cwd': os.getcwd()})
+        if response['status'] != 0:
+            raise RuntimeError(' {0} failed in the CASA worker (status {1}). {2}'.format(script,response['status'],response['error']))
+        with open(outfile, 'a'):
+            os.utime(outfile, None)
+    else:
+        statement = 'casa --nologger -c {0}.py {1} && touch {2}'.format(script,' '.join([shlex.quote(arg) for arg in script_args]),shlex.quote(outfile))
+        stdout, stderr = P.execute(statement)
+    if script in target_steps:
+        record_fingerprint(script, args[0] if len(args) > 0 else ALL_TARGETS)
+    else:
+        record_fingerprint(script)
+
+
 @transform(dependency_check, suffix('dependency_check.done'), 'import_data.done'.format(cgatcore_params['project']))
 def import_data(infile,outfile):
-    statement = 'casa --nologger -c import_data.py {} && touch import_data.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('import_data', outfile)
     
 @transform(import_data, suffix('import_data.done'.format(cgatcore_params['project'])), 'flag_calib_split.done'.format(cgatcore_params['project']))
 def flag_calib_split(infile,outfile):
-    statement = 'casa --nologger -c flag_calib_split.py {} && touch flag_calib_split.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('flag_calib_split', outfile)
     
-@transform(flag_calib_split, suffix('flag_calib_split.done'.format(cgatcore_params['project'])), 'dirty_cont_image.done'.format(cgatcore_params['project']))
+def target_args(infile):
+    """
+    Returns the extra script argument (the target name) for a per-target job file.
+    """
+    target = os.path.basename(infile)
+    for suffix in ['.target', '.dirty_cont_image.done', '.contsub_dirty_image.done', '.clean_image.done']:
+        if target.endswith(suffix):
+            target = target[:-len(suffix)]
+    if target == ALL_TARGETS:
+        return []
+    return [target]
+
+
+@split(flag_calib_split, 'targets/*.target')
+def split_targets(infile,outfiles):
+    """
+    Creates one job file per imaging target so the imaging steps can run concurrently for each target.
+    """
+    for outfile in outfiles:
+        os.remove(outfile)
+    if not os.path.isdir('targets'):
+        os.makedirs('targets')
+    targets = target_list()
+    #Markers of targets that are no longer in the parameters file would otherwise count as done
+    for done_file in glob.glob('targets/*.done'):
+        target = os.path.basename(done_file)[:-len('.done')]
+        for step in target_steps:
+            if target.endswith('.'+step):
+                target = target[:-len(step)-1]
+        if target not in targets:
+            os.remove(done_file)
+    for target in targets:
+        open('targets/{}.target'.format(target), 'w').close()
+
+@transform(split_targets, suffix('.target'), '.dirty_cont_image.done')
 def dirty_cont_image(infile,outfile):
-    statement = 'casa --nologger -c dirty_cont_image.py {} && touch dirty_cont_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('dirty_cont_image', outfile, *target_args(infile))
     
-@transform(dirty_cont_image, suffix('dirty_cont_image.done'.format(cgatcore_params['project'])), 'contsub_dirty_image.done'.format(cgatcore_params['project']))
+@transform(dirty_cont_image, suffix('.dirty_cont_image.done'), '.contsub_dirty_image.done')
 def contsub_dirty_image(infile,outfile):
-    statement = 'casa --nologger -c contsub_dirty_image.py {} && touch contsub_dirty_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('contsub_dirty_image', outfile, *target_args(infile))
     
-@transform(contsub_dirty_image, suffix('contsub_dirty_image.done'.format(cgatcore_params['project'])), 'clean_image.done'.format(cgatcore_params['project']))
+@transform(contsub_dirty_image, suffix('.contsub_dirty_image.done'), '.clean_image.done')
 def clean_image(infile,outfile):
-    statement = 'casa --nologger -c clean_image.py {} && touch clean_image.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('clean_image', outfile, *target_args(infile))
 
-@transform(clean_image, suffix('clean_image.done'.format(cgatcore_params['project'])), 'moment_zero.done'.format(cgatcore_params['project']))
+@transform(clean_image, suffix('.clean_image.done'), '.moment_zero.done')
 def moment_zero(infile,outfile):
-    statement = 'casa --nologger -c moment_zero.py {} && touch moment_zero.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+    run_stage('moment_zero', outfile, *target_args(infile))
     
-@transform(moment_zero, suffix('moment_zero.done'.format(cgatcore_params['project'])), 'cleanup.done'.format(cgatcore_params['project']))
-def cleanup(infile,outfile):
-    statement = 'casa --nologger -c cleanup.py {} && touch cleanup.done'.format(cgatcore_params['configfile'])
-    stdout, stderr = P.execute(statement)
+@merge(moment_zero, 'cleanup.done'.format(cgatcore_params['project']))
+def cleanup(infiles,outfile):
+    #The imaging steps run for each target at once, so they leave the backup of the parameters file to the pipeline
+    backup_pipeline_params()
+    run_stage('cleanup', outfile)
+    shutdown_workers()
     
 
+def plan_pipeline():
+    """
+    Lists every CASA task call the pipeline would make with its estimated cost (in summary/<project>.plan.csv) without running any step.
+    """
+    for script in ['common_functions','plan_pipeline']:
+        if not os.access(script+'.py', os.R_OK):
+            os.symlink(cgatcore_params['scripts']+script+'.py',script+'.py')
+    statement = 'casa --nologger --nogui -c plan_pipeline.py {}'.format(cgatcore_params['configfile'])
+    return subprocess.call(statement, shell=True)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
     P.main(argv)
 
 if __name__ == "__main__":
+    if plan_mode:
+        sys.exit(plan_pipeline())
     sys.exit(P.main(sys.argv))
@@ -3,9 +3,12 @@ imp.load_source('common_functions','common_functions.py')
 import common_functions as cf
 
 
+@cf.profile_step
 def import_data(data_files, msfile, config, config_raw, logger):
     """ 
     Import VLA archive files from a location to a single MS.
+    With more than one file (and core) each file is imported into its own MS in a separate CASA process and these are then joined
+    (as a multi-MS) with virtualconcat, which moves rather than copies the data.
     
     Input:
     data_files = Paths to the VLA archive files. (List/Array of Strings)
@@ -17,10 +20,20 @@ def import_data(data_files, msfile, config, config_raw, logger):
     cf.rmdir(msfile,logger)
     logger.info('Input files: {}'.format(data_files))
     logger.info('Output msfile: {}'.format(msfile))
-    command = "importvla(archivefiles = {0}, vis = '{1}')".format(data_files, msfile)
-    logger.info('Executing command: '+command)
-    exec(command)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    nproc = cf.import_procs(config,config_raw,len(data_files))
+    if nproc < 2:
+        cf.run_task('importvla',config,config_raw,logger,archivefiles=data_files,vis=msfile)
+    else:
+        part_dir = msfile+'.parts/'
+        cf.rmdir(part_dir,logger)
+        cf.makedir(part_dir,logger)
+        parts = [part_dir+'{0:03d}.ms'.format(i) for i in range(len(data_files))]
+        logger.info('Importing each of the {0} archive files into a separate MS with {1} CASA processes.'.format(len(data_files),nproc))
+        calls = [{'archivefiles': [data_files[i]], 'vis': parts[i]} for i in range(len(data_files))]
+        cf.run_tasks('importvla',calls,config,config_raw,logger,nproc=nproc)
+        logger.info('Joining the imported MSs into {}.'.format(msfile))
+        cf.run_task('virtualconcat',config,config_raw,logger,vis=parts,concatvis=msfile,keepcopy=False)
+        cf.rmdir(part_dir,logger)
     logger.info('Completed import vla data')
     
 def obs_dates(msfile, config, logger):
@@ -32,12 +45,10 @@ def obs_dates(msfile, config, logger):
     """
     logger.info('Starting archive file summary.')
     logger.info('To find the exact files imported here search the VLA archive (https://archive.nrao.edu/archive/advquery.jsp) for:')
-    tb.open(msfile+'/OBSERVATION')
-    times = tb.getcol('TIME_RANGE')
-    tb.close()
-    for i in range(len(times[0])):
-        start_time = qa.time({'value':times[0][i],'unit':'s'},form='fits')[0]
-        end_time = qa.time({'value':times[1][i],'unit':'s'},form='fits')[0]
+    times = cf.ms_metadata(msfile,logger)['obs_time_ranges']
+    for i in range(len(times)):
+        start_time = qa.time({'value':times[i][0],'unit':'s'},form='fits')[0]
+        end_time = qa.time({'value':times[i][1],'unit':'s'},form='fits')[0]
         start_time = start_time.replace('T',' ')
         end_time = end_time.replace('T',' ')
         logger.info('Project: {0}\tStart Time: {1}\tEnd Time: {2}'.format(config['global']['project_name'],start_time,end_time))
@@ -56,8 +67,7 @@ def listobs_sum(msfile, config, config_raw, logger):
     listobs_file = sum_dir+msfile+'.listobs.summary'
     cf.rmfile(listobs_file,logger)
     logger.info('Writing listobs summary of data set to: {}'.format(listobs_file))
-    listobs(vis=msfile, listfile=listobs_file)
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('listobs',config,config_raw,logger,vis=msfile,listfile=listobs_file)
     logger.info('Completed listobs summary.')
 
 def get_obsfreq(msfile):
@@ -73,13 +83,12 @@ def get_obsfreq(msfile):
     chan_res = Channel width. (Float)
     nchan = Number of channels. (Integer)
     """
-    msmd.open(msfile)
-    nspw = msmd.nspw()
-    freq_ini = msmd.chanfreqs(0)[0]/1e9
-    freq_end = msmd.chanfreqs(nspw-1)[-1]/1e9
-    chan_res = msmd.chanwidths(0)[0]/1e9
-    nchan = len(msmd.chanwidths(0))
-    msmd.done()
+    spws = cf.ms_metadata(msfile)['spws']
+    nspw = len(spws)
+    freq_ini = spws[0]['chan_freqs'][0]/1e9
+    freq_end = spws[nspw-1]['chan_freqs'][-1]/1e9
+    chan_res = spws[0]['chan_widths'][0]/1e9
+    nchan = len(spws[0]['chan_widths'])
     return freq_ini, freq_end, chan_res, nchan
 
 def find_mssources(msfile,logger):
@@ -93,9 +102,7 @@ def find_mssources(msfile,logger):
     Output:
     mssources = All the fields observed in the MS separated by ','. (String)
     """
-    msmd.open(msfile)
-    mssources = ','.join(np.sort(msmd.fieldnames()))
-    msmd.done()
+    mssources = ','.join(sorted(cf.ms_metadata(msfile,logger)['fields']))
     logger.info('Sources in MS {0}: {1}'.format(msfile, mssources))
     return mssources
 
@@ -109,10 +116,7 @@ def get_project(msfile):
     Output:
     Project identifier. (String)
     """
-    tb.open(msfile+'/OBSERVATION')
-    project = tb.getcol('PROJECT')
-    tb.close()
-    return project[0]
+    return cf.ms_metadata(msfile)['projects'][0]
 
 def get_msinfo(msfile,logger):
     """
@@ -134,7 +138,7 @@ def get_msinfo(msfile,logger):
     msinfo['freq_end'] = freq_end
     msinfo['chan_res'] = chan_res
     msinfo['nchan'] = nchan
-    msinfo['num_spw'] = len(vishead(msfile, mode = 'list', listitems = ['spw_name'])['spw_name'][0])
+    msinfo['num_spw'] = len(cf.ms_metadata(msfile,logger)['spws'])
 
     # Print summary
     logger.info('> Sources ({0}): {1}'.format(len(msinfo['mssources'].split(',')),
@@ -146,7 +150,7 @@ def get_msinfo(msfile,logger):
 # Plotting
 def plot_elevation(msfile,config,logger):
     """
-    Plots the elevation of the fields in each SPW as a function of time.
+    Plots the elevation of the fields in each SPW as a function of time. The plot is queued (see render_plots in common_functions.py).
     
     Input:
     msfile = Path to the MS. (String)
@@ -162,13 +166,13 @@ def plot_elevation(msfile,config,logger):
     min_elev = 0
     max_elev = 90
     showgui = False
-    plotms(vis=msfile, xaxis='time', yaxis='elevation',
-            correlation='', coloraxis = 'field',
-            symbolsize=5, plotrange=[-1,-1, min_elev, max_elev],  
-            averagedata=True, avgtime=str(avgtime), plotfile = plot_file,
-            expformat = 'png', customsymbol = True, symbolshape = 'circle',
-            overwrite=True, showlegend=False, showgui=showgui,
-            exprange='all', iteraxis='spw')
+    cf.queue_plot(logger,vis=msfile, xaxis='time', yaxis='elevation',
+                          correlation='', coloraxis = 'field',
+                          symbolsize=5, plotrange=[-1,-1, min_elev, max_elev],  
+                          averagedata=True, avgtime=str(avgtime), plotfile = plot_file,
+                          expformat = 'png', customsymbol = True, symbolshape = 'circle',
+                          overwrite=True, showlegend=False, showgui=showgui,
+                          exprange='all', iteraxis='spw')
     logger.info('Completed plotting elevation.')
 
 def plot_ants(msfile,logger):
@@ -186,6 +190,34 @@ def plot_ants(msfile,logger):
     plotants(vis=msfile,figfile=plot_file)
     logger.info('Completed plotting antenna positions.')
     
+def transform_args(config,config_raw,chanavg=False):
+    """
+    Returns the mstransform parameters for the selection, Hanning smoothing and channel averaging set in the parameters file.
+    
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    chanavg = Channel averaging was requested interactively. (Boolean)
+    
+    Output:
+    task_args = Parameters for mstransform (other than the input and output MS). (Dictionary)
+    """
+    importdata = config['importdata']
+    task_args = {'datacolumn': 'data'}
+    if importdata['mstransform']:
+        task_args['field'] = ','.join(importdata['keep_fields'])
+        task_args['spw'] = ','.join(importdata['keep_spws'])
+        task_args['observation'] = ','.join(importdata['keep_obs'])
+        if config_raw.has_option('importdata','chanavg') or chanavg:
+            if importdata['chanavg'] > 1:
+                task_args['chanaverage'] = True
+                task_args['chanbin'] = int(importdata['chanavg'])
+    if config_raw.has_option('importdata','hanning'):
+        if config['importdata']['hanning']:
+            task_args['hanning'] = True
+    return task_args
+
+@cf.profile_step
 def transform_data(msfile,config,config_raw,config_file,logger):
     """
     Allows the user to alter the data set by selection only specific observations, fields, and SPWs.
@@ -220,17 +252,8 @@ def transform_data(msfile,config,config_raw,config_file,logger):
             if resp.lower() in ['yes','ye','y']:
                 chanavg = True
                 importdata['chanavg'] = int(cf.uinput('Enter the number of channels to be averaged together: ', importdata['chanavg']))
-        command = "mstransform(vis='{0}', outputvis='{0}_1', field='{1}', spw='{2}', observation='{3}', datacolumn='data'".format(msfile,','.join(importdata['keep_fields']),','.join(importdata['keep_spws']),','.join(importdata['keep_obs']))
-        if config_raw.has_option('importdata','hanning'):
-            if config['importdata']['hanning']:
-                command += ', hanning=True'
-        if config_raw.has_option('importdata','chanavg') or chanavg:
-            if importdata['chanavg'] > 1:
-                command += ', chanaverage=True, chanbin='+str(importdata['chanavg'])
-        command += ')'
-        logger.info('Executing command: '+command)
-        exec(command)           
-        cf.check_casalog(config,config_raw,logger,casalog)
+        task_args = transform_args(config,config_raw,chanavg)
+        cf.run_task('mstransform',config,config_raw,logger,vis=msfile,outputvis=msfile+'_1',**task_args)
         logger.info('Updating config file ({0}) to set mstransform values.'.format(config_file))
         config_raw.set('importdata','keep_obs',importdata['keep_obs'])
         config_raw.set('importdata','keep_spws',importdata['keep_spws'])
@@ -242,6 +265,7 @@ def transform_data(msfile,config,config_raw,config_file,logger):
         configfile.close()
         cf.rmdir(msfile+'.flagversions',logger)
         cf.makedir(msfile+'.flagversions',logger)
+        cf.rmdir(msfile+'.flagdeltas',logger)
         cf.rmdir(msfile,logger)
         cf.mvdir(msfile+'_1',msfile,logger)
         logger.info('Completed data transformation.')
@@ -249,6 +273,7 @@ def transform_data(msfile,config,config_raw,config_file,logger):
     else:
         logger.info('No transformation made.')
         
+@cf.profile_step
 def hanning_smooth(msfile,config,config_raw,config_file,logger):
     """
     Hanning smooths the dataset and replaces the previous version.
@@ -261,12 +286,10 @@ def hanning_smooth(msfile,config,config_raw,config_file,logger):
     """
     logger.info('Starting Hanning smoothing.')
     importdata = config['importdata']
-    command = "hanningsmooth(vis='{0}', outputvis='{0}_1')".format(msfile)
-    logger.info('Executing command: '+command)
-    exec(command)           
-    cf.check_casalog(config,config_raw,logger,casalog)
+    cf.run_task('hanningsmooth',config,config_raw,logger,vis=msfile,outputvis=msfile+'_1')
     cf.rmdir(msfile+'.flagversions',logger)
     cf.makedir(msfile+'.flagversions',logger)
+    cf.rmdir(msfile+'.flagdeltas',logger)
     cf.rmdir(msfile,logger)
     cf.mvdir(msfile+'_1',msfile,logger)
     logger.info('Completed Hanning smoothing.')
@@ -286,10 +309,13 @@ msfile = '{0}.ms'.format(config['global']['project_name'])
 
 # Import data, write listobs to file, and plot positions and elevation
 cf.check_casaversion(logger)
+cf.join_plot_consumer(config,config_raw,logger,reason='before the MS is replaced')
 cf.rmdir('summary',logger)
 cf.rmdir('plots',logger)
 cf.rmdir(msfile,logger)
 cf.rmdir(msfile+'.flagversions',logger)
+cf.rmdir(msfile+'.flagdeltas',logger)
+cf.rmdir('checkpoints',logger)
 data_path = config['importdata']['data_path']
 if not config['importdata']['jvla']:
     data_files = glob.glob(os.path.join(data_path, '*'))
@@ -298,6 +324,8 @@ if not config['importdata']['jvla']:
 else:
     os.symlink(data_path+msfile,msfile)
     os.symlink(data_path+msfile+'.flagversions',msfile+'.flagversions')
+    if os.path.isdir(data_path+msfile+'.flagdeltas'):
+        os.symlink(data_path+msfile+'.flagdeltas',msfile+'.flagdeltas')
 listobs_sum(msfile,config,config_raw,logger)
 transform_data(msfile,config,config_raw,config_file,logger)
 if config_raw.has_option('importdata','hanning') and not config['importdata']['mstransform']:
@@ -306,6 +334,10 @@ if config_raw.has_option('importdata','hanning') and not config['importdata']['m
 msinfo = get_msinfo(msfile,logger)
 plot_elevation(msfile,config,logger)
 plot_ants(msfile,logger)
+cf.render_plots(config,config_raw,logger)
+
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
 
 #Review and backup parameters file
 cf.diff_pipeline_params(config_file,logger)
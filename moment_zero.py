@@ -22,13 +22,16 @@ def noise_est(config,logger):
     src_dir = config['global']['src_dir']+'/'
     noise = []
     for target in targets:
-        msmd.open(src_dir+target+'.split.contsub')
-        N = msmd.nantennas()
-        t_int = msmd.effexposuretime()['value']
-        t_unit = msmd.effexposuretime()['unit']
+        if target_sel is not None and target != target_sel:
+            noise.append(None)
+            continue
+        meta = cf.ms_metadata(src_dir+target+'.split.contsub',logger)
+        N = meta['nantennas']
+        t_int = meta['effexposure']['value']
+        t_unit = meta['effexposure']['unit']
         if t_unit != 's' and 'sec' not in t_unit:
             logger.warning('Integration time units are not in seconds. Estimated noise may be incorrect.')
-        ch_wid = numpy.mean(msmd.chanwidths(0))
+        ch_wid = numpy.mean(meta['spws'][0]['chan_widths'])
         #Note: The above line may cause issues if different spectral windows
         #have very difference frequency resolutions
         corr_eff = cln_param['corr_eff']
@@ -49,13 +52,13 @@ def noise_est(config,logger):
                         else:
                             f_smo = 8./3.
         noise.append(SEFD/(corr_eff*numpy.sqrt(f_smo*N_pol*N*(N-1.)*t_int*ch_wid)))
-        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),msmd.effexposuretime()['unit']))
+        logger.info('Effective integration time for {0}: {1} {2}'.format(target,int(t_int),t_unit))
         logger.info('Expected rms noise for {0}: {1} Jy/beam'.format(target,SEFD/(corr_eff*numpy.sqrt(N_pol*N*(N-1.)*t_int*ch_wid))))
-        msmd.close()
     logger.info('Completed making noise estimation.')
     return noise
 
 
+@cf.profile_step
 def moment0(config,config_raw,config_file,logger):
     """
     Generates a moment zero map of each science target.
@@ -122,27 +125,29 @@ def moment0(config,config_raw,config_file,logger):
     if len(img_list) > 0:
         J2000 = True
     for i in range(len(targets)):
+        if target_sel is not None and targets[i] != target_sel:
+            continue
         if J2000:
             imagename = targets[i]+'.image.J2000'
         else:
             imagename = targets[i]+'.image'
-        command = "immoments(imagename='{0}{1}',includepix=[{2},{3}],chans='{4}',outfile='{5}{6}.mom0')".format(img_dir,imagename,thresh*noises[i],thresh*1E6*noises[i],chans[i],mom_dir,targets[i])
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
-        command = "exportfits(imagename='{0}{1}.mom0', fitsimage='{0}{1}.mom0.fits',overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)".format(mom_dir,targets[i])
-        logger.info('Executing command: '+command)
-        exec(command)
-        cf.check_casalog(config,config_raw,logger,casalog)
+        cf.run_task('immoments',config,config_raw,logger,imagename=img_dir+imagename,includepix=[thresh*noises[i],thresh*1E6*noises[i]],
+                    chans=chans[i],outfile=mom_dir+targets[i]+'.mom0')
+        cf.run_task('exportfits',config,config_raw,logger,imagename=mom_dir+targets[i]+'.mom0',fitsimage=mom_dir+targets[i]+'.mom0.fits',
+                    overwrite=True,dropstokes=True,stokeslast=True,history=True,dropdeg=True)
     logger.info('Completed generation of moment map(s).')
     
 
     
     
-# Read configuration file with parameters
-config_file = sys.argv[-1]
+# Read configuration file with parameters (and optionally the single target to image)
+script_args = cf.get_script_args()
+config_file = script_args[0]
 config,config_raw = cf.read_config(config_file)
 interactive = config['global']['interactive']
+target_sel = None
+if len(script_args) > 1:
+    target_sel = script_args[1]
 
 # Set up your logger
 logger = cf.get_logger(LOG_FILE_INFO  = '{}.log'.format(config['global']['project_name']),
@@ -156,15 +161,18 @@ cf.check_casaversion(logger)
 targets = config['calibration']['target_names']
 mom_path = config['global']['mom_dir']+'/'
 logger.info('Deleting any existing moment(s).')
+mom_glob = '*'
+if target_sel is not None:
+    mom_glob = target_sel
 for target in targets:
-    del_list = glob.glob(mom_path+'*.mom0')
+    del_list = glob.glob(mom_path+mom_glob+'.mom0')
     if len(del_list) > 0:
         for file_path in del_list:
             try:
                 shutil.rmtree(file_path)
             except OSError:
                 pass
-    del_list = glob.glob(mom_path+'*.mom0.fits')
+    del_list = glob.glob(mom_path+mom_glob+'.mom0.fits')
     for file_path in del_list:
         try:
             os.remove(file_path)
@@ -173,3 +181,6 @@ for target in targets:
 
 #Make moment maps
 moment0(config,config_raw,config_file,logger)
+
+#Summarise the time and resources used by each task
+cf.profile_summary(config,logger)
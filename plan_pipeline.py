@@ -0,0 +1,387 @@
+import imp, os, sys, glob, numpy, csv, collections
+imp.load_source('common_functions','common_functions.py')
+import common_functions as cf
+
+# Assumptions of the cost model
+clean_major_cycles = 10 # Major cycles assumed for a CLEAN with a threshold (the dirty images use 1)
+image_products = 7 # Images written by tclean (image, residual, model, psf, pb, sumwt, mask)
+vis_bytes = 12. # Bytes per visibility in a written MS (complex data, weight and flag)
+corrected_bytes = 8. # Bytes per visibility of the CORRECTED_DATA column
+pixel_bytes = 4. # Bytes per image pixel
+# Number of times each task reads (and writes) the visibilities it selects
+task_passes = {'importvla': 1, 'virtualconcat': 0, 'listobs': 0, 'mstransform': 2, 'hanningsmooth': 2, 'flagdata': 1, 'rfi_flagger': 1, 'flag_version': 1,
+               'gencal': 0, 'setjy': 1, 'gaincal': 1, 'bandpass': 1, 'fluxscale': 0, 'applycal': 2, 'split': 2,
+               'plotms': 1, 'flag_plots': 1, 'flag_stats': 1, 'uvcontsub': 2, 'tclean': 2, 'imregrid': 1, 'exportfits': 1, 'immoments': 1}
+
+
+def row_counts(msfile,logger):
+    """
+    Returns the number of rows of every field and SPW, and the channels and correlations of every SPW.
+    The fields and channels come from the cached metadata of the MS (see cf.ms_metadata), so only the row counts and correlations are read.
+
+    Input:
+    msfile = Path to the MS. (String)
+
+    Output:
+    meta = Row counts per (field, SPW) and the shape of each SPW. (Dictionary)
+    """
+    ms_meta = cf.ms_metadata(msfile,logger)
+    field_names = ms_meta['fields']
+    logger.info('Counting the rows of {}.'.format(msfile))
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile+'/DATA_DESCRIPTION')
+    dd_spw = tb_tool.getcol('SPECTRAL_WINDOW_ID')
+    dd_pol = tb_tool.getcol('POLARIZATION_ID')
+    tb_tool.close()
+    tb_tool.open(msfile+'/POLARIZATION')
+    pol_ncorr = tb_tool.getcol('NUM_CORR')
+    tb_tool.close()
+    tb_tool.open(msfile)
+    field_ids = tb_tool.getcol('FIELD_ID')
+    dd_ids = tb_tool.getcol('DATA_DESC_ID')
+    tb_tool.close()
+    rows = collections.defaultdict(int)
+    pairs, counts = numpy.unique(field_ids*len(dd_spw)+dd_ids, return_counts=True)
+    ncorr = {}
+    for pair, count in zip(pairs,counts):
+        field = field_names[pair//len(dd_spw)]
+        spw = int(dd_spw[pair%len(dd_spw)])
+        rows[(field,spw)] += int(count)
+        ncorr[spw] = int(pol_ncorr[dd_pol[pair%len(dd_spw)]])
+    meta = {'rows': rows, 'nchan': dict([(spw,ms_meta['spws'][spw]['nchan']) for spw in range(len(ms_meta['spws']))]), 'ncorr': ncorr,
+            'fields': field_names, 'spws': sorted(ncorr.keys())}
+    meta['vis'] = select_vis(meta)
+    logger.info('{0} rows, {1:.3g} visibilities (rows x channels x correlations).'.format(len(field_ids),meta['vis']))
+    return meta
+
+def select_vis(meta, fields=None, spws=None, chans=None):
+    """
+    Returns the number of visibilities (rows x channels x correlations) in a selection of the MS.
+
+    Input:
+    meta = MS metadata. (Dictionary)
+    fields = Names of the fields selected, all if None. (List of Strings)
+    spws = IDs of the SPWs selected, all if None. (List of Integers)
+    chans = Number of channels selected in each SPW, all if None. (Dictionary)
+    """
+    vis = 0.
+    for (field, spw), nrows in meta['rows'].items():
+        if fields is not None and field not in fields:
+            continue
+        if spws is not None and spw not in spws:
+            continue
+        nchan = meta['nchan'][spw]
+        if chans is not None and spw in chans:
+            nchan = chans[spw]
+        vis += float(nrows)*nchan*meta['ncorr'][spw]
+    return vis
+
+def count_chans(selection, meta):
+    """
+    Returns the number of channels selected in each SPW by a CASA selection string such as '0:100~200;300~400'.
+    """
+    chans = {}
+    for part in str(selection).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if ':' not in part:
+            try:
+                chans[int(part)] = meta['nchan'][int(part)]
+            except (ValueError, KeyError):
+                pass
+            continue
+        spw, ranges = part.split(':',1)
+        try:
+            spw = int(spw)
+        except ValueError:
+            continue
+        nchan = 0
+        for chan_range in ranges.split(';'):
+            limits = chan_range.split('~')
+            try:
+                nchan += int(limits[-1])-int(limits[0])+1
+            except ValueError:
+                pass
+        chans[spw] = chans.get(spw,0)+nchan
+    return chans
+
+def add_call(plan, step, target, task, data, inputs, vis=0., passes=None, pixels=0., cycles=0, disk=0.):
+    """
+    Adds a task call to the plan with its estimated cost.
+    The cost is visibilities x passes for calls on an MS and pixels x channels x major cycles (plus gridding) for images.
+    """
+    if passes is None:
+        passes = task_passes.get(task,1)
+    cost = vis*passes*max(cycles,1)+pixels*max(cycles,1)
+    plan.append(collections.OrderedDict([('step',step), ('target',target), ('task',task), ('data',data), ('inputs',inputs),
+                                         ('visibilities',int(vis)), ('passes',passes), ('pixels',int(pixels)), ('major_cycles',cycles),
+                                         ('cost',cost), ('disk_bytes',int(disk))]))
+
+def target_selection(config, meta):
+    """
+    Returns the fields and SPWs of each imaging target, as split off by 'flag_calib_split'.
+    """
+    calib = config['calibration']
+    selection = collections.OrderedDict()
+    names = calib['target_names']
+    if len(names) != len(calib['targets']) and not any(['.spw' in name for name in names]):
+        names = calib['targets']
+    for name in names:
+        base = name.split('.spw')[0]
+        fields = [calib['targets'][j] for j in range(min(len(names),len(calib['targets']))) if names[j].split('.spw')[0] == base]
+        if len(fields) == 0:
+            fields = [calib['targets'][j] for j in range(len(calib['targets'])) if calib['targets'][j] == base]
+        if '.spw' in name:
+            spws = [int(spw) for spw in name.split('.spw')[1].split('+')]
+        else:
+            spws = [spw for spw in meta['spws'] if any([meta['rows'].get((field,spw),0) > 0 for field in fields])]
+        if calib.get('mosaic',False) and base in selection:
+            continue
+        selection[base if calib.get('mosaic',False) else name] = {'fields': fields, 'spws': spws}
+    return selection
+
+def plan_import(plan, config, config_raw, meta, msfile):
+    """
+    Adds the calls made by 'import_data'. When the archive files are imported in parallel the visibilities are divided between them by file size.
+    """
+    importdata = config['importdata']
+    if not importdata['jvla']:
+        data_files = sorted(glob.glob(os.path.join(importdata['data_path'],'*')))
+        if cf.import_procs(config,config_raw,len(data_files)) < 2:
+            add_call(plan,'import_data','','importvla',msfile,'archivefiles={}'.format(importdata['data_path']),
+                     vis=meta['vis'],disk=meta['vis']*vis_bytes)
+        else:
+            total_size = max(sum([os.path.getsize(data_file) for data_file in data_files]),1)
+            for i in range(len(data_files)):
+                vis = meta['vis']*os.path.getsize(data_files[i])/total_size
+                add_call(plan,'import_data','','importvla',msfile+'.parts/{0:03d}.ms'.format(i),'archivefiles={}'.format(data_files[i]),
+                         vis=vis,disk=vis*vis_bytes)
+            add_call(plan,'import_data','','virtualconcat',msfile,'keepcopy=False',vis=meta['vis'])
+    add_call(plan,'import_data','','listobs',msfile,'',vis=meta['vis'])
+    if importdata['mstransform']:
+        add_call(plan,'import_data','','mstransform',msfile,'field={0} spw={1} observation={2}'.format(importdata['keep_fields'],importdata['keep_spws'],importdata['keep_obs']),
+                 vis=meta['vis'],disk=meta['vis']*vis_bytes)
+        add_call(plan,'import_data','','listobs',msfile,'',vis=meta['vis'])
+    elif importdata.get('hanning',False):
+        add_call(plan,'import_data','','hanningsmooth',msfile,'',vis=meta['vis'],disk=meta['vis']*vis_bytes)
+    add_call(plan,'import_data','','plotms',msfile,'xaxis=time yaxis=elevation',vis=meta['vis'])
+
+def plan_calibration(plan, config, meta, msfile, first):
+    """
+    Adds the calls made by one pass of calibration in 'flag_calib_split'.
+    """
+    calib = config['calibration']
+    spws = [spw for spw in meta['spws'] if any([meta['rows'].get((field,spw),0) > 0 for field in calib['targets']])]
+    if len(spws) == 0:
+        spws = meta['spws']
+    pretabs = 1
+    if config['importdata']['jvla']:
+        add_call(plan,'flag_calib_split','','gencal',msfile,'caltype=antpos')
+        pretabs = 2
+    add_call(plan,'flag_calib_split','','gencal',msfile,'caltype=gceff')
+    for fluxcal in list(set(calib['fluxcal'])):
+        add_call(plan,'flag_calib_split','','setjy',msfile,'field={}'.format(fluxcal),vis=select_vis(meta,[fluxcal],spws))
+    bandcal_vis = select_vis(meta,calib['bandcal'],spws)
+    calfields = list(set(calib['fluxcal']+calib['bandcal']+calib['phasecal']))
+    calfields_vis = select_vis(meta,calfields,spws)
+    add_call(plan,'flag_calib_split','','plotms',msfile,'bandpass phase vs channel (refant)',vis=bandcal_vis)
+    add_call(plan,'flag_calib_split','','gaincal',msfile,'field={} gaintype=K'.format(','.join(calib['bandcal'])),vis=bandcal_vis,passes=pretabs)
+    add_call(plan,'flag_calib_split','','gaincal',msfile,'field={} calmode=p solint=int'.format(','.join(calib['bandcal'])),vis=bandcal_vis,passes=pretabs+1)
+    add_call(plan,'flag_calib_split','','bandpass',msfile,'field={}'.format(','.join(calib['bandcal'])),vis=bandcal_vis,passes=pretabs+2)
+    for solint in ['int','inf']:
+        add_call(plan,'flag_calib_split','','gaincal',msfile,'field={0} calmode=p solint={1}'.format(','.join(calfields),solint),vis=calfields_vis,passes=pretabs+2)
+    add_call(plan,'flag_calib_split','','gaincal',msfile,'field={} calmode=ap solint=inf'.format(','.join(calfields)),vis=calfields_vis,passes=pretabs+3)
+    if len(calfields) > len(set(calib['fluxcal'])):
+        add_call(plan,'flag_calib_split','','fluxscale',msfile,'reference={}'.format(','.join(calib['fluxcal'])))
+    fields = []
+    for field in calib['bandcal']+calib['fluxcal']+calib['phasecal']+calib['targets']:
+        if field not in fields:
+            fields.append(field)
+    if calib.get('otf_calibration',False):
+        #Only a copy of the calibrators is corrected, the targets are corrected as they are split
+        calfields = [field for field in fields if field not in calib['targets']]
+        add_call(plan,'flag_calib_split','','applycal',msfile+' (copy of the calibrators)','docallib=True field={}'.format(','.join(calfields)),
+                 vis=select_vis(meta,calfields,spws))
+    else:
+        add_call(plan,'flag_calib_split','','applycal',msfile,'docallib=True field={}'.format(','.join(fields)),vis=select_vis(meta,fields,spws),
+                 disk=meta['vis']*corrected_bytes if first else 0.)
+    add_call(plan,'flag_calib_split','','plotms',msfile,'corrected phase vs channel',vis=bandcal_vis)
+    add_call(plan,'flag_calib_split','','plotms',msfile,'corrected amplitude vs channel',vis=bandcal_vis)
+
+def plan_flag_calib_split(plan, config, meta, msfile):
+    """
+    Adds the calls made by 'flag_calib_split'.
+    """
+    calib = config['calibration']
+    flag = config['flagging']
+    flag_bytes = meta['vis']/8. # Bit-packed flags of the base version (the later versions only store the rows that changed)
+    def save_flags(name):
+        add_call(plan,'flag_calib_split','','flag_version',msfile,'save versionname={}'.format(name),vis=meta['vis'],disk=flag_bytes)
+    def flag_sum():
+        add_call(plan,'flag_calib_split','','flag_stats',msfile,'FLAG column scan',vis=meta['vis'])
+    save_flags('Original')
+    modes = ['shadow','clip','quack']
+    if os.path.isfile('manual_flags.list'):
+        modes.insert(0,'manual_flags.list')
+    numpy_rfi = flag.get('rfi_engine','casa') == 'numpy'
+    if not flag.get('no_tfcrop',False) and not numpy_rfi:
+        modes.append('tfcrop')
+    add_call(plan,'flag_calib_split','','flagdata',msfile,'mode=list ({})'.format(', '.join(modes)),vis=meta['vis'])
+    if not flag.get('no_tfcrop',False) and numpy_rfi:
+        add_call(plan,'flag_calib_split','','rfi_flagger',msfile,'datacolumn=DATA',vis=meta['vis'])
+    save_flags('initial')
+    flag_sum()
+    fields = list(set(calib['targets']+calib['bandcal']+calib['fluxcal']+calib['phasecal']))
+    add_call(plan,'flag_calib_split','','flag_plots',msfile,'flags of all fields and SPWs (one pass)',
+             vis=select_vis(meta,fields,meta['spws']))
+    plan_calibration(plan, config, meta, msfile, True)
+    otf_rflag = calib.get('otf_calibration',False) and not flag.get('no_rflag',False)
+    def corrected_flags(vis_name, vis, datacolumn, target=''):
+        if numpy_rfi:
+            add_call(plan,'flag_calib_split',target,'rfi_flagger',vis_name,'datacolumn={}'.format({'corrected': 'CORRECTED_DATA', 'data': 'DATA'}[datacolumn]),vis=vis)
+            add_call(plan,'flag_calib_split',target,'flagdata',vis_name,'mode=list (extend, extend)',vis=vis)
+        else:
+            add_call(plan,'flag_calib_split',target,'flagdata',vis_name,'mode=list (rflag datacolumn={}, extend, extend)'.format(datacolumn),vis=vis,passes=2)
+    if not flag.get('no_rflag',False):
+        if otf_rflag:
+            #The corrected data of the calibrators are flagged in a copy (the targets once they are split)
+            calfields = list(set(calib['bandcal']+calib['fluxcal']+calib['phasecal']))
+            calfields_vis = select_vis(meta,calfields,meta['spws'])
+            add_call(plan,'flag_calib_split','','applycal',msfile+' (copy of the calibrators)','docallib=True',vis=calfields_vis)
+            corrected_flags(msfile+' (copy of the calibrators)',calfields_vis,'corrected')
+        else:
+            corrected_flags(msfile,meta['vis'],'corrected')
+        save_flags('extended')
+        flag_sum()
+        plan_calibration(plan, config, meta, msfile, False)
+    save_flags('final')
+    flag_sum()
+    add_call(plan,'flag_calib_split','','flag_plots',msfile,'flags of all fields and SPWs (one pass)',
+             vis=select_vis(meta,fields,meta['spws']))
+    for target, selection in target_selection(config,meta).items():
+        vis = select_vis(meta,selection['fields'],selection['spws'])
+        details = 'field={0} spw={1}'.format(','.join(selection['fields']),selection['spws'])
+        if calib.get('otf_calibration',False):
+            details += ' docallib=True'
+        add_call(plan,'flag_calib_split',target,'mstransform',msfile,details,vis=vis,disk=vis*vis_bytes)
+        add_call(plan,'flag_calib_split',target,'listobs',target+'.split','',vis=vis)
+        if otf_rflag:
+            corrected_flags(target+'.split',vis,'data',target)
+
+def plan_imaging(plan, config, meta):
+    """
+    Adds the calls made by the imaging steps for each target.
+    """
+    cln_param = config['clean']
+    contsub = config['continuum_subtraction']
+    src_dir = config['global']['src_dir']+'/'
+    img_dir = config['global']['img_dir']+'/'
+    selection = target_selection(config,meta)
+    for i, target in enumerate(selection.keys()):
+        fields = selection[target]['fields']
+        spws = selection[target]['spws']
+        vis = select_vis(meta,fields,spws)
+        nchan = sum([meta['nchan'][spw] for spw in spws])
+        try:
+            im_size = int(cln_param['im_size'][i])
+        except (IndexError, ValueError, TypeError):
+            im_size = 0
+        pixels = float(im_size)**2
+        note = '' if im_size > 0 else ' (im_size not set)'
+        add_call(plan,'dirty_cont_image',target,'tclean',src_dir+target+'.split','niter=0 imsize={}{}'.format(im_size,note),
+                 vis=vis,pixels=pixels*nchan,cycles=1,disk=pixels*nchan*pixel_bytes*image_products)
+        try:
+            linefree_ch = contsub['linefree_ch'][i]
+        except (IndexError, TypeError):
+            linefree_ch = ''
+        add_call(plan,'contsub_dirty_image',target,'uvcontsub',src_dir+target+'.split','fitspw={}'.format(linefree_ch),vis=vis,
+                 disk=vis*vis_bytes*(2 if contsub.get('save_cont',False) else 1))
+        add_call(plan,'contsub_dirty_image',target,'tclean',src_dir+target+'.split.contsub','niter=0 imsize={}{}'.format(im_size,note),
+                 vis=vis,pixels=pixels*nchan,cycles=1,disk=pixels*nchan*pixel_bytes*image_products)
+        try:
+            line_ch = cln_param['line_ch'][i]
+        except (IndexError, TypeError):
+            line_ch = ''
+        chans = count_chans(line_ch,meta)
+        line_nchan = sum(chans.values()) if len(chans) > 0 else nchan
+        line_vis = select_vis(meta,fields,spws,chans if len(chans) > 0 else None)
+        add_call(plan,'clean_image',target,'tclean',src_dir+target+'.split.contsub','spw={0} imsize={1}{2}'.format(line_ch,im_size,note),
+                 vis=line_vis,pixels=pixels*line_nchan,cycles=clean_major_cycles,disk=pixels*line_nchan*pixel_bytes*image_products)
+        for image in ['.image','.image.pbcor']:
+            add_call(plan,'clean_image',target,'exportfits',img_dir+target+image,'',pixels=pixels*line_nchan,
+                     disk=pixels*line_nchan*pixel_bytes)
+        add_call(plan,'moment_zero',target,'immoments',img_dir+target+'.image','',pixels=pixels*line_nchan,disk=pixels*pixel_bytes)
+        add_call(plan,'moment_zero',target,'exportfits',config['global']['mom_dir']+'/'+target+'.mom0','',pixels=pixels,disk=pixels*pixel_bytes)
+
+def write_plan(plan, config, logger):
+    """
+    Writes the plan to summary/<project>.plan.csv.
+    """
+    sum_dir = './summary/'
+    cf.makedir(sum_dir,logger)
+    out_file = sum_dir+'{}.plan.csv'.format(config['global']['project_name'])
+    f = open(out_file,'w')
+    writer = csv.DictWriter(f,fieldnames=plan[0].keys())
+    writer.writeheader()
+    for call in plan:
+        writer.writerow(call)
+    f.close()
+    logger.info('Plan of {0} task calls written to: {1}'.format(len(plan),out_file))
+
+def summarise_plan(plan, meta, logger):
+    """
+    Logs the cost and disk use of each step and target, the order in which to image the targets and any step that reads the MS many times.
+    """
+    total_cost = max(sum([call['cost'] for call in plan]),1.)
+    steps = collections.OrderedDict()
+    targets = collections.OrderedDict()
+    for call in plan:
+        step = steps.setdefault(call['step'],{'calls': 0, 'cost': 0., 'disk': 0., 'vis': 0.})
+        step['calls'] += 1
+        step['cost'] += call['cost']
+        step['disk'] += call['disk_bytes']
+        step['vis'] += call['visibilities']*call['passes']
+        if call['target'] != '':
+            targets[call['target']] = targets.get(call['target'],0.)+call['cost']
+    logger.info('Estimated cost by step (visibilities x passes + pixels x channels x major cycles):')
+    for name, step in steps.items():
+        logger.info('{0}: {1} call(s), cost {2:.3g} ({3:.0f}%), disk {4:.2f} GB.'.format(name,step['calls'],step['cost'],100.*step['cost']/total_cost,step['disk']/1e9))
+        if meta['vis'] > 0:
+            full_passes = step['vis']/meta['vis']
+            if full_passes >= 10:
+                logger.warning('{0} reads the equivalent of the full MS {1:.1f} times.'.format(name,full_passes))
+    logger.info('Total: {0} call(s), cost {1:.3g}, disk {2:.2f} GB.'.format(len(plan),total_cost,sum([call['disk_bytes'] for call in plan])/1e9))
+    if len(targets) > 0:
+        logger.info('Targets by estimated cost (longest first): {}'.format(', '.join(['{0} ({1:.3g})'.format(target,cost) for target, cost in sorted(targets.items(), key=lambda item: item[1], reverse=True)])))
+    heaviest = sorted(plan, key=lambda call: call['cost'], reverse=True)[:5]
+    logger.info('Most expensive calls:')
+    for call in heaviest:
+        logger.info('{0} {1} {2} on {3} ({4}): cost {5:.3g} ({6:.0f}%).'.format(call['step'],call['target'],call['task'],call['data'],call['inputs'],call['cost'],100.*call['cost']/total_cost))
+
+
+# Read configuration file with parameters
+config_file = cf.get_script_args()[0]
+config,config_raw = cf.read_config(config_file)
+
+# Set up your logger
+logger = cf.get_logger(LOG_FILE_INFO  = '{}.plan.log'.format(config['global']['project_name']),
+                    LOG_FILE_ERROR = '{}_errors.log'.format(config['global']['project_name']),
+                    new_log = True) # Set up your logger
+
+# Define MS file name
+msfile = '{0}.ms'.format(config['global']['project_name'])
+if not os.path.isdir(msfile) and config['importdata']['jvla']:
+    msfile = config['importdata']['data_path']+msfile
+if not os.path.isdir(msfile):
+    logger.critical('{} not found. The plan is estimated from the MS metadata, so the data must be imported first (run the import_data step).'.format(msfile))
+    sys.exit(-1)
+
+#List every task call with its estimated cost
+meta = row_counts(msfile,logger)
+plan = []
+plan_import(plan,config,config_raw,meta,msfile)
+plan_flag_calib_split(plan,config,meta,msfile)
+plan_imaging(plan,config,meta)
+write_plan(plan,config,logger)
+summarise_plan(plan,meta,logger)
@@ -0,0 +1,14 @@
+import imp, sys
+imp.load_source('common_functions','common_functions.py')
+import common_functions as cf
+
+# Read configuration file with parameters
+config_file = sys.argv[-1]
+config,config_raw = cf.read_config(config_file)
+
+# Set up your logger
+logger = cf.get_logger(LOG_FILE_INFO  = '{}_plots.log'.format(config['global']['project_name']),
+                    LOG_FILE_ERROR = '{}_plots_errors.log'.format(config['global']['project_name'])) # Set up your logger
+
+#Render the deferred QA plots until no more have been requested for a minute
+cf.consume_plot_spool(config,config_raw,logger)
@@ -0,0 +1,229 @@
+import os, time, warnings, multiprocessing
+import numpy
+from numpy.lib.stride_tricks import as_strided
+import common_functions as cf
+
+# Parameters of the flagger
+freq_window = 9 # Channels in the sliding median that removes the residual spectral structure
+sum_windows = [1,2,4,8,16,32] # Window sizes (in samples) of the SumThreshold passes
+sum_rho = 1.5 # The threshold of a window of M samples is the single sample threshold divided by sum_rho**log2(M)
+job_dir = './.rfi_flagger/'
+
+
+def rfi_procs(config,config_raw):
+    """
+    Returns the number of processes flagging at once. This is the number of cores (or 'rfi_procs' in the flagging section of the parameters file).
+
+    Input:
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    """
+    nproc = multiprocessing.cpu_count()
+    if config_raw.has_option('flagging','rfi_procs'):
+        nproc = int(config['flagging']['rfi_procs'])
+    return max(1,nproc)
+
+def sliding_median(cube,window,axis):
+    """
+    Returns the median (ignoring NaNs) of a sliding window along one axis of an array. The window is centred on each sample and truncated at the edges.
+
+    Input:
+    cube = Array of values, with NaN where there is no valid data. (Float array)
+    window = Width of the window in samples (odd). (Integer)
+    axis = Axis along which the window slides. (Integer)
+    """
+    values = numpy.moveaxis(cube,axis,-1)
+    half = window//2
+    pad = numpy.full(values.shape[:-1]+(half,),numpy.nan)
+    padded = numpy.ascontiguousarray(numpy.concatenate([pad,values,pad],axis=-1))
+    view = as_strided(padded,shape=values.shape+(window,),strides=padded.strides+(padded.strides[-1],))
+    return numpy.moveaxis(numpy.nanmedian(view,axis=-1),-1,axis)
+
+def normalised_residuals(amp,flags):
+    """
+    Removes the smooth structure from the time-frequency planes and scales the residuals by their robust standard deviation.
+    The bandpass of each baseline is its median spectrum over time, the residual structure in frequency is removed with a sliding median, and
+    the scale of each baseline and correlation is its median absolute deviation (MAD).
+
+    Input:
+    amp = Amplitudes (baseline x time x channel x correlation). (Float array)
+    flags = Samples already flagged (or without data). (Boolean array)
+
+    Output:
+    resid = Absolute residuals in units of the robust standard deviation, NaN where flagged. (Float array)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+        resid = numpy.where(flags,numpy.nan,amp)
+        resid -= numpy.nanmedian(resid,axis=1,keepdims=True)
+        resid -= sliding_median(resid,freq_window,2)
+        mad = numpy.nanmedian(numpy.abs(resid),axis=(1,2),keepdims=True)
+        resid = numpy.abs(resid)/(1.4826*mad)
+    resid[~numpy.isfinite(resid)] = numpy.nan
+    return resid
+
+def sum_threshold(resid,flags,thresh,axis):
+    """
+    Runs the SumThreshold algorithm along one axis: for each window size M the samples of every window whose mean residual exceeds
+    thresh/sum_rho**log2(M) are flagged. Flagged samples count as being at the threshold, so they neither hide nor add to an excess.
+
+    Input:
+    resid = Normalised absolute residuals, NaN where flagged. (Float array)
+    flags = Samples already flagged. Updated in place. (Boolean array)
+    thresh = Threshold for single samples, in robust standard deviations. (Float)
+    axis = Axis along which the windows run (1 for time, 2 for frequency). (Integer)
+    """
+    nsamp = resid.shape[axis]
+    for size in sum_windows:
+        if size > nsamp:
+            break
+        chi = thresh/sum_rho**numpy.log2(size)
+        values = numpy.moveaxis(numpy.where(flags,chi,numpy.nan_to_num(resid)),axis,-1)
+        cumsum = numpy.concatenate([numpy.zeros(values.shape[:-1]+(1,)),numpy.cumsum(values,axis=-1)],axis=-1)
+        exceed = (cumsum[...,size:]-cumsum[...,:-size]) > size*chi
+        #Flag every sample covered by at least one window that exceeds the threshold
+        count = numpy.concatenate([numpy.zeros(exceed.shape[:-1]+(1,)),numpy.cumsum(exceed,axis=-1)],axis=-1)
+        starts = numpy.clip(numpy.arange(nsamp)-size+1,0,None)
+        stops = numpy.clip(numpy.arange(nsamp)+1,None,exceed.shape[-1])
+        covered = (count[...,stops]-count[...,starts]) > 0
+        flags |= numpy.moveaxis(covered,-1,axis)
+
+def flag_planes(amp,flags,time_thresh,freq_thresh):
+    """
+    Flags RFI in the time-frequency planes of a group of baselines (all at once).
+
+    Input:
+    amp = Amplitudes (baseline x time x channel x correlation). (Float array)
+    flags = Samples already flagged (or without data). (Boolean array)
+    time_thresh = Threshold for single samples along time, in robust standard deviations. (Float)
+    freq_thresh = Threshold for single samples along frequency, in robust standard deviations. (Float)
+
+    Output:
+    flags = The flags including those of the RFI. (Boolean array)
+    """
+    flags = flags.copy()
+    resid = normalised_residuals(amp,flags)
+    sum_threshold(resid,flags,time_thresh,1)
+    sum_threshold(resid,flags,freq_thresh,2)
+    return flags
+
+def baseline_groups(ant1,ant2,nchan,npol,ntime,chunk_bytes):
+    """
+    Splits the cross-correlation baselines into groups whose time-frequency planes fit in 'chunk_bytes' when flagged together.
+
+    Output:
+    groups = Baseline codes (ant1*65536+ant2) of each group. (List of Arrays)
+    """
+    codes = numpy.unique(ant1[ant1 != ant2]*65536+ant2[ant1 != ant2])
+    #The residuals, the sliding median window and the copies of the flags take roughly (freq_window+6) floats per sample
+    per_baseline = ntime*nchan*npol*8.*(freq_window+6)
+    size = max(1,int(chunk_bytes/per_baseline))
+    return [codes[i:i+size] for i in range(0,len(codes),size)]
+
+def flag_job(job):
+    """
+    Flags RFI in one scan of one data description of an MS, reading the time-frequency planes of a group of baselines at a time.
+    The new flags are not written to the MS but saved (for the rows whose flags changed) to 'out_file', so that jobs can run in parallel.
+
+    Input:
+    job = 'vis', 'ddid', 'scan', 'column', 'time_thresh', 'freq_thresh', 'chunk_bytes' and 'out_file'. (Dictionary)
+
+    Output:
+    result = The number of rows read and of rows with new flags, and the wall time. (Dictionary)
+    """
+    start = time.time()
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(job['vis'])
+    selection = tb_tool.query('DATA_DESC_ID=={0} AND SCAN_NUMBER=={1}'.format(job['ddid'],job['scan']),columns='ANTENNA1,ANTENNA2,TIME')
+    ms_rows = numpy.array(selection.rownumbers())
+    ant1 = selection.getcol('ANTENNA1')
+    ant2 = selection.getcol('ANTENNA2')
+    times, time_inx = numpy.unique(selection.getcol('TIME'),return_inverse=True)
+    selection.close()
+    codes = ant1*65536+ant2
+    npol, nchan = tb_tool.getcell('FLAG',int(ms_rows[0])).shape
+    changed_rows = []
+    changed_flags = []
+    for group in baseline_groups(ant1,ant2,nchan,npol,len(times),job['chunk_bytes']):
+        inx = numpy.where(numpy.in1d(codes,group))[0]
+        rows = tb_tool.selectrows([int(row) for row in ms_rows[inx]])
+        amp = numpy.abs(rows.getcol(job['column']))
+        old_flags = rows.getcol('FLAG')
+        rows.close()
+        bl_inx = numpy.searchsorted(group,codes[inx])
+        cube = numpy.zeros((len(group),len(times),nchan,npol))
+        cube_flags = numpy.ones(cube.shape,dtype=bool)
+        cube[bl_inx,time_inx[inx]] = amp.transpose(2,1,0)
+        cube_flags[bl_inx,time_inx[inx]] = old_flags.transpose(2,1,0)
+        new_flags = flag_planes(cube,cube_flags,job['time_thresh'],job['freq_thresh'])[bl_inx,time_inx[inx]].transpose(2,1,0)
+        changed = numpy.where((new_flags != old_flags).any(axis=(0,1)))[0]
+        changed_rows.append(ms_rows[inx][changed])
+        changed_flags.append(new_flags[:,:,changed])
+    tb_tool.close()
+    rows = numpy.concatenate(changed_rows) if len(changed_rows) > 0 else numpy.zeros(0,dtype=int)
+    if len(rows) > 0:
+        numpy.savez(job['out_file'],rows=rows,flags=numpy.concatenate(changed_flags,axis=2))
+    return {'nrows': len(ms_rows), 'nchanged': len(rows), 'wall_time': time.time()-start}
+
+def write_flags(msfile,out_files,logger):
+    """
+    Writes the flags found by the flagging jobs to the MS, in bulk for each job.
+    """
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile,nomodify=False)
+    for out_file in out_files:
+        if not os.path.isfile(out_file):
+            continue
+        new = numpy.load(out_file)
+        rows = tb_tool.selectrows([int(row) for row in new['rows']])
+        rows.putcol('FLAG',new['flags'])
+        rows.putcol('FLAG_ROW',new['flags'].all(axis=(0,1)))
+        rows.close()
+        os.remove(out_file)
+    tb_tool.close()
+
+def flag_ms(msfile,column,time_thresh,freq_thresh,config,config_raw,logger,chunk_bytes=2.5e8):
+    """
+    Flags RFI in an MS with the built-in flagger, as an alternative to CASA's tfcrop and rflag. Each scan of each SPW is a job and the jobs run in
+    separate CASA processes (see cf.run_tasks), as CASA cannot safely fork. The time-frequency planes of many baselines are flagged at once: the smooth structure is removed with medians, the
+    residuals are scaled by their MAD and the SumThreshold algorithm is run along time and frequency. The flags are written back in bulk.
+    The throughput (rows per second) is logged for comparison with the CASA modes.
+
+    Input:
+    msfile = Path to the MS. (String)
+    column = Data column to flag ('DATA' or 'CORRECTED_DATA'). (String)
+    time_thresh = Threshold for single samples along time, in robust standard deviations. (Float)
+    freq_thresh = Threshold for single samples along frequency, in robust standard deviations. (Float)
+    config = The parameters read from the configuration file. (Ordered dictionary)
+    config_raw = The instance of the parser.
+    chunk_bytes = Approximate memory used by each process. (Float)
+    """
+    cf.makedir(job_dir,logger)
+    tb_tool = cf.get_tool('tb')
+    tb_tool.open(msfile)
+    ddids = tb_tool.getcol('DATA_DESC_ID')
+    scans = tb_tool.getcol('SCAN_NUMBER')
+    tb_tool.close()
+    jobs = []
+    for ddid, scan in sorted(set(zip(ddids.tolist(),scans.tolist()))):
+        out_file = job_dir+'{0}.d{1}.s{2}.npz'.format(os.getpid(),ddid,scan)
+        jobs.append({'vis': msfile, 'ddid': ddid, 'scan': scan, 'column': column, 'time_thresh': time_thresh, 'freq_thresh': freq_thresh,
+                     'chunk_bytes': chunk_bytes, 'out_file': out_file, 'nrows': int(numpy.sum((ddids == ddid) & (scans == scan)))})
+    #Start the largest jobs first so that the processes finish together
+    jobs.sort(key=lambda job: job['nrows'],reverse=True)
+    nproc = min(rfi_procs(config,config_raw),len(jobs))
+    logger.info('Flagging RFI in the {0} column of {1}: {2} jobs (scans x SPWs) in {3} processes.'.format(column,msfile,len(jobs),nproc))
+    start = time.time()
+    with cf.task_profile('rfi_flagger(vis={0!r},datacolumn={1!r})'.format(msfile,column),config,logger):
+        if nproc > 1:
+            results = cf.run_tasks('rfi_flagger.flag_job',[{'job': job} for job in jobs],config,config_raw,logger,nproc=nproc,check=False)
+        else:
+            results = [flag_job(job) for job in jobs]
+        flag_time = time.time()-start
+        write_flags(msfile,[job['out_file'] for job in jobs],logger)
+    wall_time = time.time()-start
+    nrows = sum([result['nrows'] for result in results])
+    nchanged = sum([result['nchanged'] for result in results])
+    logger.info('Flagged {0} rows in {1:.1f} s ({2:.0f} rows/s, {3:.1f} s writing the flags). New flags in {4} rows.'.format(
+        nrows,wall_time,nrows/max(wall_time,1e-6),wall_time-flag_time,nchanged))
+    cf.rmdir(job_dir,logger)